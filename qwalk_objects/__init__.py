@@ -1,26 +1,46 @@
 from qwalk_objects import average_tools
+from qwalk_objects import collect
 from qwalk_objects import crystal
 from qwalk_objects import crystal2qmc
+from qwalk_objects import crystal_cache
 from qwalk_objects import dmc
 from qwalk_objects import linear
 from qwalk_objects import orbitals
+from qwalk_objects import parallel
+from qwalk_objects import planner
+from qwalk_objects import postprocess
 from qwalk_objects import propertiesreader
+from qwalk_objects import pseudo_library
+from qwalk_objects import qwalk_log
+from qwalk_objects import reblock
 from qwalk_objects import system
+from qwalk_objects import trace
 from qwalk_objects import trialfunc
+from qwalk_objects import twist
 from qwalk_objects import variance
 from qwalk_objects import vmc
 
 __all__ = [
     'average_tools',
+    'collect',
     'crystal',
     'crystal2qmc',
+    'crystal_cache',
     'dmc',
     'linear',
     'orbitals',
+    'parallel',
+    'planner',
+    'postprocess',
     'propertiesreader',
+    'pseudo_library',
+    'qwalk_log',
+    'reblock',
     'slater',
     'system',
+    'trace',
     'trialfunc',
+    'twist',
     'variance',
     'vmc'
   ]
@@ -8,7 +8,7 @@ from copy import deepcopy
 
 ##########################################################
 # Tools for handling basis set input.
-from xml.etree.ElementTree import ElementTree
+from qwalk_objects.pseudo_library import get_library
 def edit_xml_basis(xml_name,symbols,min_exp=0.2,naug=2,alpha=3,
                        cutoff=0.2,basis_name='vtz',
                        nangular={"s":1,"p":1,"d":1,"f":1,"g":0}
@@ -27,28 +27,23 @@ def edit_xml_basis(xml_name,symbols,min_exp=0.2,naug=2,alpha=3,
   '''
 
   allbasis={}
+  library=get_library(xml_name)
 
   for symbol in symbols:
     allbasis[symbol]=[]
     transition_metals=["Sc","Ti","V","Cr","Mn","Fe","Co","Ni","Cu","Zn"]
     if symbol in transition_metals:
       nangular['s']=max(nangular['s'],2)
-    tree = ElementTree()
-    tree.parse(xml_name)
-    element = tree.find('./Pseudopotential[@symbol="{}"]'.format(symbol))
-    basis_path = './Basis-set[@name="{}"]/Contraction'.format(basis_name)
 
     # add in the first nangular basis functions.
     found_orbitals = []  
-    for contraction in element.findall(basis_path):
-      angular = contraction.get('Angular_momentum')
+    for contraction in library.basis(symbol,basis_name):
+      angular = contraction['angular']
       if found_orbitals.count(angular) >= nangular[angular]:
         continue
       nterms = 0
       basis_sec={'angular':angular,'primitives':[]}
-      for basis_term in contraction.findall('./Basis-term'):
-        exp = basis_term.get('Exp')
-        coeff = basis_term.get('Coeff')
+      for exp,coeff in contraction['terms']:
         if float(exp) > cutoff:
           basis_sec['primitives'].append((exp, coeff))
           nterms+=1
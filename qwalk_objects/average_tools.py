@@ -1,3 +1,4 @@
+import numpy as np
 from numpy import array
 
 ################################################
@@ -69,10 +70,16 @@ def check_opts(opts):
       Make sure all of %s are set."""%(key,', '.join(check))
 
 ################################################
-def kaverage(name,data):
-  ''' kaverage the data for each property.'''
+def kaverage(name,data,aslist=True,weights=None):
+  ''' kaverage the data for each property.
+  Args:
+    name (str): name of the average generator.
+    data (list): gosling output of the property for each kpoint.
+    aslist (bool): return nested lists like gosling (otherwise arrays).
+    weights (list): weight of each kpoint (e.g. Orbitals.kweight). Default is equal weights.
+  '''
   if name=='average_derivative_dm':
-    return _kaverage_deriv(data)
+    return _kaverage_deriv(data,aslist,weights)
   elif name=='region_fluctuation':
     return [] # TODO
   else:
@@ -81,74 +88,84 @@ def kaverage(name,data):
     You should implement it, it should be easy!"""%name)
 
 ################################################
-def _kaverage_tbdm(data):
-  nkpt=len(data)
-  nstates=len(data[0]['states'])
-  res={'obdm':{},'tbdm':{}}
+def _kmean(kdata,getval,keep=None,weights=None):
+  ''' Weighted mean and propagated error over kpoints, accumulating one kpoint at a time.
+  Args:
+    kdata (list): data for each kpoint.
+    getval (function): getval(data,suffix) gets the values ('') or errors ('_err') from one kpoint's data.
+      Should raise KeyError if there are no errors.
+    keep (tuple): slices of each kpoint's values to keep.
+    weights (list): weight of each kpoint. Default is equal weights.
+  Returns:
+    tuple: (mean,error) arrays. error is None if there are no errors.
+  '''
+  if weights is None:
+    weights=np.ones(len(kdata))
+  total=0.0
+  errsq=0.0
+  for data,weight in zip(kdata,weights):
+    vals=np.asarray(getval(data,''),dtype=float)
+    total=total+weight*(vals if keep is None else vals[keep])
+    if errsq is not None:
+      try:
+        errs=np.asarray(getval(data,'_err'),dtype=float)
+        errsq=errsq+(weight*(errs if keep is None else errs[keep]))**2
+      except KeyError:
+        errsq=None
+  wtot=float(np.sum(weights))
+  if errsq is None:
+    return total/wtot,None
+  return total/wtot,errsq**0.5/wtot
+
+################################################
+def _kaverage_tbdm(data,aslist=True,weights=None):
+  ''' Average the 1- and 2-RDMs over kpoints.
+  Args:
+    data (list): tbdm output for each kpoint. May also be a list (over kpoints) of lists of tbdm outputs,
+      which are averaged together (for example, one for each parameter in average_derivative_dm).
+    aslist (bool): return nested lists like gosling (otherwise arrays).
+    weights (list): weight of each kpoint. Default is equal weights.
+  Returns:
+    dict: averaged 'obdm' and 'tbdm', with '_err' entries if the data has errors.
+  '''
+  nested=type(data[0]) is list
+  if not nested: data=[[tbdm] for tbdm in data]
+  nset=len(data[0])
+  nstates=len(data[0][0]['states'])
+  res=[{'obdm':{},'tbdm':{}} for i in range(nset)]
 
-  # Wait, do we need this? This is already in tbdm, no?
-  for key in ['up','down']:
-    res['obdm'][key]=[
-        [
-          sum([
-            data[i]['obdm'][key][k][l]
-            for i in range(nkpt)
-          ])/nkpt 
-          for l in range(nstates)
-        ] 
-        for k in range(nstates)
-      ] 
+  # Wait, do we need obdm? This is already in tbdm, no?
+  for dm,keys,ndim in [('obdm',['up','down'],2),('tbdm',['upup','updown','downup','downdown'],4)]:
+    keep=(slice(None),)+(slice(0,nstates),)*ndim
+    for key in keys:
+      mean,err=_kmean(data,lambda kdata,suffix: [tbdm[dm][key+suffix] for tbdm in kdata],keep,weights)
+      for i in range(nset):
+        res[i][dm][key]=mean[i].tolist() if aslist else mean[i]
+        if err is not None:
+          res[i][dm][key+'_err']=err[i].tolist() if aslist else err[i]
 
-  for key in ['upup','updown','downup','downdown']:
-    res['tbdm'][key]=[
-        [
-          [
-            [
-              sum([
-                data[i]['tbdm'][key][k][l][m][n]
-                for i in range(nkpt)
-              ])/nkpt 
-              for n in range(nstates)
-            ] 
-            for m in range(nstates)
-          ]
-          for l in range(nstates)
-        ] 
-        for k in range(nstates)
-      ] 
+  if not nested: return res[0]
   return res
 
 ################################################
-def _kaverage_deriv(data):
+def _kaverage_deriv(data,aslist=True,weights=None):
   res={}
-  nparm=len(data[0]['dpenergy']['vals'])
   nkpt=len(data)
-  nstates=len(data[0]['tbdm']['states'])
 
   # Parameters with one value per parameter values.
   for prop in ['dpenergy','dpwf']:
-    res[prop]=[
-        sum([
-          data[i][prop]['vals'][j]
-          for i in range(nkpt)
-        ])/nkpt
-        for j in range(nparm)
-      ]
-    res['%s_err'%prop]=[
-        (sum([
-          data[i][prop]['err'][j]**2
-          for i in range(nkpt)
-        ])/nkpt)**0.5
-        for j in range(nparm)
-      ]
+    res[prop],res['%s_err'%prop]=_kmean(data,
+        lambda kdata,suffix: kdata[prop]['err' if suffix else 'vals'],weights=weights)
+    if aslist:
+      res[prop]=res[prop].tolist()
+      res['%s_err'%prop]=res['%s_err'%prop].tolist()
 
-  res['tbdm']=_kaverage_tbdm([data[k]['tbdm'] for k in range(nkpt)])
+  res['tbdm']=_kaverage_tbdm([data[k]['tbdm'] for k in range(nkpt)],aslist,weights)
 
-  res['dprdm']=[
-      _kaverage_tbdm(
-        [data[k]['dprdm'][i]['tbdm'] for k in range(nkpt)]
-      ) for i in range(nparm)
-    ]
+  # All parameters are averaged together.
+  res['dprdm']=_kaverage_tbdm(
+      [[dprdm['tbdm'] for dprdm in data[k]['dprdm']] for k in range(nkpt)],
+      aslist,weights)
 
   return res
 
@@ -1,9 +1,9 @@
 import numpy as np
+import multiprocessing
 import scipy.optimize as optimize
 import scipy
 from math import factorial
 from xml.etree.ElementTree import ElementTree,SubElement,Element
-from scipy.integrate import quad
 ####################################################
 
 def generate_norm(e,n):
@@ -13,120 +13,179 @@ def generate_norm(e,n):
 n_map={'S':1,'P':2,'D':3,'F':5 } 
 ####################################################
 
+def gaussian_matrix(exp,el,x):
+  ''' Normalized primitives exp evaluated at each x, as a matrix [x,primitive].'''
+  exp=np.asarray(exp,dtype=float)
+  x=np.asarray(x,dtype=float).reshape(-1,1)
+  return generate_norm(exp,n_map[el])*np.exp(-exp*x**2)
+
 def evaluate(exp,coeff,el,x):
-  f=0.0*x
+  ''' Contraction with exponents exp and coefficients coeff at x (zero if any exponent is negative).'''
+  x=np.asarray(x,dtype=float)
   if np.any(np.array(exp)<0):
-    return f
-  for e,c in zip(exp,coeff):
-    n=generate_norm(e,n_map[el] )
-    f+=n*c*np.exp( - e*x**2)
-  return f
+    return 0.0*x
+  nprim=min(len(exp),len(coeff))
+  return (gaussian_matrix(exp[:nprim],el,x)@np.asarray(coeff[:nprim],dtype=float)).reshape(x.shape)
 
 ####################################################
-  
-  
-def fit_exp(basis,expnew=(.2,.4,.8,1.6,3.2,6.4,12.8,25.6) ):
-  p0=[1.]*len(expnew)
-
-  xdata=np.logspace(-5,1,1000)
-  ydata=evaluate(basis['exp'],basis['coeff'],basis['el'],xdata)
-  #print(ydata)
-  pf,pcov=optimize.curve_fit(lambda x,p1,p2,p3,p4,p5,p6,p7,p8,p9,p10: \
-                             evaluate(expnew,[p1,p2,p3,p4,p5,p6,p7,p8,p9,p10],basis['el'],x),
-                             xdata, ydata,p0)
-#  err=evaluate(expnew,pf,basis['el'],xdata)-ydata
-  err=quad(lambda x: np.abs(evaluate(expnew,pf,basis['el'],x)-\
-      evaluate(basis['exp'],basis['coeff'],basis['el'],x)),
-      0,10.0)
-  
-  
-  return expnew,pf,np.sqrt(np.sum(err[0]**2))
-                  
+def _gauss_legendre(lower,upper,npanel=200,order=8):
+  ''' Points and weights of composite Gauss-Legendre quadrature on [lower,upper].'''
+  nodes,weights=np.polynomial.legendre.leggauss(order)
+  edges=np.linspace(lower,upper,npanel+1)
+  half=(edges[1:]-edges[:-1])/2
+  points=(edges[:-1]+half)[:,None]+half[:,None]*nodes
+  return points.ravel(),(half[:,None]*weights).ravel()
+
+fit_x=np.logspace(-5,1,1000)
+quad_x,quad_w=_gauss_legendre(0,10.0)
+
+def fit_error(basis,exp,coeff):
+  ''' Integral of |fit-original| over [0,10], with fixed quadrature.'''
+  diff=evaluate(exp,coeff,basis['el'],quad_x)-evaluate(basis['exp'],basis['coeff'],basis['el'],quad_x)
+  return np.abs(diff)@quad_w
+
 ####################################################
+def fit_exp(basis,expnew=(.2,.4,.8,1.6,3.2,6.4,12.8,25.6) ):
+  ''' Fit the coefficients of primitives with exponents expnew to the contraction basis.
+  With the exponents fixed the fit is linear, so it's solved exactly by least squares.
+  Args:
+    basis (dict): contraction with 'el', 'exp', and 'coeff'.
+    expnew (list): exponents of the fit; any number of them.
+  Returns:
+    tuple: (exponents,coefficients,error).
+  '''
+  ydata=evaluate(basis['exp'],basis['coeff'],basis['el'],fit_x)
+  pf=np.linalg.lstsq(gaussian_matrix(expnew,basis['el'],fit_x),ydata,rcond=None)[0]
+  return expnew,pf,fit_error(basis,expnew,pf)
 
+####################################################
 def fit_exp_all(basis,expnew):
-  p0=list(expnew)+[1.]*len(expnew) 
-
-  xdata=np.logspace(-5,1,1000)
-  ydata=evaluate(basis['exp'],basis['coeff'],basis['el'],xdata)
-  #print(ydata)
-  pf,pcov=optimize.curve_fit(lambda x,
-                            e1,e2,e3,e4,e5,e6,e7,e8,e9,e10,
-                            p1,p2,p3,p4,p5,p6,p7,p8,p9,p10: \
-                             evaluate([e1,e2,e3,e4,e5,e6,e7,e8,e9,e10],
-                               [p1,p2,p3,p4,p5,p6,p7,p8,p9,p10],basis['el'],x),
-                             xdata, ydata,p0)
-#  err=evaluate(expnew,pf,basis['el'],xdata)-ydata
-  err=quad(lambda x: np.abs(evaluate(expnew,pf,basis['el'],x)-\
-      evaluate(basis['exp'],basis['coeff'],basis['el'],x)),
-      0,10.0)
-  
-  
-  return expnew,pf,np.sqrt(np.sum(err[0]**2))
+  ''' Fit both the exponents and coefficients to the contraction basis, starting from exponents expnew.
+  Uses the analytic Jacobian of the fit, and keeps exponents positive.
+  Args:
+    basis (dict): contraction with 'el', 'exp', and 'coeff'.
+    expnew (list): initial exponents; any number of them.
+  Returns:
+    tuple: (exponents,coefficients,error).
+  '''
+  nprim=len(expnew)
+  nang=n_map[basis['el']]
+  ydata=evaluate(basis['exp'],basis['coeff'],basis['el'],fit_x)
+  x2=fit_x.reshape(-1,1)**2
+
+  def model(x,*params):
+    return gaussian_matrix(params[:nprim],basis['el'],x)@np.asarray(params[nprim:])
+
+  def jacobian(x,*params):
+    exp,coeff=np.asarray(params[:nprim]),np.asarray(params[nprim:])
+    prims=gaussian_matrix(exp,basis['el'],x)
+    # d/de [N(e) exp(-e x^2)] = N(e) exp(-e x^2) ((2n+1)/(4e) - x^2).
+    dexp=prims*((2*nang+1)/(4*exp)-x2)*coeff
+    return np.hstack([dexp,prims])
+
+  p0=list(expnew)+list(fit_exp(basis,expnew)[1])
+  bounds=([1e-8]*nprim+[-np.inf]*nprim,[np.inf]*(2*nprim))
+  pf,pcov=optimize.curve_fit(model,fit_x,ydata,p0,jac=jacobian,bounds=bounds)
+  return pf[:nprim],pf[nprim:],fit_error(basis,pf[:nprim],pf[nprim:])
 
 ####################################################
+def refit_contraction(task):
+  ''' Fit one contraction with the even-tempered exponents ebase*2**i, i<nexp.
+  Args:
+    task (tuple): (basis,ebase,nexp) with basis a dict of 'el', 'exp', and 'coeff'.
+  Returns:
+    tuple: (exponents,coefficients,error). error is inf if the fit failed.
+  '''
+  basis,ebase,nexp=task
+  exptest=[ebase*2**i for i in range(nexp)]
+  try:
+    return fit_exp(basis,exptest)
+  except (RuntimeError,np.linalg.LinAlgError) as err:
+    print("Fit failed for ebase {}: {}".format(ebase,err))
+    return exptest,None,np.inf
 
-if __name__=="__main__":
+####################################################
+def refit_library(xml_name="BFD_Library.xml",outfn="BFD_PBC0.20.xml",errfn="errors.csv",
+    ebases=(0.20,),min_exp=0.2,nexp=10,nproc=1):
+  ''' Refit every contraction with exponents below min_exp in terms of even-tempered exponents.
+  Each contraction is fit for every ebase, and the fit with the smallest error is kept.
+  The fits are independent, so they're run in a process pool; results don't depend on nproc.
+
+  Args:
+    xml_name (str): library to refit.
+    outfn (str): where to write the refitted library.
+    errfn (str): where to write the table of fit errors (csv). None to skip.
+    ebases (list): smallest exponent of the even-tempered sets to try.
+    min_exp (float): contractions whose exponents are all at least this are kept as they are.
+    nexp (int): number of even-tempered exponents in each fit.
+    nproc (int): number of processes.
+  Returns:
+    list: row (dict) of the error table for each fit: symbol, basis, shell, angular, ebase, err.
+  '''
   tree=ElementTree()
-  tree.parse("BFD_Library.xml")
+  tree.parse(xml_name)
   root=tree.getroot()
-  df={'symbol':[],'shell':[],'err':[],'angular':[],'ebase':[]}
+
+  # Contractions to fit, in the order of the file.
+  refit=[]
   for child in root:
-    print(child.tag,child.attrib['symbol'])
     for child2 in child:
-      #print(child2.tag)
       if child2.tag=='Basis-set':
         shell=0
         for child3 in child2:
           if child3.tag=='Contraction':
-            n=int(child3.attrib['nterms'])
             shell+=1
+            if int(child3.attrib['nterms'])<=1: continue
+            basis={'el':child3.attrib['Angular_momentum'].upper(),
+                   'exp':[float(contract.attrib['Exp']) for contract in child3],
+                   'coeff':[float(contract.attrib['Coeff']) for contract in child3]}
+            if np.min(basis['exp']) >= min_exp: continue
+            refit.append((child.attrib['symbol'],child2.attrib.get('name'),shell,child3,basis))
+
+  tasks=[(basis,ebase,nexp) for symbol,name,shell,contraction,basis in refit for ebase in ebases]
+  if nproc>1:
+    pool=multiprocessing.Pool(nproc)
+    try:
+      fits=pool.map(refit_contraction,tasks)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    fits=[refit_contraction(task) for task in tasks]
 
-            basis={}
-            basis['el']=child3.attrib['Angular_momentum'].upper()
-            if n>1:
-              basis['exp']=[]
-              basis['coeff']=[]
-              for contract in child3:
-                basis['exp'].append(float(contract.attrib['Exp']))
-                basis['coeff'].append(float(contract.attrib['Coeff']))
-              if np.min(basis['exp']) >=0.2:
-                expnew=basis['exp']
-                pf=basis['coeff']
-                err=0.
-              elif n==1:
-                expnew=[]
-                pf=[]
-                err=0
-              else:
-                err=1e8
-                for ebase in [0.20]:
-                  exptest=[]
-                  for i in range(10):
-                    exptest.append(ebase*2**i)
-                  exptest,pftest,errtest=fit_exp(basis,exptest)
-                  print(ebase,errtest)
-                  df['symbol'].append(child.attrib['symbol'])
-                  df['shell'].append(shell)
-                  df['err'].append(pftest)
-                  df['angular'].append(basis['el'])
-                  df['ebase'].append(ebase)
-                  if errtest < err:
-                    expnew=exptest[:]
-                    pf=pftest[:]
-                    err=errtest
-
-                  
-              
-              for contract in child3.findall('Basis-term'):
-                child3.remove(contract)
-              child3.attrib['nterms']=str(len(expnew))
-              for e,c in zip(expnew,pf):
-                child3.append(Element("Basis-term",
-                  attrib={'Exp':str(e),'Coeff':str(c)}))
-              print("err",err)
-
-  tree.write("BFD_PBC0.20.xml")             
-  import pandas as pd
-  pd.DataFrame(df).to_csv("errors.csv")
+  table=[]
+  for cidx,(symbol,name,shell,contraction,basis) in enumerate(refit):
+    best=None
+    for eidx,ebase in enumerate(ebases):
+      expnew,pf,err=fits[cidx*len(ebases)+eidx]
+      table.append({'symbol':symbol,'basis':name,'shell':shell,'angular':basis['el'],'ebase':ebase,'err':err})
+      if pf is not None and (best is None or err < best[2]):
+        best=(expnew,pf,err)
+    if best is None:
+      print("No fit for {} {} shell {}; keeping the original.".format(symbol,name,shell))
+      continue
 
+    expnew,pf,err=best
+    for contract in contraction.findall('Basis-term'):
+      contraction.remove(contract)
+    contraction.attrib['nterms']=str(len(expnew))
+    for e,c in zip(expnew,pf):
+      contraction.append(Element("Basis-term",
+        attrib={'Exp':str(e),'Coeff':str(c)}))
+
+  tree.write(outfn)
+  if errfn is not None:
+    import pandas as pd
+    pd.DataFrame(table,columns=['symbol','basis','shell','angular','ebase','err']).to_csv(errfn)
+  return table
+
+####################################################
+if __name__=="__main__":
+  import argparse
+  parser=argparse.ArgumentParser("Refit a basis library with even-tempered exponents.")
+  parser.add_argument('xml_name',nargs='?',default="BFD_Library.xml",help='Library to refit.')
+  parser.add_argument('-o','--outfn',default="BFD_PBC0.20.xml",help='Refitted library.')
+  parser.add_argument('-e','--ebases',type=float,nargs='+',default=[0.20],help='Smallest exponents to try.')
+  parser.add_argument('-n','--nproc',type=int,default=1,help='Number of processes.')
+  args=parser.parse_args()
+  refit_library(args.xml_name,args.outfn,ebases=args.ebases,nproc=args.nproc)
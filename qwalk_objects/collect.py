@@ -0,0 +1,119 @@
+'''
+Collect results of many runs at once.
+collect_runs runs a reader over a list of outputs in a process or thread pool, and returns one row per run
+with the status, energy, error, and number of blocks, along with how long each file took to read.
+The rows can be passed directly to pandas.DataFrame.
+To poll running calculations, pass the same readers dict to every call: each file keeps its reader, so only
+output appended since the last call is parsed.
+'''
+
+from __future__ import division,print_function
+import time
+import copy
+import multiprocessing
+import multiprocessing.pool
+
+columns=['file','status','completed','energy','error','blocks','sigma','time','message']
+
+####################################################
+def collect_runs(outfiles,reader,nproc=1,threads=False,args=None,keep_output=False,as_frame=False,readers=None):
+  ''' Collect the results of many runs with the same kind of reader.
+
+  Args:
+    outfiles (list): output files, as passed to reader.collect.
+    reader (object): reader with collect(outfile,...) and output, e.g. VMCReader(errtol=0.001).
+      Each file is collected by a copy of it, so its settings apply to every run.
+    nproc (int): number of processes (or threads) to collect with.
+    threads (bool): use threads instead of processes. Processes are faster for the text parsers.
+    args (list): extra arguments to collect for each file, e.g. [(chkfile,),...] for PySCFReader.
+    keep_output (bool): include the reader output of each run in the row.
+    as_frame (bool): return a pandas.DataFrame instead of a list.
+    readers (dict): reader of each output file from earlier calls, updated by this one. Files in it are
+      collected by their own reader instead of a new copy, so the reader's state (like how much of the log
+      was read, and when) carries over between calls.
+  Returns:
+    list: dict for each run, in the order of outfiles, with keys from `columns`:
+      status is the return of collect, or 'error' if reading failed (message says why);
+      energy, error, blocks, and sigma are None if the run doesn't have them; time is in seconds.
+      error is reader.energy_error() if the reader has it, the same error collect checks against errtol.
+  '''
+  if args is None:
+    args=[()]*len(outfiles)
+  assert len(args)==len(outfiles), "Need one set of args for each output file."
+  keep_reader=readers is not None
+  if readers is None:
+    readers={}
+  tasks=[(readers.get(outfile,reader),outfile not in readers,outfile,tuple(arg),keep_output,keep_reader)
+      for outfile,arg in zip(outfiles,args)]
+
+  if nproc>1:
+    poolclass=multiprocessing.pool.ThreadPool if threads else multiprocessing.Pool
+    pool=poolclass(nproc)
+    try:
+      rows=pool.map(_collect_one,tasks,chunksize=max(1,len(tasks)//(4*nproc)))
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    rows=[_collect_one(task) for task in tasks]
+
+  if keep_reader:
+    for outfile,row in zip(outfiles,rows):
+      readers[outfile]=row.pop('reader')
+  if as_frame:
+    import pandas as pd
+    return pd.DataFrame(rows,columns=columns+(['output'] if keep_output else []))
+  return rows
+
+####################################################
+def timing_summary(rows):
+  ''' Total, mean, and slowest collection time of rows from collect_runs.'''
+  times=[row['time'] for row in rows]
+  if len(times)==0:
+    return {'total':0.0,'mean':0.0,'max':0.0,'slowest':None}
+  slowest=max(range(len(times)),key=lambda i: times[i])
+  return {'total':sum(times),'mean':sum(times)/len(times),'max':times[slowest],'slowest':rows[slowest]['file']}
+
+####################################################
+def summarize_output(output):
+  ''' Energy, error, blocks, and sigma from the output of any of the readers.'''
+  row={'energy':None,'error':None,'blocks':None,'sigma':None}
+  if 'properties' in output and 'total_energy' in output['properties']:
+    # VMC, DMC, and postprocess (gosling layout).
+    row['energy']=output['properties']['total_energy']['value'][0]
+    row['error']=output['properties']['total_energy']['error'][0]
+    if 'total blocks' in output:
+      row['blocks']=output['total blocks']-output.get('warmup blocks',0)
+  elif 'total_energy' in output:
+    # Linear and Crystal.
+    row['energy']=output['total_energy']
+    row['error']=output.get('total_energy_err')
+  elif 'scf' in output and output['scf'] is not None and 'e_tot' in output['scf']:
+    # PySCF.
+    row['energy']=float(output['scf']['e_tot'])
+  if output.get('sigma') is not None:
+    row['sigma']=output['sigma']
+  return row
+
+####################################################
+def _collect_one(task):
+  reader,new,outfile,args,keep_output,keep_reader=task
+  if new:
+    reader=copy.deepcopy(reader)
+  row={'file':outfile,'status':'error','completed':False,'message':''}
+  start=time.perf_counter()
+  try:
+    row['status']=reader.collect(outfile,*args)
+    row['completed']=reader.completed
+    row.update(summarize_output(reader.output))
+    if row['energy'] is not None and hasattr(reader,'energy_error'):
+      row['error']=reader.energy_error()
+  except Exception as err:
+    row.update(summarize_output({}))
+    row['message']='%s: %s'%(err.__class__.__name__,err)
+  row['time']=time.perf_counter()-start
+  if keep_output:
+    row['output']=reader.output
+  if keep_reader:
+    row['reader']=reader
+  return row
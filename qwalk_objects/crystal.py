@@ -7,7 +7,7 @@ from pymatgen.io.cif import CifParser
 from pymatgen.io.xyz import XYZ
 from pymatgen.core.periodic_table import Element
 import qwalk_objects as obj
-from xml.etree.ElementTree import ElementTree
+from qwalk_objects.pseudo_library import get_library
 import numpy as np
 import os
 
@@ -447,28 +447,23 @@ class CrystalWriter:
       maxorb=4
       nangular['s']=2
     
-    tree = ElementTree()
-    tree.parse(self.xml_name)
-    element = tree.find('./Pseudopotential[@symbol="{}"]'.format(symbol))
-    atom_charge = int(element.find('./Effective_core_charge').text)
+    library = get_library(self.xml_name)
+    atom_charge = int(library.pseudopotential(symbol)['core_charge'])
     if symbol in self.initial_charges.keys():
       atom_charge-=self.initial_charges[symbol]
-    basis_path = './Basis-set[@name="{}"]/Contraction'.format(basis_name)
     found_orbitals = []
     totcharge=0
     ret=[]
     ncontract=0
-    for contraction in element.findall(basis_path):
-        angular = contraction.get('Angular_momentum')
+    for contraction in library.basis(symbol,basis_name):
+        angular = contraction['angular']
         if found_orbitals.count(angular) >= nangular[angular]:
             continue
 
         #Figure out which coefficients to print out based on the minimal exponent
         nterms = 0
         basis_part=[]
-        for basis_term in contraction.findall('./Basis-term'):
-            exp = basis_term.get('Exp')
-            coeff = basis_term.get('Coeff')
+        for exp,coeff in contraction['terms']:
             if float(exp) > self.cutoff:
                 basis_part += ['  {} {}'.format(exp, coeff)]
                 nterms+=1
@@ -518,33 +513,21 @@ class CrystalWriter:
     Returns:
         list of lines of pseudopotential section (edit by Brian Busemeyer).
     """
-    tree = ElementTree()
-    tree.parse(self.xml_name)
-    element = tree.find('./Pseudopotential[@symbol="{}"]'.format(symbol))
-    eff_core_charge = element.find('./Effective_core_charge').text
-    local_path = './Gaussian_expansion/Local_component'
-    non_local_path = './Gaussian_expansion/Non-local_component'
-    local_list = element.findall(local_path)
-    non_local_list = element.findall(non_local_path)
+    element = get_library(self.xml_name).pseudopotential(symbol)
+    eff_core_charge = element['core_charge']
+    local_list = element['local']
+    non_local_list = element['nonlocal']
     nlocal = len(local_list)
     m = [0, 0, 0, 0, 0]
-    proj_path = './Gaussian_expansion/Non-local_component/Proj'
-    proj_list = element.findall(proj_path)
-    for projector in proj_list:
-        m[int(projector.text)] += 1
+    for projector in element['proj']:
+        m[int(projector)] += 1
     strlist = []
     strlist.append('INPUT')
     strlist.append(' '.join(map(str,[eff_core_charge,nlocal,
                                      m[0],m[1],m[2],m[3],m[4]])))
-    for local_component in local_list:
-        exp_gaus = local_component.find('./Exp').text
-        coeff_gaus = local_component.find('./Coeff').text
-        r_to_n = local_component.find('./r_to_n').text
+    for exp_gaus, coeff_gaus, r_to_n in local_list:
         strlist.append(' '.join([exp_gaus, coeff_gaus,r_to_n]))
-    for non_local_component in non_local_list:
-        exp_gaus = non_local_component.find('./Exp').text
-        coeff_gaus = non_local_component.find('./Coeff').text
-        r_to_n = non_local_component.find('./r_to_n').text
+    for exp_gaus, coeff_gaus, r_to_n in non_local_list:
         strlist.append(' '.join([exp_gaus, coeff_gaus,r_to_n]))
     return strlist
 import os 
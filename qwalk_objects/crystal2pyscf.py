@@ -4,7 +4,8 @@
 import pandas as pd
 import numpy as np
 from functools import reduce
-from qwalk_objects.crystal2qmc import periodic_table,read_gred, read_kred, read_outputfile, eigvec_lookup
+from qwalk_objects.crystal2qmc import periodic_table, read_outputfile, eigvec_lookup
+from qwalk_objects.crystal_cache import load_crystal
 import pyscf
 import pyscf.lo
 import pyscf.pbc
@@ -16,12 +17,14 @@ from collections import Counter
 def crystal2pyscf_mol(propoutfn="prop.in.o",
     basis='bfd_vtz',
     gs=(8,8,8),
-    basis_order=None):
+    basis_order=None,
+    use_cache=False):
   ''' Make a PySCF object with solution from a crystal run.
 
   Args:
     propoutfn (str): properties or crystal stdout.
     basis (str): PySCF basis option--should match the crystal basis.
+    use_cache (bool): use the binary cache of GRED.DAT and KRED.DAT (see crystal_cache).
   Returns:
     tuple: (mol,scf) PySCF-equilivent Mole and SCF object.
   '''
@@ -30,8 +33,7 @@ def crystal2pyscf_mol(propoutfn="prop.in.o",
   nspin=2
 
   # Load crystal data.
-  info, crylat_parm, cryions, crybasis, crypseudo = read_gred()
-  cryeigsys = read_kred(info,crybasis)
+  info, crylat_parm, cryions, crybasis, crypseudo, cryeigsys = load_crystal(use_cache=use_cache)
 
 
   # Format and input structure.
@@ -62,12 +64,14 @@ def crystal2pyscf_cell(
     cryoutfn="prop.in.o",
     basis='bfd_vtz',
     mesh=None,
-    basis_order=None):
+    basis_order=None,
+    use_cache=False):
   ''' Make a PySCF object with solution from a crystal run.
 
   Args:
     cryoutfn (str): properties or crystal stdout.
     basis (str): PySCF basis option--should match the crystal basis.
+    use_cache (bool): use the binary cache of GRED.DAT and KRED.DAT (see crystal_cache).
   Returns:
     tuple: (cell,scf) PySCF-equilivent Mole and SCF object.
   '''
@@ -75,8 +79,7 @@ def crystal2pyscf_cell(
   #TODO Generalize spin and kpoint.
 
   # Load crystal data.
-  info, crylat_parm, cryions, crybasis, crypseudo = read_gred(gred=gred)
-  cryeigsys = read_kred(info,crybasis,kred=kred)
+  info, crylat_parm, cryions, crybasis, crypseudo, cryeigsys = load_crystal(gred,kred,use_cache=use_cache)
 
   totspin=read_outputfile(cryoutfn)
   ntot=int(round(sum(crybasis['charges'])))
@@ -5,8 +5,11 @@ A casual user would be interested in convert_crystal.
 
 from __future__ import division,print_function
 import numpy as np
+import os
 import sys
+import mmap
 import qwalk_objects as obj
+from qwalk_objects.parallel import worker,map_with_context
 
 def error(message,errortype):
   print(message)
@@ -30,7 +33,9 @@ def convert_crystal(
     base="qwalk",
     propoutfn="prop.in.o",
     realonly=False,
-    nvirtual=50):
+    nvirtual=50,
+    use_cache=False,
+    nproc=1):
   """
   Uses rountines in this library to convert crystal files into qwalk files in one call.
   Files are named by [base]_[kindex].sys etc.
@@ -39,6 +44,8 @@ def convert_crystal(
     propoutfn (str): name of either crystal or properties output file.
     realonly (bool): whether to only the real kpoints.
     nvirtual (int): number of virtual orbtials to include in orbitals section.
+    use_cache (bool): use the binary cache of GRED.DAT and KRED.DAT (see crystal_cache).
+    nproc (int): number of processes converting kpoints in parallel.
   Returns:
     dict: files produced by this call.
   """
@@ -48,8 +55,7 @@ def convert_crystal(
   # keeps track of the files that get produced.
   files={}
 
-  info, lat_parm, ions, basis, pseudo = read_gred()
-  eigsys = read_kred(info,basis)
+  info, lat_parm, ions, basis, pseudo, eigsys = obj.crystal_cache.load_crystal(use_cache=use_cache)
 
   if eigsys['nspin'] > 1:
     eigsys['totspin'] = read_outputfile(propoutfn)
@@ -77,6 +83,7 @@ def convert_crystal(
   write_basis(basis,ions,files['basis'])
   write_jast2(lat_parm,ions,files['jastrow2'])
  
+  tasks=[]
   for kpt in eigsys['kpt_coords']:
     if eigsys['ikpt_iscmpx'][kpt] and realonly: continue
     kidx=eigsys['kpt_index'][kpt]
@@ -85,24 +92,58 @@ def convert_crystal(
     files['slater'][kidx]="%s_%d.slater"%(base,kidx)
     files['orb'][kidx]="%s_%d.orb"%(base,kidx)
     files['sys'][kidx]="%s_%d.sys"%(base,kidx)
-    write_slater(basis,eigsys,kpt,
-        outfn=files['slater'][kidx],
-        orbfn=files['orb'][kidx],
-        basisfn=files['basis'],
-        maxmo_spin=maxmo_spin)
-    write_orbplot(basis,eigsys,kpt,
-        outfn=files['orbplot'][kidx],
-        orbfn=files['orb'][kidx],
-        basisfn=files['basis'],
-        sysfn=files['sys'][kidx],
-        maxmo_spin=maxmo_spin)
-    write_orb(eigsys,basis,ions,kpt,files['orb'][kidx],maxmo_spin)
-    write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,files['sys'][kidx])
+    tasks.append((kpt,{key:files[key][kidx] for key in ['orbplot','slater','orb','sys']}))
+
+  context={'lat_parm':lat_parm,'ions':ions,'basis':basis,'pseudo':pseudo,'basisfn':files['basis'],'maxmo_spin':maxmo_spin}
+  if nproc > 1:
+    map_with_context(_convert_kpoint,tasks,dict(context,eigsys=eigsys),nproc,setup=_open_reader)
+  else:
+    with open_eigvec_reader(eigsys) as reader:
+      for kpt,kfiles in tasks:
+        convert_kpoint(kpt,kfiles,eigsys,reader=reader,**context)
 
   return files
 
 ###############################################################################
-def pack_objects(gred="GRED.DAT",kred="KRED.DAT",spin=0,maxbands=(None,None),realonly=True):
+def convert_kpoint(kpt,kfiles,eigsys,lat_parm,ions,basis,pseudo,basisfn,maxmo_spin,reader=None):
+  ''' Write the slater, orbplot, orb, and sys files for one kpoint (see convert_crystal).
+  Args:
+    kpt (tuple of int): Kpoint coordinates.
+    kfiles (dict): file names to write for 'slater', 'orbplot', 'orb', and 'sys'.
+    basisfn (str): basis file to include.
+    maxmo_spin (int): number of orbitals per spin channel.
+    reader (KredReader): open eigenvector reader.
+    Other arguments are from read_gred and read_kred.
+  '''
+  write_slater(basis,eigsys,kpt,
+      outfn=kfiles['slater'],
+      orbfn=kfiles['orb'],
+      basisfn=basisfn,
+      maxmo_spin=maxmo_spin)
+  write_orbplot(basis,eigsys,kpt,
+      outfn=kfiles['orbplot'],
+      orbfn=kfiles['orb'],
+      basisfn=basisfn,
+      sysfn=kfiles['sys'],
+      maxmo_spin=maxmo_spin)
+  write_orb(eigsys,basis,ions,kpt,kfiles['orb'],maxmo_spin,reader=reader)
+  write_sys(lat_parm,basis,eigsys,pseudo,ions,kpt,kfiles['sys'])
+
+###############################################################################
+# Tasks of the kpoint pools of convert_crystal and pack_objects; each process opens its own eigenvector reader.
+def _open_reader(worker):
+  worker['reader']=open_eigvec_reader(worker['eigsys'])
+
+def _convert_kpoint(task):
+  kpt,kfiles=task
+  convert_kpoint(kpt,kfiles,**worker)
+
+def _lookup_kpoint(task):
+  kpt,maxbands=task
+  return [worker['reader'].lookup(kpt,s,maxbands=maxbands[s]) for s in range(worker['eigsys']['nspin'])]
+
+###############################################################################
+def pack_objects(gred="GRED.DAT",kred="KRED.DAT",spin=0,maxbands=(None,None),realonly=True,use_cache=False,nproc=1,lazy=False,nvirtual=None):
   ''' Create System and Orbitals objects from Crystal results. 
   These objects can generate QWalk input files.
 
@@ -112,13 +153,17 @@ def pack_objects(gred="GRED.DAT",kred="KRED.DAT",spin=0,maxbands=(None,None),rea
     maxbands (tuple): limit on number of orbitals to read in per spin channel.
       defaults to all availabe orbitals == size of basis set.
     realonly (bool): do only the 8 real kpoints.
+    use_cache (bool): use the binary cache of GRED.DAT and KRED.DAT (see crystal_cache).
+    nproc (int): number of processes reading kpoints in parallel.
+    lazy (bool): make LazyOrbitals, which only read the orbitals when they're used.
+    nvirtual (int): number of virtual orbitals to read in per spin channel, beyond the larger spin channel.
+      Overrides maxbands, and matches the orbitals from convert_crystal.
   Returns:
     sys (System): System object.
     orbs (Orbitals): Orbitals object.
   '''
   # This is the pretty much raw data from the Crystal output files.
-  info, lat_parm, ions, basis, pseudo = read_gred(gred)
-  eigsys = read_kred(info,basis,kred)
+  info, lat_parm, ions, basis, pseudo, eigsys = obj.crystal_cache.load_crystal(gred,kred,use_cache=use_cache)
 
   sys=obj.system.System()
 
@@ -133,15 +178,31 @@ def pack_objects(gred="GRED.DAT",kred="KRED.DAT",spin=0,maxbands=(None,None),rea
   basis  =  format_basis(ions,basis)
   sys.find_cutoff_divider(obj.orbitals.find_min_exp(basis))
 
+  if nvirtual is not None:
+    maxbands = (max(sys.nspin)+nvirtual,)*2
 
-  allorbs=[]
 
-  for kidx,kpt in enumerate(eigsys['kpt_coords']):
-    if eigsys['ikpt_iscmpx'][kpt] and realonly: continue
-    orbs=obj.orbitals.Orbitals()
+  kidxs=[kidx for kidx,kpt in enumerate(eigsys['kpt_coords']) if not (eigsys['ikpt_iscmpx'][kpt] and realonly)]
+  tasks=[(eigsys['kpt_coords'][kidx],maxbands) for kidx in kidxs]
+
+  if lazy:
+    alleigvecs=[None for task in tasks]
+  elif nproc > 1:
+    alleigvecs=map_with_context(_lookup_kpoint,tasks,{'eigsys':eigsys},nproc,setup=_open_reader)
+  else:
+    with open_eigvec_reader(eigsys) as reader:
+      alleigvecs=[[reader.lookup(kpt,s,maxbands=maxbands[s]) for s in range(eigsys['nspin'])] for kpt,_ in tasks]
+
+  allorbs=[]
+  for kidx,eigvecs in zip(kidxs,alleigvecs):
+    kpt=eigsys['kpt_coords'][kidx]
+    if lazy:
+      orbs=obj.orbitals.LazyOrbitals(eigsys,kpt,maxbands)
+    else:
+      orbs=obj.orbitals.Orbitals()
+      orbs.eigvecs=eigvecs
     orbs.basis=basis
     orbs.kpoint=(np.array(kpt)/eigsys['nkpts_dir']*2.)
-    orbs.eigvecs=[eigvec_lookup(kpt,eigsys,s,maxbands=maxbands[s]) for s in range(eigsys['nspin'])]
     orbs.eigvals=eigsys['eigvals'][kidx]
     orbs.kweight=eigsys['kpt_weights'][kidx]
     orbs.atom_order=[periodic_table[n%200-1] for n in ions['atom_nums']]
@@ -167,128 +228,94 @@ def read_gred(gred="GRED.DAT"):
   basis = {}
   pseudo = {}
 
-  gred = open(gred,'r').read()
-
-  # Fix numbers with no space between them.
-  gred = gred.replace("-"," -")
-  gred = gred.replace("E -","E-") 
-
-  gred_words = gred.split()
-  nparms = [int(w) for w in gred_words[1:4]]
-  cursor = 4
-
-  # These follow naming of cryapi_inp (but "inf" -> "info").
-  info = [int(w) for w in gred_words[cursor          :cursor+nparms[0]]]
-  itol = [int(w) for w in gred_words[cursor+nparms[0]:cursor+nparms[1]]]
-  par  = [int(w) for w in gred_words[cursor+nparms[1]:cursor+nparms[2]]]
-  cursor += sum(nparms)
+  with GredTokens(gred) as words:
+    words.skip(1)
+    nparms = words.take(3,int).tolist()
+
+    # These follow naming of cryapi_inp (but "inf" -> "info").
+    # itol and par are not needed.
+    info = words.take(nparms[0],int).tolist()
+    words.skip(sum(nparms)-nparms[0])
+
+    lat_parm['struct_dim'] = int(info[9])
+
+    # Lattice parameters.
+    lat_parm['latvecs'] = words.take(9,float).reshape(3,3).T.round(15)
+    if (lat_parm['latvecs'] > 100).any():
+      print("Lattice parameter larger than 100 A! Reducing to 100.")
+      print("If this is a dimension < 3 system, there is no cause for alarm.")
+      print("Otherwise if this is a problem for you, please generalize crystal2qmc.")
+      lat_parm['latvecs'][lat_parm['latvecs']>100] = 100.
+    prim_trans= words.take(9,float).reshape(3,3)
+    lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
+    words.skip(info[1] + 48*48 + 9*info[1] + 3*info[1]) # Skip symmetry part.
+
+    # Lattice "stars" (?) skipped.
+    words.skip(info[4]+1 + info[78]*3 + info[4]+1 + info[4]+1 + info[78] + info[78]*3)
+
+    # Some of ion information.
+    natoms = info[23]
+    ions['charges'] = words.take(natoms,float)
+    # Atom positions.
+    ions['positions'] = words.take(3*natoms,float).reshape(natoms,3)
+
+    # Basis information (some ion information mixed in).
+    nshells = info[19]
+    nprim   = info[74]
+    # Formal charge of shell.
+    basis['charges'] = words.take(nshells,float)
+    # "Adjoined gaussian" of shells.
+    basis['adj_gaus'] = words.take(nshells,float)
+    # Position of shell.
+    basis['positions'] = words.take(3*nshells,float).reshape(nshells,3)
+    # Primitive gaussian exponents.
+    basis['prim_gaus'] = words.take(nprim,float)
+    # Coefficients of s, p, d, and (?).
+    basis['coef_s'] = words.take(nprim,float)
+    basis['coef_p'] = words.take(nprim,float)
+    basis['coef_dfg'] = words.take(nprim,float)
+    basis['coef_max'] = words.take(nprim,float)
+    # Skip "old normalization"
+    words.skip(2*nprim)
+    # Atomic numbers.
+    ions['atom_nums'] = words.take(natoms,int)
+    # First shell of each atom (skip extra number after).
+    basis['first_shell'] = words.take(natoms,int)
+    words.skip(1)
+    # First primitive of each shell (skips an extra number after).
+    basis['first_prim'] = words.take(nshells,int)
+    words.skip(1)
+    # Number of prims per shell.
+    basis['prim_shell'] = words.take(nshells,int)
+    # Type of shell: 0=s,1=sp,2=p,3=d,4=f.
+    basis['shell_type'] = words.take(nshells,int)
+    # Number of atomic orbtials per shell.
+    basis['nao_shell'] = words.take(nshells,int)
+    # First atomic orbtial per shell (skip extra number after).
+    basis['first_ao'] = words.take(nshells,int)
+    words.skip(1)
+    # Atom to which each shell belongs.
+    basis['atom_shell'] = words.take(nshells,int)
+
+    # Pseudopotential information.
+    # Pseudopotential for each element.
+    pseudo_atom = words.take(natoms,int)
+    words.skip(1) # skip INFPOT
+    ngauss = int(words.take(1,int)[0])
+    headlen = int(words.take(1,int)[0])
+    # Number of pseudopotentials.
+    numpseudo = int(words.take(1,int)[0])
+    # Exponents of r^l prefactor.
+    r_exps = -1*words.take(ngauss,int)
+    # Number of Gaussians for angular momenutum j
+    n_per_j = words.take(headlen,int)
+    # index of first n_per_j for each pseudo.
+    pseudo_start = words.take(numpseudo,int)
+    words.skip(1)
+    # Actual floats of pseudopotential.
+    exponents = words.take(ngauss,float)
+    prefactors = words.take(ngauss,float)
 
-  lat_parm['struct_dim'] = int(info[9])
-
-  # Lattice parameters.
-  lat_parm['latvecs'] = \
-      np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3).T.round(15)
-  if (lat_parm['latvecs'] > 100).any():
-    print("Lattice parameter larger than 100 A! Reducing to 100.")
-    print("If this is a dimension < 3 system, there is no cause for alarm.")
-    print("Otherwise if this is a problem for you, please generalize crystal2qmc.")
-    lat_parm['latvecs'][lat_parm['latvecs']>100] = 100.
-  cursor += 9
-  prim_trans= np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3)
-  cursor += 9
-  lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
-  cursor += info[1] + 48*48 + 9*info[1] + 3*info[1] # Skip symmetry part.
-
-  # Lattice "stars" (?) skipped.
-  cursor += info[4]+1 + info[78]*3 + info[4]+1 + info[4]+1 + info[78] + info[78]*3
-
-  # Some of ion information.
-  natoms = info[23]
-  ions['charges'] = np.array(gred_words[cursor:cursor+natoms],dtype=float)
-  cursor += natoms
-  # Atom positions.
-  atom_poss = np.array(gred_words[cursor:cursor+3*natoms],dtype=float)
-  ions['positions'] = atom_poss.reshape(natoms,3)
-  cursor += 3*natoms
-
-  # Basis information (some ion information mixed in).
-  nshells = info[19]
-  nprim   = info[74]
-  # Formal charge of shell.
-  basis['charges'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
-  cursor += nshells
-  # "Adjoined gaussian" of shells.
-  basis['adj_gaus'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
-  cursor += nshells
-  # Position of shell.
-  shell_poss = np.array(gred_words[cursor:cursor+3*nshells],dtype=float)
-  basis['positions'] = shell_poss.reshape(nshells,3)
-  cursor += 3*nshells
-  # Primitive gaussian exponents.
-  basis['prim_gaus'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
-  cursor += nprim
-  # Coefficients of s, p, d, and (?).
-  basis['coef_s'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
-  cursor += nprim
-  basis['coef_p'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
-  cursor += nprim
-  basis['coef_dfg'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
-  cursor += nprim
-  basis['coef_max'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
-  cursor += nprim
-  # Skip "old normalization"
-  cursor += 2*nprim
-  # Atomic numbers.
-  ions['atom_nums'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
-  cursor += natoms
-  # First shell of each atom (skip extra number after).
-  basis['first_shell'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
-  cursor += natoms + 1
-  # First primitive of each shell (skips an extra number after).
-  basis['first_prim'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
-  cursor += nshells + 1
-  # Number of prims per shell.
-  basis['prim_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
-  cursor += nshells
-  # Type of shell: 0=s,1=sp,2=p,3=d,4=f.
-  basis['shell_type'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
-  cursor += nshells
-  # Number of atomic orbtials per shell.
-  basis['nao_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
-  cursor += nshells
-  # First atomic orbtial per shell (skip extra number after).
-  basis['first_ao'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
-  cursor += nshells + 1
-  # Atom to which each shell belongs.
-  basis['atom_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
-  cursor += nshells
-
-  # Pseudopotential information.
-  # Pseudopotential for each element.
-  pseudo_atom = np.array(gred_words[cursor:cursor+natoms],dtype=int)
-  cursor += natoms
-  cursor += 1 # skip INFPOT
-  ngauss = int(gred_words[cursor])
-  cursor += 1
-  headlen = int(gred_words[cursor])
-  cursor += 1
-  # Number of pseudopotentials.
-  numpseudo = int(gred_words[cursor])
-  cursor += 1
-  # Exponents of r^l prefactor.
-  r_exps = -1*np.array(gred_words[cursor:cursor+ngauss],dtype=int)
-  cursor += ngauss
-  # Number of Gaussians for angular momenutum j
-  n_per_j = np.array(gred_words[cursor:cursor+headlen],dtype=int)
-  cursor += headlen
-  # index of first n_per_j for each pseudo.
-  pseudo_start = np.array(gred_words[cursor:cursor+numpseudo],dtype=int)
-  cursor += numpseudo + 1
-  # Actual floats of pseudopotential.
-  exponents = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
-  cursor += ngauss
-  prefactors = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
-  cursor += ngauss
   # Store information nicely.
   npjlen = int(headlen / len(pseudo_start))
   for aidx,atom in enumerate(ions['atom_nums']):
@@ -305,15 +332,83 @@ def read_gred(gred="GRED.DAT"):
 
   ## Density matrix information.
   # This is impossible to figure out.  See `cryapi_inp.f`.
-  #atomic_charges = np.array(gred_words[cursor:cursor+natoms],dtype=float)
-  #cursor += natoms
+  #atomic_charges = words.take(natoms,float)
   #mvlaf = info[55] #???
   ## Skip symmetry information.
-  #cursor += mvlaf*4 + info[19]*info[1] + 
+  #words.skip(mvlaf*4 + info[19]*info[1] + ...)
   #print("atomic_charges",atomic_charges)
 
   return info, lat_parm, ions, basis, pseudo
 
+###############################################################################
+class GredTokens:
+  ''' Cursor over the words of GRED.DAT that reads the file a chunk at a time.
+  Fortran glues negative numbers onto the previous one (1.0-2.0), so a space is put in front of every minus
+  sign that isn't part of an exponent as each chunk is read.
+  Words are only converted to numbers when they are taken, and skipped words are never converted.
+
+  Args:
+    gred (str): path to GRED.DAT file.
+    chunksize (int): bytes to read at a time.
+  '''
+  def __init__(self,gred,chunksize=2**22):
+    self._file=open(gred,'rb')
+    self.chunksize=chunksize
+    self._words=[]  # Words read but not yet used.
+    self._pos=0     # Cursor in self._words.
+    self._partial=b'' # Possibly incomplete word at the end of the last chunk.
+
+  def close(self):
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*args):
+    self.close()
+
+  #----------------------------------------------------------------------------
+  def _fill(self,n):
+    ''' Read until at least n unused words are available (or the file ends). '''
+    if self._pos > 0:
+      del self._words[:self._pos]
+      self._pos=0
+    while len(self._words) < n:
+      chunk=self._file.read(self.chunksize)
+      if chunk==b'':
+        if self._partial!=b'':
+          self._words+=self._split(self._partial)
+          self._partial=b''
+        break
+      chunk=self._partial+chunk
+      # Cut at whitespace so no word is split between chunks.
+      cut=max(chunk.rfind(b' '),chunk.rfind(b'\n'))+1
+      self._partial=chunk[cut:]
+      self._words+=self._split(chunk[:cut])
+
+  @staticmethod
+  def _split(text):
+    return text.replace(b"-",b" -").replace(b"E -",b"E-").split()
+
+  #----------------------------------------------------------------------------
+  def take(self,n,dtype=float):
+    ''' Convert the next n words into an array of dtype. '''
+    if self._pos+n > len(self._words):
+      self._fill(n)
+    words=self._words[self._pos:self._pos+n]
+    self._pos+=n
+    return np.array(words,dtype=dtype)
+
+  #----------------------------------------------------------------------------
+  def skip(self,n):
+    ''' Move the cursor past the next n words without converting them. '''
+    while self._pos+n > len(self._words):
+      n-=len(self._words)-self._pos
+      self._pos=len(self._words)
+      self._fill(1)
+      if len(self._words)==0: return
+    self._pos+=n
+
 ###############################################################################
 def read_kred(info,basis,kred="KRED.DAT"):
   ''' Read the KRED and provide information about the CRYSTAL solutions. 
@@ -448,15 +543,12 @@ def format_pseudo(oldps,oldions):
 
 ###############################################################################
 def format_positions(ions):
-  ''' Rearrage the pseudopotential data for structure object.'''
-  positions=[]
-  for num,pos in zip(ions['atom_nums'],ions['positions']):
-    species=periodic_table[num%200-1]
-    positions.append({
-        'species':species,
-        'xyz':pos
-      })
-  return positions
+  ''' Ion positions for the System object.
+  Returns:
+    Positions: species and Cartesian positions of the ions.
+  '''
+  species=np.array(periodic_table)[np.asarray(ions['atom_nums'])%200-1]
+  return obj.system.Positions(species,xyz=ions['positions'])
 
 ###############################################################################
 def format_basis(ions,basis):
@@ -501,8 +593,7 @@ def format_basis(ions,basis):
 
 ###############################################################################
 # Look up an eigenvector from KRED.DAT.
-# TODO: Further reduction in memory usage can be had by specifying nvirtual here.
-def eigvec_lookup(kpt,eigsys,spin=0,maxbands=None):
+def eigvec_lookup(kpt,eigsys,spin=0,maxbands=None,reader=None):
   ''' Look up eigenvector at kpt from KRED.DAT using information from eigsys about where the eigenvectors start and end.  
   Args:
     kpt (tuple of int): Kpoint coordinates.
@@ -510,33 +601,158 @@ def eigvec_lookup(kpt,eigsys,spin=0,maxbands=None):
     iscomplex (bool): Is the kpoint complex.
     spin (int): desired spin component. 
     maxbands (int): highest band to read in. Default is to read in all bands.
+      Only these bands are parsed, so this saves time and memory.
+    reader (KredReader): already opened reader to use. Default opens KRED.DAT just for this lookup.
   Returns:
     array: eigenstate indexed by [band, ao]
   '''
-  if maxbands is not None:
-    nband=min((eigsys['nbands'],maxbands))
-  else:
-    nband=eigsys['nbands']
+  if reader is not None:
+    return reader.lookup(kpt,spin,maxbands)
+  with open_eigvec_reader(eigsys) as reader:
+    return reader.lookup(kpt,spin,maxbands)
 
-  ncpnts = int(nband* eigsys['nao'])
-  if eigsys['ikpt_iscmpx'][kpt]:
-    ncpnts *= 2
-  linesperkpt = ncpnts//4 + int(ncpnts%4>0)
+###############################################################################
+def open_eigvec_reader(eigsys):
+  ''' Open a reader for the eigenvectors: from the binary cache if eigsys came from it, otherwise from KRED.DAT.
+  Args:
+    eigsys (dict): data from read_kred or crystal_cache.load_crystal.
+  Returns:
+    KredReader or CacheReader: object with lookup(kpt,spin,maxbands).
+  '''
+  if eigsys.get('cache') is not None and os.path.exists(eigsys['cache']):
+    return obj.crystal_cache.CacheReader(eigsys)
+  return KredReader(eigsys)
+
+###############################################################################
+# Powers of ten that are exact doubles.
+_pow10=np.array([10.0**k for k in range(23)])
 
-  kredf = open(eigsys['kred'],'r')
-  kredf.seek(eigsys['kpt_file_start'][kpt][spin])
-  eigvec=[]
-  for li,line in enumerate(kredf):
-    if li==linesperkpt: break
-    eigvec+=line.split()
+def parse_efields(fields,minfields=256):
+  ''' Numbers in Fortran E format with 13 decimals (like 4E21.13), from their digits instead of as text.
+  The 14 digits are an exact integer and 10**k is exact for k<=22, so one multiply or divide rounds the same
+  as float() would. Fields without that layout, or with exponents outside it, are converted as text.
+  Args:
+    fields (array): [n,width] uint8 characters of each number, right-aligned.
+    minfields (int): fewer fields than this are just converted as text.
+  Returns:
+    array: n floats.
+  '''
+  text=lambda rows: np.ascontiguousarray(rows).view('S%d'%fields.shape[1]).astype(float).ravel()
+  if fields.shape[0]<minfields or fields.shape[1]<20:
+    return text(fields)
+  zero,decimals=np.uint8(ord('0')),fields[:,-17:-4]
+  mant=fields[:,-19]*1e13+decimals@_pow10[12::-1]-ord('0')*_pow10[:14].sum()
+  exponent=(fields[:,-2]-zero).astype(int)*10+(fields[:,-1]-zero)
+  scale=np.where(fields[:,-3]==ord('-'),-exponent,exponent)-13
+  ok=(fields[:,-4]==ord('E'))&(fields[:,-18]==ord('.'))&(abs(scale)<=22)
+  ok&=((fields[:,-3]==ord('+'))|(fields[:,-3]==ord('-')))&((fields[:,-20]==ord(' '))|(fields[:,-20]==ord('-')))
+  ok&=((decimals-zero)<=9).all(axis=1)&(fields[:,-19]-zero<=9)&(fields[:,-2]-zero<=9)&(fields[:,-1]-zero<=9)
+  ok&=(fields[:,:-20]==ord(' ')).all(axis=1)
+  scale=np.where(ok,scale,0)
+  vals=np.where(scale>=0,mant*_pow10[np.clip(scale,0,22)],mant/_pow10[np.clip(-scale,0,22)])
+  vals[fields[:,-20]==ord('-')]*=-1
+  if not ok.all():
+    vals[~ok]=text(fields[~ok])
+  return vals
 
-  eigvec = np.array(eigvec[:ncpnts],dtype=float)
+###############################################################################
+class KredReader:
+  ''' Memory-mapped access to the eigenvectors in KRED.DAT.
 
-  if eigsys['ikpt_iscmpx'][kpt]:
-    eigvec=eigvec.reshape(ncpnts//2,2)
-    eigvec=eigvec[:,0] + eigvec[:,1]*1j # complexify.
+  The file is mapped once, and the offsets recorded by read_kred are used to parse each k-point and spin
+  block directly into a numpy buffer. Crystal writes the eigenvectors in fixed-width columns (4E21.13), so the
+  numbers are sliced out by column instead of split on whitespace.
+  Blocks that don't have the fixed-width layout fall back to splitting on whitespace.
 
-  return eigvec.reshape(nband,eigsys['nao'])
+  Args:
+    eigsys (dict): data from read_kred.
+  '''
+  width=21 # Characters per number.
+  npl=4 # Numbers per line.
+
+  def __init__(self,eigsys):
+    self.eigsys=eigsys
+    self._file=open(eigsys['kred'],'rb')
+    self._map=mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ)
+
+  #----------------------------------------------------------------------------
+  def close(self):
+    self._map.close()
+    self._file.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*args):
+    self.close()
+
+  #----------------------------------------------------------------------------
+  def lookup(self,kpt,spin=0,maxbands=None,out=None):
+    ''' Look up eigenvector at kpt.
+    Args:
+      kpt (tuple of int): Kpoint coordinates.
+      spin (int): desired spin component. 
+      maxbands (int): highest band to read in. Default is to read in all bands.
+      out (array): buffer of nband*nao elements to parse into, of complex type for complex kpoints.
+        Default allocates a new one.
+    Returns:
+      array: eigenstate indexed by [band, ao]
+    '''
+    eigsys=self.eigsys
+    if maxbands is not None:
+      nband=min((eigsys['nbands'],maxbands))
+    else:
+      nband=eigsys['nbands']
+    dtype=(float,complex)[bool(eigsys['ikpt_iscmpx'][kpt])]
+
+    if out is None:
+      out=np.empty(nband*eigsys['nao'],dtype=dtype)
+    assert out.dtype==dtype and out.size==nband*eigsys['nao'],\
+        "Buffer doesn't match the size or type of the eigenvector."
+
+    # Complex numbers are stored as (real,imag) pairs, same as the file.
+    self._parse(eigsys['kpt_file_start'][kpt][spin],out.reshape(-1).view(float))
+
+    return out.reshape(nband,eigsys['nao'])
+
+  #----------------------------------------------------------------------------
+  def _parse(self,start,flat):
+    ''' Parse flat.size numbers starting at byte start into flat. '''
+    ncpnts=flat.size
+    width,npl=self.width,self.npl
+    linelen=width*npl+1
+    nfull=ncpnts//npl
+    rem=ncpnts%npl
+    end=start+nfull*linelen+rem*width
+    if end>len(self._map) or (rem>0 and end<len(self._map) and self._map[end:end+1]!=b'\n'):
+      return self._parse_words(start,flat)
+
+    lines=np.frombuffer(self._map,dtype=np.uint8,count=nfull*linelen,offset=start).reshape(nfull,linelen)
+    if (lines[:,-1]!=ord('\n')).any():
+      del lines
+      return self._parse_words(start,flat)
+    fields=np.ascontiguousarray(lines[:,:-1]).reshape(-1,width)
+    del lines # Release the view of the map.
+    flat[:nfull*npl]=parse_efields(fields)
+    if rem>0:
+      tail=start+nfull*linelen
+      flat[nfull*npl:]=[float(self._map[tail+i*width:tail+(i+1)*width]) for i in range(rem)]
+    return flat
+
+  #----------------------------------------------------------------------------
+  def _parse_words(self,start,flat):
+    ''' Slower parser for blocks that aren't in fixed-width columns. '''
+    ncpnts=flat.size
+    words=[]
+    pos=start
+    while len(words)<ncpnts:
+      end=self._map.find(b'\n',pos)
+      if end<0: end=len(self._map)
+      words+=self._map[pos:end].split()
+      if end==len(self._map): break
+      pos=end+1
+    flat[:]=np.array(words[:ncpnts],dtype=float)
+    return flat
 
 ###############################################################################
 def read_outputfile(fname = "prop.in.o"):
@@ -655,44 +871,25 @@ def write_orbplot(basis,eigsys,kpt,outfn,orbfn,basisfn,sysfn,maxmo_spin=-1):
     outf.write("\n".join(outlines_prefix+ [" ".join(dnorblines)] + outlines_postfix))
       
 ###############################################################################
-def write_orb(eigsys,basis,ions,kpt,outfn,maxmo_spin=-1):
-  outf=open(outfn,'w')
+def write_orb(eigsys,basis,ions,kpt,outfn,maxmo_spin=-1,reader=None):
   if maxmo_spin < 0:
     maxmo_spin=basis['nmo']
 
   fbasis = format_basis(ions,basis)
   atom_order=[periodic_table[n%200-1] for n in ions['atom_nums']]
 
-  eigvecs=[normalize_eigvec(eigvec_lookup(kpt,eigsys,spin),fbasis,atom_order) for spin in range(eigsys['nspin'])]
+  # Only read and normalize the bands that are written.
+  eigvecs=[normalize_eigvec(eigvec_lookup(kpt,eigsys,spin,maxbands=maxmo_spin,reader=reader),fbasis,atom_order)
+      for spin in range(eigsys['nspin'])]
   atidxs = np.unique(basis['atom_shell'])-1
   nao_atom = np.zeros(atidxs.size,dtype=int)
   for shidx in range(len(basis['nao_shell'])):
     nao_atom[basis['atom_shell'][shidx]-1] += basis['nao_shell'][shidx]
   #nao_atom = int(round(sum(basis['nao_shell']) / len(ions['positions'])))
-  coef_cnt = 1
   totnmo = maxmo_spin*eigsys['nspin'] #basis['nmo'] * eigsys['nspin']
-  for moidx in np.arange(totnmo)+1:
-    for atidx in atidxs+1:
-      for aoidx in np.arange(nao_atom[atidx-1])+1:
-        outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
-            .format(moidx,aoidx,atidx,coef_cnt))
-        coef_cnt += 1
-  eigvec_flat = [e[0:maxmo_spin].ravel() for e in eigvecs]
-  print_cnt = 0
-  outf.write("COEFFICIENTS\n")
-  if eigsys['ikpt_iscmpx'][kpt]: #complex coefficients
-    for eigv in eigvec_flat: #zip(eigreal_flat,eigimag_flat):
-      for r,i in zip(eigv.real,eigv.imag):
-        outf.write("({:<.12e},{:<.12e}) "\
-            .format(r,i))
-        print_cnt+=1
-        if print_cnt%5==0: outf.write("\n")
-  else: #Real coefficients
-    for eigr in eigvec_flat:
-      for r in eigr:
-        outf.write("{:< 15.12e} ".format(r))
-        print_cnt+=1
-        if print_cnt%5==0: outf.write("\n")
+  with open(outfn,'w') as outf:
+    obj.orbitals.write_orbfile(outf,nao_atom[atidxs],eigvecs,
+        iscomplex=eigsys['ikpt_iscmpx'][kpt],nmo=totnmo)
 
 ###############################################################################
 # TODO Generalize to no pseudopotential.
@@ -914,25 +1111,19 @@ def write_moanalysis():
 ###############################################################################
 # f orbital normalizations are from 
 # <http://winter.group.shef.ac.uk/orbitron/AOs/4f/equations.html>
-def normalize_eigvec(eigvec,basis,atom_order):
-  ''' Changes crystal normalization to qwalk normalization.
-  eigvec will also be changed in place (i.e. does not copy).
-  Args:
-    eigvec (array): eigenvectors indexed by vector then AO.
-    basis (dict): basis information. 
-  Returns:
-    array: normalized view of eigvec.
-  '''
-  snorm = 1./(4.*np.pi)**0.5
-  pnorm = snorm*(3.)**.5
-  dnorms = [
+_snorm = 1./(4.*np.pi)**0.5
+_pnorm = _snorm*(3.)**.5
+_angular_norms = {
+    'S':[_snorm],
+    'P':[_pnorm]*3,
+    '5D':[
       .5*(5./(4*np.pi))**.5,
       (15./(4*np.pi))**.5,
       (15./(4*np.pi))**.5,
       .5*(15./(4.*np.pi))**.5,
       (15./(4*np.pi))**.5
-    ]
-  fnorms = [
+    ],
+    '7F_crystal':[
       ( 7./(16.*np.pi))**.5,
       (21./(32.*np.pi))**.5,
       (21./(32.*np.pi))**.5,
@@ -940,31 +1131,44 @@ def normalize_eigvec(eigvec,basis,atom_order):
       (105./(4.*np.pi))**.5,
       (35./(32.*np.pi))**.5,
       (35./(32.*np.pi))**.5
-    ]
-
-  # Find order of angular momentum channels.
-  angular_order = []
-  for species in atom_order:
-    for element in basis[species]:
-      angular_order.append(element['angular'])
-
-  # This is to align properly with the d-components of eigvecs.
-  dnorms *= angular_order.count('5D')
-  fnorms *= angular_order.count('7F_crystal')
-
-  # Duplicate according to number of Lz states to get AO labels for eigvecs.
-  nangular = {'S':1,'P':3,'5D':5,'7F_crystal':7,'G':9,'H':11}
-  ao_type=[]
-  for btype in angular_order:
-    ao_type+=nangular[btype]*[btype]
-
-  ao_type=np.array(ao_type)
+    ],
+    # No change for these.
+    'G':[1.0]*9,
+    'H':[1.0]*11
+  }
+_ao_normalization_cache = {}
 
-  eigvec[:,ao_type=='S'] *= snorm
-  eigvec[:,ao_type=='P'] *= pnorm
-  eigvec[:,ao_type=='5D'] *= dnorms
-  eigvec[:,ao_type=='7F_crystal'] *= fnorms
+###############################################################################
+def ao_normalization(basis,atom_order):
+  ''' Factors that change crystal normalization to qwalk normalization for each AO.
+  These only depend on the angular momentum of each shell, so they are cached for each basis and atom order.
+  Args:
+    basis (dict): basis information, as in Orbitals. 
+    atom_order (list): species of each atom.
+  Returns:
+    array: factor for each AO (read-only).
+  '''
+  species_shells = tuple((species,tuple([element['angular'] for element in basis[species]])) for species in sorted(basis))
+  key = (tuple(atom_order),species_shells)
+  if key not in _ao_normalization_cache:
+    species_norm = {species:np.concatenate([_angular_norms[angular] for angular in shells]) for species,shells in species_shells}
+    norm = np.concatenate([species_norm[species] for species in atom_order])
+    norm.setflags(write=False)
+    if len(_ao_normalization_cache) > 32: _ao_normalization_cache.clear()
+    _ao_normalization_cache[key] = norm
+  return _ao_normalization_cache[key]
 
+###############################################################################
+def normalize_eigvec(eigvec,basis,atom_order):
+  ''' Changes crystal normalization to qwalk normalization.
+  eigvec will also be changed in place (i.e. does not copy).
+  Args:
+    eigvec (array): eigenvectors indexed by vector then AO.
+    basis (dict): basis information. 
+  Returns:
+    array: normalized view of eigvec.
+  '''
+  eigvec *= ao_normalization(basis,atom_order)
   return eigvec
 
 if __name__ == "__main__":
@@ -978,6 +1182,8 @@ if __name__ == "__main__":
       help="[=False] Convert only real kpoints.")
   parser.add_argument('-v','--nvirtual',type=int,default=50,
       help="[=50] Number of unoccupied or virtual orbitals to allow access to.")
+  parser.add_argument('-n','--nproc',type=int,default=1,
+      help="[=1] Number of processes converting kpoints in parallel.")
   args=parser.parse_args()
 
-  convert_crystal(args.base,args.propout,args.kset,args.nvirtual)
+  convert_crystal(args.base,args.propout,args.real,args.nvirtual,nproc=args.nproc)
@@ -0,0 +1,210 @@
+'''
+On-disk cache of parsed GRED.DAT and KRED.DAT data.
+Parsing the Crystal text files is slow for large systems, so the results of read_gred and read_kred
+(including the eigenvectors) are stored in an npz file keyed by the content of the two files.
+Each entry is a full copy of the eigenvectors, so the cache is only used when asked for (use_cache=True).
+A casual user would be interested in load_crystal.
+'''
+
+from __future__ import division,print_function
+import os
+import json
+import pickle
+import hashlib
+import zipfile
+import numpy as np
+from qwalk_objects.crystal2qmc import read_gred, read_kred, KredReader
+
+default_cache_dir=os.path.join(os.path.expanduser('~'),'.cache','qwalk_objects')
+default_max_bytes=10*2**30
+INDEX='index.json'
+
+###############################################################################
+def load_crystal(gred="GRED.DAT",kred="KRED.DAT",use_cache=False,cache_dir=None,max_bytes=default_max_bytes):
+  ''' Read GRED.DAT and KRED.DAT, optionally using the cache if the files were read before.
+
+  Args:
+    gred (str): path to GRED.DAT.
+    kred (str): path to KRED.DAT.
+    use_cache (bool): read from the cache, adding the files to it if they aren't there yet.
+      Otherwise the files are parsed directly and nothing is written.
+    cache_dir (str): directory of the cache. Default is ~/.cache/qwalk_objects.
+    max_bytes (int): size limit of the cache. Least recently used entries are removed to stay under it.
+  Returns:
+    tuple: (info,lat_parm,ions,basis,pseudo,eigsys) as from read_gred and read_kred.
+      If the cache was used, eigsys['cache'] is the path to the cached eigenvectors.
+  '''
+  if not use_cache:
+    info, lat_parm, ions, basis, pseudo = read_gred(gred)
+    eigsys = read_kred(info,basis,kred)
+    return info, lat_parm, ions, basis, pseudo, eigsys
+
+  if cache_dir is None: cache_dir=default_cache_dir
+  if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+
+  key=cache_key(gred,kred,cache_dir)
+  entry=os.path.join(cache_dir,key+'.npz')
+
+  if os.path.exists(entry):
+    try:
+      info, lat_parm, ions, basis, pseudo, eigsys = _read_entry(entry)
+      os.utime(entry,None) # Mark as recently used.
+      eigsys['kred']=kred
+      return info, lat_parm, ions, basis, pseudo, eigsys
+    except Exception as err:
+      print("Cache entry {} is unreadable ({}), rereading files.".format(entry,err))
+      os.remove(entry)
+
+  info, lat_parm, ions, basis, pseudo = read_gred(gred)
+  eigsys = read_kred(info,basis,kred)
+  _write_entry(entry,info,lat_parm,ions,basis,pseudo,eigsys)
+  evict(cache_dir,max_bytes)
+
+  eigsys['cache']=entry
+  return info, lat_parm, ions, basis, pseudo, eigsys
+
+###############################################################################
+def cache_key(gred,kred,cache_dir):
+  ''' Content hash of GRED.DAT and KRED.DAT.
+  The hash is remembered along with the size and modification time of the files, so unchanged files aren't rehashed.
+  Args:
+    gred (str): path to GRED.DAT.
+    kred (str): path to KRED.DAT.
+    cache_dir (str): directory of the cache.
+  Returns:
+    str: key of the cache entry.
+  '''
+  stats=[[os.path.abspath(fn),os.stat(fn).st_size,os.stat(fn).st_mtime_ns] for fn in (gred,kred)]
+  statkey=json.dumps(stats)
+
+  index=_read_index(cache_dir)
+  if statkey in index:
+    return index[statkey]
+
+  digest=hashlib.sha1()
+  for fn in (gred,kred):
+    with open(fn,'rb') as f:
+      for chunk in iter(lambda: f.read(2**24),b''):
+        digest.update(chunk)
+  key=digest.hexdigest()
+
+  # Forget old hashes of these files, since they've changed.
+  paths=[s[0] for s in stats]
+  index={k:v for k,v in index.items() if [s[0] for s in json.loads(k)]!=paths}
+  index[statkey]=key
+  _write_index(cache_dir,index)
+  return key
+
+###############################################################################
+def evict(cache_dir=None,max_bytes=default_max_bytes):
+  ''' Remove least recently used entries until the cache is smaller than max_bytes.
+  Args:
+    cache_dir (str): directory of the cache.
+    max_bytes (int): size limit of the cache.
+  Returns:
+    list: removed entries.
+  '''
+  if cache_dir is None: cache_dir=default_cache_dir
+  entries=[os.path.join(cache_dir,fn) for fn in os.listdir(cache_dir) if fn.endswith('.npz')]
+  entries=sorted(entries,key=lambda fn: os.stat(fn).st_mtime)
+  total=sum([os.path.getsize(fn) for fn in entries])
+  removed=[]
+  for fn in entries:
+    if total <= max_bytes: break
+    total-=os.path.getsize(fn)
+    os.remove(fn)
+    removed.append(fn)
+  return removed
+
+###############################################################################
+def clear_cache(cache_dir=None):
+  ''' Remove all entries and the index from the cache.'''
+  if cache_dir is None: cache_dir=default_cache_dir
+  if not os.path.isdir(cache_dir): return
+  for fn in os.listdir(cache_dir):
+    if fn.endswith('.npz') or fn==INDEX:
+      os.remove(os.path.join(cache_dir,fn))
+
+###############################################################################
+class CacheReader:
+  ''' Eigenvector lookup from a cache entry, with the same interface as KredReader.
+  Each eigenvector is only loaded from the entry when it is looked up.
+
+  Args:
+    eigsys (dict): data from load_crystal.
+  '''
+  def __init__(self,eigsys):
+    self.eigsys=eigsys
+    self._npz=np.load(eigsys['cache'])
+
+  def close(self):
+    self._npz.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*args):
+    self.close()
+
+  def lookup(self,kpt,spin=0,maxbands=None,out=None):
+    ''' Look up eigenvector at kpt. Arguments are the same as KredReader.lookup.
+    Only the first maxbands bands are read from the entry.
+    '''
+    with self._npz.zip.open(eigvec_name(self.eigsys['kpt_index'][kpt],spin)+'.npy') as f:
+      version=np.lib.format.read_magic(f)
+      if version==(1,0): shape,fortran,dtype=np.lib.format.read_array_header_1_0(f)
+      else:              shape,fortran,dtype=np.lib.format.read_array_header_2_0(f)
+      assert not fortran, "Cache entries should be stored in C order."
+      nband=shape[0] if maxbands is None else min(shape[0],maxbands)
+      if out is None:
+        out=np.empty(nband*shape[1],dtype=dtype)
+      out=out.reshape(nband,shape[1])
+      out[:]=np.frombuffer(f.read(out.nbytes),dtype=dtype).reshape(out.shape)
+    return out
+
+###############################################################################
+def eigvec_name(kidx,spin):
+  return 'eigvec_%d_%d'%(kidx,spin)
+
+###############################################################################
+def _write_entry(entry,info,lat_parm,ions,basis,pseudo,eigsys):
+  ''' Store the parsed data in entry. Eigenvectors are stored as separate arrays so they can be loaded one at a time.
+  They're also written one at a time (in the npz layout), so only one eigenvector is in memory.'''
+  meta=(info,lat_parm,ions,basis,pseudo,eigsys)
+
+  # Write then move, so other processes never see a partial entry.
+  tmpfn='%s.%d.tmp'%(entry,os.getpid())
+  with zipfile.ZipFile(tmpfn,'w',compression=zipfile.ZIP_STORED,allowZip64=True) as npz:
+    with KredReader(eigsys) as reader:
+      for kpt,kidx in eigsys['kpt_index'].items():
+        for spin in range(eigsys['nspin']):
+          _write_array(npz,eigvec_name(kidx,spin),reader.lookup(kpt,spin))
+    _write_array(npz,'meta',np.frombuffer(pickle.dumps(meta,protocol=pickle.HIGHEST_PROTOCOL),dtype=np.uint8))
+  os.replace(tmpfn,entry)
+
+def _write_array(npz,name,array):
+  with npz.open(name+'.npy','w',force_zip64=True) as f:
+    np.lib.format.write_array(f,np.ascontiguousarray(array),allow_pickle=False)
+
+###############################################################################
+def _read_entry(entry):
+  with np.load(entry) as npz:
+    info, lat_parm, ions, basis, pseudo, eigsys = pickle.loads(npz['meta'].tobytes())
+  eigsys['cache']=entry
+  return info, lat_parm, ions, basis, pseudo, eigsys
+
+###############################################################################
+def _read_index(cache_dir):
+  try:
+    with open(os.path.join(cache_dir,INDEX),'r') as f:
+      return json.load(f)
+  except (IOError,ValueError):
+    return {}
+
+###############################################################################
+def _write_index(cache_dir,index):
+  indexfn=os.path.join(cache_dir,INDEX)
+  tmpfn='%s.%d.tmp'%(indexfn,os.getpid())
+  with open(tmpfn,'w') as f:
+    json.dump(index,f)
+  os.replace(tmpfn,indexfn)
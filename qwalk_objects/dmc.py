@@ -1,5 +1,6 @@
 from __future__ import print_function
 from qwalk_objects.trialfunc import export_qwalk_trialfunc
+from qwalk_objects import qwalk_log
 import os
 ####################################################
 class DMCWriter:
@@ -58,7 +59,6 @@ class DMCWriter:
     self.completed=True
      
 ####################################################
-import subprocess as sub
 import json
 class DMCReader:
   ''' Reads results from a DMC calculation. 
@@ -66,27 +66,59 @@ class DMCReader:
   Attributes:
     output (dict): results of calculation. 
     completed (bool): whether the run has converged to a final answer.
+    native (bool): read the log in Python instead of calling gosling (see qwalk_log).
+    warmup (int): number of blocks to discard when reading the log natively, or 'auto' to detect it.
   '''
-  def __init__(self,errtol=0.01,minblocks=15):
+  def __init__(self,errtol=0.01,minblocks=15,native=False,warmup='auto'):
     self.output={}
     self.completed=False
 
     self.errtol=errtol
     self.minblocks=minblocks
     self.gosling="gosling"
+    self.native=native
+    self.warmup=warmup
+    self._tails={}
 
   def read_outputfile(self,outfile):
     ''' Read output file results.
+    Blocks read by earlier calls are remembered, so only new blocks of the log are parsed.
 
     Args:
       outfile (str): output to read.
     '''
+    logfn = outfile.replace('.o','.log')
+    if logfn not in self._tails:
+      self._tails[logfn] = qwalk_log.LogTail(logfn)
     try: 
-      res = json.loads(sub.check_output([self.gosling,"-json",outfile.replace('.o','.log')]).decode())
+      res = qwalk_log.collect_log(logfn,self.gosling,self.native,self._tails[logfn],warmup=self.warmup)
     except json.decoder.JSONDecodeError:
       res = {}
     return res
 
+  def read_outputfiles(self,outfiles):
+    ''' Read results of many output files in one call.
+
+    Args:
+      outfiles (list): outputs to read.
+    Returns:
+      list: results for each output; {} for outputs that couldn't be read.
+    '''
+    return qwalk_log.read_logs([outfile.replace('.o','.log') for outfile in outfiles],
+        self.gosling,self.native,warmup=self.warmup)
+
+  def seconds_per_block(self):
+    ''' Measured time per block of the collected run, from when its blocks were written to the log. None if unknown.'''
+    if 'file' not in self.output: return None
+    tail=self._tails.get(self.output['file'].replace('.o','.log'))
+    return tail.seconds_per_block() if tail is not None else None
+
+  def energy_error(self):
+    ''' Error of the total energy, from reblocking if the log was read natively (more reliable with correlated blocks).'''
+    if 'reblock' in self.output:
+      return self.output['reblock']['error']
+    return self.output['properties']['total_energy']['error'][0]
+
   def check_complete(self):
     ''' Check if a DMC run is complete.
     Returns:
@@ -95,9 +127,9 @@ class DMCReader:
     completed=True
     if 'properties' not in self.output:
       return False # No results yet.
-    if self.output['properties']['total_energy']['error'][0] > self.errtol:
+    if self.energy_error() > self.errtol:
       print("DMC incomplete: (%f) does not meet tolerance (%f)"%\
-          (self.output['properties']['total_energy']['error'][0],self.errtol))
+          (self.energy_error(),self.errtol))
       completed=False
     if self.output['total blocks']-self.output['warmup blocks'] < self.minblocks:
       print("DMC incomplete: Run completed %d blocks, but requires %d."%\
@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+from qwalk_objects.qwalk_log import FileTail
 ####################################################
 class LinearWriter:
   def __init__(self,sys,trialfunc,trialfunc_options=None,total_nstep=2048*8,total_fit=2048):
@@ -60,17 +61,25 @@ class LinearReader:
     self.completed=False
     self.sigtol=sigtol
     self.minsteps=minsteps
+    self._tail=None
+    self._trace=([],[])
 
   #------------------------------------------------
   def read_outputfile(self,outfile):
+    ''' Read output file into dict. Only the part of outfile added since the last read is parsed.'''
+    if self._tail is None or self._tail.fn!=outfile:
+      self._tail=FileTail(outfile)
+      self._trace=([],[])
+    text,restarted=self._tail.read()
+    if restarted:
+      self._trace=([],[])
+    for line in text.splitlines():
+      if 'current energy' in line:
+        self._trace[0].append(float(line.split()[4]))
+        self._trace[1].append(float(line.split()[6]))
     ret={}
-    ret['energy_trace']=[]
-    ret['energy_trace_err']=[]
-    with open(outfile) as f:
-      for line in f:
-        if 'current energy' in line:
-          ret['energy_trace'].append(float(line.split()[4]))
-          ret['energy_trace_err'].append(float(line.split()[6]))
+    ret['energy_trace']=list(self._trace[0])
+    ret['energy_trace_err']=list(self._trace[1])
     if len(ret['energy_trace']) > 0:
       ret['total_energy']=ret['energy_trace'][-1]
       ret['total_energy_err']=ret['energy_trace_err'][-1]
@@ -1,3 +1,4 @@
+import numpy as np
 from numpy import array
 import qwalk_objects as obj
 
@@ -14,7 +15,7 @@ class Orbitals:
     self.eigvecs=[]
     self.eigvals=[]
     self.atom_order=()
-    self.kpt_weight=0.0
+    self.kweight=1.0
     self.kpoint=(0.0,0.0,0.0)
     self.last_orbfile=None # Last path orbfile was written to.
 
@@ -26,35 +27,23 @@ class Orbitals:
     Args:
       outfn (str): file to write to.
     '''
-    nspin=len(self.eigvecs)
-    outf=open(outfn,'w')
-
     nao_atom = count_naos(self.basis)
+    aonorm = obj.crystal2qmc.ao_normalization(self.basis,self.atom_order)
+    eigvecs = [e*aonorm for e in self.eigvecs]
+    iscomplex = self.is_complex()
+
+    with open(outfn,'w') as outf:
+      write_orbfile(outf,[nao_atom[atom] for atom in self.atom_order],eigvecs,iscomplex)
 
-    # Do the printing.
-    coef_cnt = 0
-    for moidx in range(sum([e.shape[0] for e in self.eigvecs])):
-      for atidx,atom in enumerate(self.atom_order):
-        for aoidx in range(nao_atom[atom]):
-          outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
-              .format(moidx+1,aoidx+1,atidx+1,coef_cnt+1))
-          coef_cnt += 1
-    eigvec_flat = [obj.crystal2qmc.normalize_eigvec(self.eigvecs[s].copy(),self.basis,self.atom_order).ravel() for s in range(nspin)]
-    print_cnt = 0
-    outf.write("COEFFICIENTS\n")
-    if any([(e.imag!=0.0).any() for e in self.eigvecs]):
-      for eigv in eigvec_flat: 
-        for r,i in zip(eigv.real,eigv.imag):
-          outf.write("({:<.12e},{:<.12e}) "\
-              .format(r,i))
-          print_cnt+=1
-          if print_cnt%5==0: outf.write("\n")
-    else:                        # Real coefficients
-      for eigr in eigvec_flat:
-        for r in eigr:
-          outf.write("{:< 15.12e} ".format(r))
-          print_cnt+=1
-          if print_cnt%5==0: outf.write("\n")
+  #----------------------------------------------------------------------------------------------
+  def nmos(self):
+    ''' Number of orbitals in each spin channel. '''
+    return [e.shape[0] for e in self.eigvecs]
+
+  #----------------------------------------------------------------------------------------------
+  def is_complex(self):
+    ''' Whether the orbitals need complex coefficients. '''
+    return any([(e.imag!=0.0).any() for e in self.eigvecs])
 
   #----------------------------------------------------------------------------------------------
   def export_pyscf_basis(self):
@@ -105,25 +94,96 @@ class Orbitals:
     return '\n'.join(outlines)
 
   #----------------------------------------------------------------------------------------------
-  def export_qwalk_orbitals(self,orbfn):
+  def export_qwalk_orbitals(self,orbfn,basisfn=None):
     ''' Generate a orbitals section for QWalk.
     Args: 
       orbfn (str): file name of orb file (see write_qwalk_orb).
+      basisfn (str): file with the basis section (see export_qwalk_basis) to include, instead of writing it out.
     Returns:
       str: orbitals section for QWalk.
     '''
-    iscomplex=any([(e.imag!=0.0).any() for e in self.eigvecs])
+    iscomplex=self.is_complex()
+    if basisfn is None:
+      basislines=self.export_qwalk_basis().split('\n')
+    else:
+      basislines=["include {0}".format(basisfn)]
     outlines=[
       "{0}orbitals {{".format(('','c')[iscomplex]),
       "  magnify 1",
-      "  nmo {0}".format(sum([e.shape[0] for e in self.eigvecs])),
+      "  nmo {0}".format(sum(self.nmos())),
       "  orbfile {0}".format(orbfn)
-      ] + ["  "+line for line in self.export_qwalk_basis().split('\n')] + [
+      ] + ["  "+line for line in basislines] + [
       "  centers { useglobal }",
       "}"
     ]
     return '\n'.join(outlines)
 
+#################################################################################################
+class LazyOrbitals(Orbitals):
+  ''' Orbitals whose coefficients are only read from KRED.DAT (or the crystal_cache) when eigvecs is first used.
+  Useful for keeping only one kpoint in memory while converting many kpoints.
+  The number of orbitals and whether they're complex come from eigsys, so they don't read the coefficients.
+  '''
+
+  #----------------------------------------------------------------------------------------------
+  def __init__(self,eigsys,kpt,maxbands=(None,None),release=True):
+    '''
+    Args:
+      eigsys (dict): data from crystal2qmc.read_kred or crystal_cache.load_crystal.
+      kpt (tuple of int): Kpoint coordinates in eigsys.
+      maxbands (tuple): limit on number of orbitals to read in per spin channel.
+      release (bool): release the coefficients after write_qwalk_orb. They are reread if used again.
+    '''
+    Orbitals.__init__(self)
+    self.eigsys=eigsys
+    self.kpt=kpt
+    self.maxbands=maxbands
+    self.release=release
+    self._eigvecs=None
+
+  #----------------------------------------------------------------------------------------------
+  @property
+  def eigvecs(self):
+    if self._eigvecs is None:
+      with obj.crystal2qmc.open_eigvec_reader(self.eigsys) as reader:
+        self._eigvecs=[reader.lookup(self.kpt,s,maxbands=self.maxbands[s]) for s in range(self.eigsys['nspin'])]
+    return self._eigvecs
+
+  @eigvecs.setter
+  def eigvecs(self,eigvecs):
+    self._eigvecs=eigvecs
+
+  #----------------------------------------------------------------------------------------------
+  def nmos(self):
+    ''' Number of orbitals in each spin channel, without reading the coefficients. '''
+    nbands=self.eigsys['nbands']
+    return [nbands if self.maxbands[s] is None else min(nbands,self.maxbands[s]) for s in range(self.eigsys['nspin'])]
+
+  #----------------------------------------------------------------------------------------------
+  def is_complex(self):
+    ''' Whether the coefficients at this kpoint are complex, without reading them. '''
+    return bool(self.eigsys['ikpt_iscmpx'][self.kpt])
+
+  #----------------------------------------------------------------------------------------------
+  def loaded(self):
+    ''' Whether the coefficients are in memory. '''
+    return self._eigvecs is not None
+
+  #----------------------------------------------------------------------------------------------
+  def release_eigvecs(self):
+    ''' Free the coefficients; they'll be reread on the next use. '''
+    self._eigvecs=None
+
+  #----------------------------------------------------------------------------------------------
+  def write_qwalk_orb(self,outfn):
+    ''' Generate a orb file for QWalk (see Orbitals.write_qwalk_orb), then release the coefficients if requested.
+    Args:
+      outfn (str): file to write to.
+    '''
+    Orbitals.write_qwalk_orb(self,outfn)
+    if self.release:
+      self.release_eigvecs()
+
 ###############################################################################
 def find_min_exp(basis):
   ''' Find minimum exponent in basis. '''
@@ -149,3 +209,51 @@ def count_naos(basis):
     for basis_element in basis[atom]:
       results[atom]+=countmap[basis_element['angular']]
   return results
+
+###############################################################################
+def write_orbfile(outf,naos,eigvecs,iscomplex,nmo=None,chunksize=2**16):
+  ''' Write the index table and coefficients of a QWalk orb file.
+  Lines are formatted a chunk at a time from numpy arrays, rather than one call per number.
+  Args:
+    outf (file): open file to write to.
+    naos (list): number of AOs on each atom, in order of the atoms.
+    eigvecs (list): coefficients indexed by [orbital, AO], one array for each spin channel (already normalized).
+    iscomplex (bool): write complex coefficients.
+    nmo (int): number of orbitals in the index table. Default is the total number of rows in eigvecs.
+    chunksize (int): number of lines or coefficients formatted at a time.
+  '''
+  naos = np.asarray(naos,dtype=int)
+  if nmo is None:
+    nmo = sum([e.shape[0] for e in eigvecs])
+
+  # Index table: one line per (orbital, atom, AO) with a running coefficient count.
+  # Same for every orbital, so build it once and shift the orbital and count columns.
+  naotot = naos.sum()
+  atidx = np.repeat(np.arange(naos.size)+1,naos)
+  aoidx = np.arange(naotot) - np.repeat(naos.cumsum()-naos,naos) + 1
+  index = np.empty((naotot,4),dtype=int)
+  index[:,1] = aoidx
+  index[:,2] = atidx
+  mochunk = max(1,chunksize//max(naotot,1))
+  for start in range(0,nmo,mochunk):
+    moidx = np.arange(start,min(start+mochunk,nmo))
+    table = np.tile(index,(moidx.size,1))
+    table[:,0] = np.repeat(moidx+1,naotot)
+    table[:,3] = np.arange(moidx[0]*naotot,(moidx[-1]+1)*naotot)+1
+    outf.write(" %5d %5d %5d %5d\n"*table.shape[0]%tuple(table.ravel().tolist()))
+
+  # Coefficients, five to a line.
+  outf.write("COEFFICIENTS\n")
+  if iscomplex:
+    coefs = np.concatenate([np.asarray(e,dtype=complex).ravel() for e in eigvecs])
+    fmt,nfield = "(%.12e,%.12e) ",2
+    coefs = np.stack([coefs.real,coefs.imag],axis=1).ravel()
+  else:
+    coefs = np.concatenate([np.asarray(e).real.ravel() for e in eigvecs])
+    fmt,nfield = "%- 15.12e ",1
+  chunksize -= chunksize%(5*nfield)
+  for start in range(0,coefs.size,chunksize):
+    chunk = coefs[start:start+chunksize].tolist()
+    nlines,rem = divmod(len(chunk)//nfield,5)
+    outf.write((fmt*5+"\n")*nlines%tuple(chunk[:len(chunk)-rem*nfield]))
+    outf.write(fmt*rem%tuple(chunk[len(chunk)-rem*nfield:]))
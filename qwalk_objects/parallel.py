@@ -0,0 +1,35 @@
+'''
+Process pools whose tasks share a context, like the eigsys or the System.
+The context is sent to each process once, when the pool starts, instead of with every task.
+Task functions read it from worker, so they have to be defined at module level to be sent to the pool.
+'''
+
+from __future__ import division,print_function
+import multiprocessing
+
+# Context of the pool this process belongs to.
+worker={}
+
+def _init_worker(context,setup):
+  worker.clear()
+  worker.update(context)
+  if setup is not None:
+    setup(worker)
+
+def map_with_context(func,tasks,context,nproc,setup=None):
+  ''' Run func on each task in a pool of processes that share context.
+  Args:
+    func (function): called as func(task); reads the context from worker.
+    tasks (list): arguments of func.
+    context (dict): copied into worker in each process.
+    nproc (int): number of processes.
+    setup (function): called as setup(worker) in each process after the context is set, e.g. to open files.
+  Returns:
+    list: results of func, in the order of tasks.
+  '''
+  pool=multiprocessing.Pool(nproc,initializer=_init_worker,initargs=(context,setup))
+  try:
+    return pool.map(func,tasks)
+  finally:
+    pool.close()
+    pool.join()
@@ -0,0 +1,52 @@
+'''
+Plan the next run when a VMC or DMC reader says 'restart'.
+The error of the mean falls as 1/sqrt(nblocks), so the current error and block count tell how many more blocks
+reach the reader's errtol. With the time per block this gives the wall time to request.
+The time per block is measured by the reader from when the log was written, which takes two collects that
+find new blocks (e.g. polling the run, or keeping readers in collect_runs). Otherwise it has to be given.
+'''
+
+from __future__ import division,print_function
+import numpy as np
+from qwalk_objects import reblock as rb
+
+####################################################
+def plan_restart(reader,seconds_per_block=None,safety=1.1,min_nblock=1,max_nblock=None):
+  ''' Blocks and wall time for the next run, based on the last collect of reader.
+  Args:
+    reader (VMCReader or DMCReader): reader after collect.
+    seconds_per_block (float): time per block. Default is reader.seconds_per_block(); if that's unknown and
+      more blocks are needed, this is required.
+    safety (float): factor on the number of blocks to allow for the noise in the error estimate.
+    min_nblock (int): smallest nblock to plan.
+    max_nblock (int): largest nblock to plan (e.g. to fit in a queue's time limit).
+  Returns:
+    dict: 'nblock' (blocks for the next run; 0 if none are needed), 'walltime' (seconds), 'seconds_per_block',
+      'error', 'errtol', and 'blocks' (usable blocks so far).
+  '''
+  output=reader.output
+  if 'properties' not in output:
+    raise ValueError("Reader has no results to plan from; collect a run first.")
+  error=reader.energy_error()
+  nblocks=output['total blocks']-output['warmup blocks']
+  if seconds_per_block is None:
+    seconds_per_block=reader.seconds_per_block()
+
+  needed=max(rb.extra_blocks(error,nblocks,reader.errtol),reader.minblocks-nblocks,0)
+  if needed>0:
+    needed=max(int(np.ceil(needed*safety)),min_nblock)
+  if max_nblock is not None:
+    needed=min(needed,max_nblock)
+
+  if seconds_per_block is None and needed>0:
+    raise ValueError("The time per block of {} wasn't measured; pass seconds_per_block.".format(output.get('file')))
+
+  plan={'nblock':needed,'error':error,'errtol':reader.errtol,'blocks':nblocks,'seconds_per_block':seconds_per_block}
+  plan['walltime']=needed*seconds_per_block if needed>0 else 0.0
+  return plan
+
+####################################################
+def apply_plan(writer,plan):
+  ''' Set the number of blocks of a VMCWriter or DMCWriter from plan_restart. Returns the writer.'''
+  writer.nblock=max(plan['nblock'],1)
+  return writer
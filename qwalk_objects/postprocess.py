@@ -3,6 +3,8 @@ import os
 import qwalk_objects as obj
 import subprocess as sub
 import json
+import copy
+import numpy as np
 
 ####################################################
 class PostprocessWriter:
@@ -60,6 +62,129 @@ class PostprocessWriter:
 
     self.completed = True
 
+  #-----------------------------------------------
+  def qwalk_input_shards(self,infile,nshard,nconfig,nelec=None):
+    ''' Split the trace into nshard pieces and write an input for each, so they can be run at the same time.
+    Each input reads only its own blocks (see shard_trace for how), and none reads the warmup (nskip blocks).
+    Merge the results with merge_postprocess(infile+'.shards').
+
+    Args:
+      infile (str): base name of the inputs; shard i is infile_shard{i}.
+      nshard (int): number of shards.
+      nconfig (int): walkers per block in the trace.
+      nelec (int): number of electrons. Default is from sys.nspin.
+    Returns:
+      list: input file for each shard.
+    '''
+    if nelec is None:
+      nelec = sum(self.sys.nspin)
+    shards = shard_trace(self.tracefn,nshard,nelec,nconfig,self.nskip)
+
+    infiles = []
+    for i,shard in enumerate(shards):
+      writer = copy.copy(self)
+      writer.tracefn = shard['tracefn']
+      writer.nskip = shard['nskip']
+      infiles.append('%s_shard%d'%(infile,i))
+      writer.qwalk_input(infiles[-1])
+      shard['infile'] = infiles[-1]
+
+    with open(infile+'.shards','w') as f:
+      json.dump(shards,f)
+    self.completed = True
+    return infiles
+
+####################################################
+def shard_trace(tracefn,nshard,nelec,nconfig,nskip=0,chunkblocks=64):
+  ''' Split a trace into nshard ranges of whole blocks, leaving out the first nskip blocks.
+  QWalk can skip blocks at the start of a trace but can't stop early, so the last shard reads the original trace,
+  skipping everything before its range, and only the blocks of each other shard are copied to a trace of its own.
+  Args:
+    tracefn (str): trace to split; shard i (except the last) is written to tracefn.shard{i}.
+    nshard (int): number of shards. Blocks are divided as evenly as possible.
+    nelec (int): number of electrons.
+    nconfig (int): walkers per block.
+    nskip (int): warmup blocks to leave out.
+    chunkblocks (int): blocks to copy at a time.
+  Returns:
+    list: dict for each shard with 'tracefn', 'nskip' (blocks of tracefn to skip), 'blocks' (range of blocks
+      in the original trace), and 'weight' (total walker weight, used to combine the results).
+  '''
+  trace = obj.trace.TraceReader(tracefn,nelec,nconfig)
+  assert trace.nblocks-nskip >= nshard, \
+      "Trace has %d blocks after skipping %d, can't make %d shards."%(trace.nblocks-nskip,nskip,nshard)
+  bounds = np.linspace(nskip,trace.nblocks,nshard+1).round().astype(int)
+
+  shards = []
+  for i in range(nshard):
+    shard = {'tracefn':'%s.shard%d'%(tracefn,i),'nskip':0,'blocks':[int(bounds[i]),int(bounds[i+1])],'weight':0.0}
+    chunks = [(start,min(start+chunkblocks,bounds[i+1])) for start in range(bounds[i],bounds[i+1],chunkblocks)]
+    shard['weight'] = sum([float(trace.weights(start,stop).sum()) for start,stop in chunks])
+    if i == nshard-1:
+      shard['tracefn'],shard['nskip'] = tracefn,int(bounds[i])
+    else:
+      with open(shard['tracefn'],'wb') as f:
+        for start,stop in chunks:
+          trace.records(start,stop).tofile(f)
+    shards.append(shard)
+  trace.close()
+  return shards
+
+####################################################
+def merge_postprocess(manifest,jsonfns=None):
+  ''' Combine the results of sharded postprocess runs.
+  Args:
+    manifest (str): .shards file from PostprocessWriter.qwalk_input_shards.
+    jsonfns (list): JSON output of each shard. Default is the shard input name with .json.
+  Returns:
+    dict: results in the same layout as a single postprocess run.
+  '''
+  with open(manifest,'r') as f:
+    shards = json.load(f)
+  if jsonfns is None:
+    jsonfns = [shard['infile']+'.json' for shard in shards]
+  results = []
+  for jsonfn in jsonfns:
+    with open(jsonfn,'r') as f:
+      results.append(json.load(f))
+  return merge_results(results,[shard['weight'] for shard in shards])
+
+def merge_results(results,weights):
+  ''' Weighted average of postprocess results that were computed from separate walkers.
+  Values are averaged with the weights. Errors (in 'error' lists next to 'value', or in keys ending in '_err')
+  are independent between shards, so they are added in quadrature with the same weights.
+  Other entries that are equal in all results (settings, state lists, labels) are kept as they are, and
+  non-numeric entries that differ (like file names) are taken from the first result.
+
+  Args:
+    results (list): output of each run.
+    weights (list): total walker weight of each run.
+  Returns:
+    dict: combined result.
+  '''
+  weights = np.asarray(weights,dtype=float)/sum(weights)
+  return _merge(results,weights)
+
+def _merge(items,weights,iserr=False):
+  if not iserr and all([item == items[0] for item in items[1:]]):
+    return items[0]
+  if type(items[0]) is dict:
+    merged = {}
+    for key in items[0]:
+      keyerr = iserr or key.endswith('_err') or key == 'error'
+      merged[key] = _merge([item[key] for item in items],weights,keyerr)
+    return merged
+  if type(items[0]) is list and len(items[0])>0 and type(items[0][0]) is dict:
+    return [_merge(list(entries),weights,iserr) for entries in zip(*items)]
+  try:
+    vals = np.asarray(items,dtype=float)
+  except (ValueError,TypeError):
+    return items[0]
+  wshape = (-1,)+(1,)*(vals.ndim-1)
+  if iserr:
+    return (((weights.reshape(wshape)*vals)**2).sum(axis=0)**0.5).tolist()
+  return (weights.reshape(wshape)*vals).sum(axis=0).tolist()
+
 ####################################################
 class PostprocessReader:
   def __init__(self,errtol=0.01,minblocks=15):
@@ -0,0 +1,331 @@
+'''
+Pseudopotential and basis library (e.g. BFD_Library.xml), parsed once per process.
+get_library returns the same PseudoLibrary for every call with the same file, so writers and systems that look up
+many species don't reparse the XML. Lookups return copies, so changing them doesn't change the shared library.
+Numbers are kept as the text in the XML, so output written from the library is exactly what the XML says.
+
+For high-volume input generation, compile_library converts the XML once into an indexed binary store
+(BFD_Library.npz next to BFD_Library.xml), which get_library then loads instead of the XML. The store records the
+size and hash of the XML it came from, and get_library recompiles it if the XML doesn't match:
+
+  python -m qwalk_objects.pseudo_library BFD_Library.xml
+'''
+
+from __future__ import print_function
+import os
+import json
+import hashlib
+import numpy as np
+from xml.etree.ElementTree import ElementTree
+
+default_cache_dir=os.path.join(os.path.expanduser('~'),'.cache','qwalk_objects')
+_libraries={}
+
+####################################################
+def get_library(xml_name='BFD_Library.xml',persist=False,cache_dir=None):
+  ''' Library for xml_name, parsed only the first time it's asked for (or when the file changes).
+  Args:
+    xml_name (str): path to the XML library.
+    persist (bool): also keep the parsed library in cache_dir (as JSON), so new processes don't parse the XML either.
+    cache_dir (str): directory for persist. Default is ~/.cache/qwalk_objects.
+  Returns:
+    PseudoLibrary or CompiledLibrary: library for xml_name. If a compiled store for xml_name exists, or xml_name is
+      itself a compiled store (.npz), it's loaded instead of parsing the XML. A store made from a different version
+      of the XML is recompiled first.
+  '''
+  compiled=compiled_name(xml_name)
+  if os.path.exists(compiled) and (compiled==xml_name or _store_matches(compiled,xml_name)):
+    xml_name=compiled
+  stat=os.stat(xml_name)
+  key=(os.path.abspath(xml_name),stat.st_size,stat.st_mtime_ns)
+  if key in _libraries:
+    return _libraries[key]
+
+  library=None
+  persist=persist and not xml_name.endswith('.npz')
+  if persist:
+    if cache_dir is None: cache_dir=default_cache_dir
+    jsonfn=os.path.join(cache_dir,'pseudo_%s.json'%hashlib.sha1(json.dumps(key).encode()).hexdigest())
+    if os.path.exists(jsonfn):
+      try:
+        with open(jsonfn,'r') as f:
+          library=PseudoLibrary.from_elements(xml_name,json.load(f))
+      except (ValueError,KeyError,TypeError) as err:
+        print("Library cache {} is unreadable ({}), rereading {}.".format(jsonfn,err,xml_name))
+  if library is None and xml_name.endswith('.npz'):
+    library=CompiledLibrary(xml_name)
+  if library is None:
+    library=PseudoLibrary(xml_name)
+    if persist:
+      if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+      tmpfn='%s.%d.tmp'%(jsonfn,os.getpid())
+      with open(tmpfn,'w') as f:
+        json.dump(library.elements,f)
+      os.replace(tmpfn,jsonfn)
+
+  # Forget older versions of this file.
+  for old in [k for k in _libraries if k[0]==key[0]]:
+    del _libraries[old]
+  _libraries[key]=library
+  return library
+
+# Result of _store_matches for each (store,xml) stat, so the XML is hashed once per version.
+_checked={}
+
+def _store_matches(compiled,xml_name):
+  ''' Whether compiled was made from xml_name as it is now, recompiling it if not.
+  Returns False (use the XML) if the store can't be rewritten.'''
+  xstat,cstat=os.stat(xml_name),os.stat(compiled)
+  key=(os.path.abspath(compiled),cstat.st_size,cstat.st_mtime_ns,xstat.st_size,xstat.st_mtime_ns)
+  if key not in _checked:
+    with np.load(compiled) as npz:
+      source=(int(npz['source_size']),npz['source_sha1'].item().decode()) if 'source_sha1' in npz.files else None
+    _checked[key]=source==(xstat.st_size,_sha1(xml_name))
+  if _checked[key]:
+    return True
+  try:
+    compile_library(xml_name,compiled)
+  except OSError as err:
+    print("Compiled library {} doesn't match {} and can't be rewritten ({}); reading the XML.".format(compiled,xml_name,err))
+    return False
+  print("Recompiled {} from {}.".format(compiled,xml_name))
+  return True
+
+def _sha1(fn):
+  digest=hashlib.sha1()
+  with open(fn,'rb') as f:
+    for chunk in iter(lambda: f.read(1<<20),b''):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+####################################################
+class PseudoLibrary:
+  ''' Pseudopotentials and basis sets of an XML library, indexed by symbol.
+
+  Args:
+    xml_name (str): path to the XML library.
+  Attributes:
+    elements (dict): record for each symbol (see pseudopotential and basis).
+  '''
+  def __init__(self,xml_name,parse=True):
+    self.xml_name=xml_name
+    self.elements={}
+    if not parse:
+      return
+    tree=ElementTree()
+    tree.parse(xml_name)
+    for element in tree.getroot().findall('./Pseudopotential'):
+      self.elements[element.get('symbol')]=_read_element(element)
+
+  @classmethod
+  def from_elements(cls,xml_name,elements):
+    ''' Library from elements saved as JSON (lists in place of the tuples).'''
+    library=cls(xml_name,parse=False)
+    for symbol,element in elements.items():
+      pseudo=element['pseudo']
+      library.elements[symbol]={
+          'pseudo':{'core_charge':pseudo['core_charge'],'proj':list(pseudo['proj']),
+              'local':[tuple(comp) for comp in pseudo['local']],'nonlocal':[tuple(comp) for comp in pseudo['nonlocal']]},
+          'basis':{name:[{'angular':con['angular'],'terms':[tuple(term) for term in con['terms']]} for con in basis]
+              for name,basis in element['basis'].items()}
+        }
+    return library
+
+  def __contains__(self,symbol):
+    return symbol in self.elements
+
+  def _lookup(self,symbol):
+    try:
+      return self.elements[symbol]
+    except KeyError:
+      raise KeyError("No pseudopotential for {} in {}.".format(symbol,self.xml_name))
+
+  def pseudopotential(self,symbol):
+    ''' Pseudopotential of symbol.
+    Returns:
+      dict: 'core_charge' (str), 'local' and 'nonlocal' (lists of (exp,coeff,r_to_n) strings),
+        and 'proj' (angular momentum of each nonlocal component, str).
+    '''
+    pseudo=self._lookup(symbol)['pseudo']
+    return {'core_charge':pseudo['core_charge'],'local':list(pseudo['local']),
+        'nonlocal':list(pseudo['nonlocal']),'proj':list(pseudo['proj'])}
+
+  def basis(self,symbol,basis_name='vtz'):
+    ''' Basis set basis_name of symbol.
+    Returns:
+      list: dict for each contraction with 'angular' (e.g. 's') and 'terms' (list of (exp,coeff) strings).
+    '''
+    return [{'angular':con['angular'],'terms':list(con['terms'])} for con in self._lookup(symbol)['basis'].get(basis_name,[])]
+
+####################################################
+def _read_element(element):
+  pseudo={}
+  pseudo['core_charge']=element.find('./Effective_core_charge').text
+  pseudo['local']=[_components(lc) for lc in element.findall('./Gaussian_expansion/Local_component')]
+  pseudo['nonlocal']=[_components(nlc) for nlc in element.findall('./Gaussian_expansion/Non-local_component')]
+  pseudo['proj']=[pl.text for pl in element.findall('./Gaussian_expansion/Non-local_component/Proj')]
+
+  basis={}
+  for basis_set in element.findall('./Basis-set'):
+    basis.setdefault(basis_set.get('name'),[]).extend([{
+        'angular':contraction.get('Angular_momentum'),
+        'terms':[(term.get('Exp'),term.get('Coeff')) for term in contraction.findall('./Basis-term')]
+      } for contraction in basis_set.findall('./Contraction')])
+  return {'pseudo':pseudo,'basis':basis}
+
+def _components(component):
+  return (component.find('./Exp').text,component.find('./Coeff').text,component.find('./r_to_n').text)
+
+####################################################
+def compiled_name(xml_name):
+  ''' Path of the compiled store for xml_name.'''
+  return os.path.splitext(xml_name)[0]+'.npz'
+
+####################################################
+def compile_library(xml_name,outfn=None):
+  ''' Convert an XML library to an indexed binary store.
+  Exponents and coefficients of all elements are stored in flat arrays (as numbers and as their original text),
+  with offsets giving each element's pseudopotential components and basis contractions.
+  The size and SHA-1 of xml_name are stored too, so get_library can tell if the store is stale.
+
+  Args:
+    xml_name (str): path to the XML library.
+    outfn (str): where to write the store. Default is compiled_name(xml_name).
+  Returns:
+    str: path of the store.
+  '''
+  if outfn is None: outfn=compiled_name(xml_name)
+  library=PseudoLibrary(xml_name)
+  symbols=list(library.elements)
+  basis_names=sorted(set([name for sym in symbols for name in library.elements[sym]['basis']]))
+
+  core,nlocal,pp,proj=[],[],[],[]
+  pp_offsets,proj_offsets,con_offsets=[0],[0],[0]
+  con_name,con_angular,terms,term_offsets=[],[],[],[0]
+  for sym in symbols:
+    element=library.elements[sym]
+    core.append(element['pseudo']['core_charge'])
+    nlocal.append(len(element['pseudo']['local']))
+    pp+=element['pseudo']['local']+element['pseudo']['nonlocal']
+    pp_offsets.append(len(pp))
+    proj+=element['pseudo']['proj']
+    proj_offsets.append(len(proj))
+    for name in sorted(element['basis']):
+      for contraction in element['basis'][name]:
+        con_name.append(basis_names.index(name))
+        con_angular.append(contraction['angular'])
+        terms+=contraction['terms']
+        term_offsets.append(len(terms))
+    con_offsets.append(len(con_name))
+
+  pp_text=np.array(pp,dtype='S').reshape(-1,3)
+  term_text=np.array(terms,dtype='S').reshape(-1,2)
+  arrays={
+      'symbols':np.array(symbols,dtype='S'),
+      'basis_names':np.array(basis_names,dtype='S'),
+      'core_charge':np.array(core,dtype='S'),
+      'nlocal':np.array(nlocal,dtype=int),
+      'pp_offsets':np.array(pp_offsets,dtype=int),
+      'pp_text':pp_text,
+      'pp_values':_to_float(pp_text),
+      'proj_offsets':np.array(proj_offsets,dtype=int),
+      'proj_text':np.array(proj,dtype='S'),
+      'con_offsets':np.array(con_offsets,dtype=int),
+      'con_name':np.array(con_name,dtype=int),
+      'con_angular':np.array(con_angular,dtype='S'),
+      'term_offsets':np.array(term_offsets,dtype=int),
+      'term_text':term_text,
+      'term_values':_to_float(term_text),
+      'source_size':np.array(os.stat(xml_name).st_size,dtype=int),
+      'source_sha1':np.array(_sha1(xml_name),dtype='S'),
+    }
+  tmpfn='%s.%d.tmp'%(outfn,os.getpid())
+  with open(tmpfn,'wb') as f:
+    np.savez(f,**arrays)
+  os.replace(tmpfn,outfn)
+  return outfn
+
+def _to_float(text):
+  ''' Numbers from an array of text; entries that aren't numbers (there are typos in the libraries) become nan.'''
+  try:
+    return text.astype(float)
+  except ValueError:
+    def convert(word):
+      try:
+        return float(word)
+      except ValueError:
+        return np.nan
+    return np.vectorize(convert,otypes=[float])(text)
+
+####################################################
+class CompiledLibrary:
+  ''' Library loaded from a store made by compile_library, with the same interface as PseudoLibrary.
+  Looking up an element only slices the flat arrays at its offsets.
+
+  Args:
+    fn (str): path to the store.
+  '''
+  def __init__(self,fn):
+    self.xml_name=fn
+    with np.load(fn) as npz:
+      self._arrays={key:npz[key] for key in npz.files}
+    self.index={sym.decode():i for i,sym in enumerate(self._arrays['symbols'])}
+    self.basis_names=[name.decode() for name in self._arrays['basis_names']]
+
+  def __contains__(self,symbol):
+    return symbol in self.index
+
+  def _lookup(self,symbol):
+    try:
+      return self.index[symbol]
+    except KeyError:
+      raise KeyError("No pseudopotential for {} in {}.".format(symbol,self.xml_name))
+
+  def _contractions(self,symbol,basis_name):
+    idx=self._lookup(symbol)
+    a=self._arrays
+    cons=np.arange(a['con_offsets'][idx],a['con_offsets'][idx+1])
+    if basis_name not in self.basis_names:
+      return cons[:0]
+    return cons[a['con_name'][cons]==self.basis_names.index(basis_name)]
+
+  def pseudopotential(self,symbol):
+    ''' Pseudopotential of symbol, as from PseudoLibrary.pseudopotential.'''
+    idx=self._lookup(symbol)
+    a=self._arrays
+    comps=[tuple(row) for row in np.char.decode(a['pp_text'][a['pp_offsets'][idx]:a['pp_offsets'][idx+1]]).tolist()]
+    nlocal=a['nlocal'][idx]
+    return {
+        'core_charge':a['core_charge'][idx].decode(),
+        'local':comps[:nlocal],
+        'nonlocal':comps[nlocal:],
+        'proj':np.char.decode(a['proj_text'][a['proj_offsets'][idx]:a['proj_offsets'][idx+1]]).tolist()
+      }
+
+  def basis(self,symbol,basis_name='vtz'):
+    ''' Basis set of symbol, as from PseudoLibrary.basis.'''
+    a=self._arrays
+    return [{
+        'angular':a['con_angular'][con].decode(),
+        'terms':[tuple(row) for row in np.char.decode(a['term_text'][a['term_offsets'][con]:a['term_offsets'][con+1]]).tolist()]
+      } for con in self._contractions(symbol,basis_name)]
+
+  def basis_arrays(self,symbol,basis_name='vtz'):
+    ''' Basis set of symbol as numbers.
+    Returns:
+      list: (angular,exponents,coefficients) for each contraction; the arrays are views into the store.
+    '''
+    a=self._arrays
+    return [(a['con_angular'][con].decode(),
+             a['term_values'][a['term_offsets'][con]:a['term_offsets'][con+1],0],
+             a['term_values'][a['term_offsets'][con]:a['term_offsets'][con+1],1])
+        for con in self._contractions(symbol,basis_name)]
+
+####################################################
+if __name__=='__main__':
+  import argparse
+  parser=argparse.ArgumentParser("Compile XML pseudopotential libraries into binary stores for get_library.")
+  parser.add_argument('xml_names',nargs='+',help='XML libraries to compile.')
+  args=parser.parse_args()
+  for xml_name in args.xml_names:
+    print("Compiled",xml_name,"to",compile_library(xml_name))
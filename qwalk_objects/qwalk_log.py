@@ -0,0 +1,383 @@
+'''
+Read QWalk .log files in Python instead of calling gosling.
+QWalk appends a record for every block to the log, with each property numbered by wave function:
+
+  block {
+    label dmc
+    version 1
+    totweight 2048
+    total_energy0 -14.6123 0.0121
+    kinetic0 11.62 0.031
+    ...
+    aux_size 0
+    average_generator {
+      type tbdm_basis
+      vals 0.98 0.01 ...
+    }
+  }
+
+read_log averages these records into the same dictionary as `gosling -json`.
+The raw values of average generators are averaged too ('average_generators'), but only gosling knows how to lay
+them out (e.g. as density matrices), so collect_log goes to gosling for logs that have them, and for logs it
+can't read natively. The native reader hasn't yet been checked against gosling on logs from real runs, so
+the readers only use it if asked (native=True).
+FileTail and LogTail remember how much of a file was read, so polling a running calculation only parses new output.
+'''
+
+from __future__ import division,print_function
+import os
+import re
+import subprocess as sub
+import json
+import numpy as np
+from qwalk_objects import reblock as rb
+
+####################################################
+def parse_blocks(logtext):
+  ''' Parse the block records in the text of a QWalk log.
+  Args:
+    logtext (str): contents of a .log file.
+  Returns:
+    list: dict for each block, with 'label', 'totweight', and 'properties'.
+      properties[name] is an array of (value,error) pairs, one pair per wave function
+      (QWalk's total_energy0, total_energy1, ... become rows of properties['total_energy']).
+      'average_generators' has the type and values (array) of each average generator, in order.
+      Other nested sections are kept as raw text in 'sections'.
+  '''
+  blocks=[]
+  words=logtext.replace('{',' { ').replace('}',' } ').split()
+  pos=0
+  while pos < len(words):
+    if words[pos].lower()=='block' and pos+1<len(words) and words[pos+1]=='{':
+      block,pos=_parse_block(words,pos+2)
+      blocks.append(block)
+    else:
+      pos+=1
+  return blocks
+
+####################################################
+def _parse_block(words,pos):
+  ''' Parse the inside of one block record starting at words[pos]. Returns the block and the position after it.'''
+  block={'label':None,'totweight':None,'properties':{},'average_generators':[],'sections':{}}
+  numbered={}
+  while pos < len(words) and words[pos]!='}':
+    key=pos
+    pos+=1
+    if pos < len(words) and words[pos]=='{':
+      start=pos+1
+      depth=1
+      while depth>0:
+        pos+=1
+        if words[pos]=='{': depth+=1
+        elif words[pos]=='}': depth-=1
+      if words[key]=='average_generator':
+        block['average_generators'].append(_average_generator(words[start:pos]))
+      else:
+        # Other nested sections: keep the raw words.
+        block['sections'].setdefault(words[key],[]).append(' '.join(words[start:pos]))
+      pos+=1
+      continue
+    vals=[]
+    while pos < len(words) and words[pos] not in ('{','}') and _isnumber(words[pos]):
+      vals.append(float(words[pos]))
+      pos+=1
+    name=words[key]
+    if name=='label':
+      block['label']=words[pos]
+      pos+=1
+    elif name=='totweight':
+      block['totweight']=vals[0]
+    elif len(vals)<2:
+      continue # Counts like version and aux_size.
+    elif _numbered.match(name) and len(vals)==2:
+      prop,wf=_numbered.match(name).groups()
+      numbered.setdefault(prop,{})[int(wf)]=vals
+    else:
+      block['properties'][name]=np.array(vals[:len(vals)//2*2]).reshape(-1,2)
+  for prop,wfs in numbered.items():
+    block['properties'][prop]=np.array([wfs[wf] for wf in sorted(wfs)])
+  return block,pos+1
+
+# Property of one wave function, like total_energy0.
+_numbered=re.compile(r'^([A-Za-z_]*[A-Za-z_])(\d+)$')
+
+def _average_generator(words):
+  ''' Type and values of an average_generator section of a block.'''
+  gen={'type':None,'vals':[]}
+  for i,word in enumerate(words):
+    if word=='type' and i+1<len(words):
+      gen['type']=words[i+1]
+    elif word=='vals':
+      end=i+1
+      while end<len(words) and _isnumber(words[end]): end+=1
+      gen['vals']=[float(w) for w in words[i+1:end]]
+  gen['vals']=np.array(gen['vals'])
+  return gen
+
+def _isnumber(word):
+  try:
+    float(word)
+    return True
+  except ValueError:
+    return False
+
+####################################################
+def average_blocks(blocks,warmup=0,reblock=1):
+  ''' Average block records like gosling does.
+  Each property is the totweight-weighted mean of the block averages; its error is the standard error of
+  the (reblocked) block averages.
+  Args:
+    blocks (list): blocks from parse_blocks, all from the same run.
+    warmup (int or 'auto'): number of blocks to discard at the start. 'auto' detects it from the total energy.
+    reblock (int): number of consecutive blocks to combine before estimating the error.
+  Returns:
+    dict: same layout as gosling -json: 'properties', 'total blocks', 'warmup blocks', and 'label'.
+      If there is a total energy, 'reblock' has its full error analysis (see reblock.analyze).
+      If the blocks have average generators, 'average_generators' has the 'type', and the averaged
+      'vals' and their errors ('err'), of each one.
+  '''
+  weights=np.array([b['totweight'] if b['totweight'] is not None else 1.0 for b in blocks])
+  energies=None
+  if len(blocks)>0 and all(['total_energy' in b['properties'] for b in blocks]):
+    energies=np.array([b['properties']['total_energy'][0,0] for b in blocks])
+  if warmup=='auto':
+    warmup=rb.detect_warmup(energies) if energies is not None else 0
+
+  res={'total blocks':len(blocks),'warmup blocks':warmup,'properties':{}}
+  if len(blocks)>0:
+    res['label']=blocks[-1]['label']
+  use=blocks[warmup:]
+  if len(use)==0:
+    return res
+
+  weights=weights[warmup:]
+  for name in use[0]['properties']:
+    if not all([name in b['properties'] for b in use]): continue
+    vals=np.array([b['properties'][name][:,0] for b in use]) # [block,wf]
+    value,error=weighted_mean_error(vals,weights,reblock)
+    res['properties'][name]={'value':value.tolist(),'error':error.tolist()}
+  gens=[[gen['vals'].shape for gen in b['average_generators']] for b in use]
+  ngen=len(gens[0])
+  if ngen>0 and all([shapes==gens[0] for shapes in gens]):
+    res['average_generators']=[]
+    for i in range(ngen):
+      value,error=weighted_mean_error([b['average_generators'][i]['vals'] for b in use],weights,reblock)
+      res['average_generators'].append({'type':use[0]['average_generators'][i]['type'],
+          'vals':value.tolist(),'err':error.tolist()})
+  if energies is not None:
+    res['reblock']=rb.analyze(energies[warmup:],weights)
+  return res
+
+####################################################
+def weighted_mean_error(vals,weights,reblock=1):
+  ''' Weighted mean of block values and its standard error.
+  Args:
+    vals (array): values indexed by [block,...].
+    weights (array): weight of each block.
+    reblock (int): number of consecutive blocks to combine before estimating the error.
+  Returns:
+    tuple: (mean,error) arrays, indexed like vals[0].
+  '''
+  vals=np.asarray(vals,dtype=float)
+  weights=np.asarray(weights,dtype=float)
+  if reblock>1:
+    nbin=vals.shape[0]//reblock
+    keep=nbin*reblock
+    binweights=weights[:keep].reshape(nbin,reblock)
+    vals=np.einsum('ij,ij...->i...',binweights,vals[:keep].reshape((nbin,reblock)+vals.shape[1:]))
+    weights=binweights.sum(axis=1)
+    vals/=weights.reshape((-1,)+(1,)*(vals.ndim-1))
+  wshape=(-1,)+(1,)*(vals.ndim-1)
+  total=weights.sum()
+  mean=(weights.reshape(wshape)*vals).sum(axis=0)/total
+  nblock=vals.shape[0]
+  if nblock<2:
+    return mean,np.full(mean.shape,np.nan)
+  var=(weights.reshape(wshape)*(vals-mean)**2).sum(axis=0)/total
+  return mean,np.sqrt(var/(nblock-1))
+
+####################################################
+class FileTail:
+  ''' Read only what was appended to a file since the last read.
+  If the file was truncated or replaced (e.g. a restarted run or rotated output), reading starts over.
+
+  Args:
+    fn (str): file to follow.
+  Attributes:
+    offset (int): bytes of fn already read.
+    mtime (float): modification time of fn at the last read.
+  '''
+  headsize=256
+
+  def __init__(self,fn):
+    self.fn=fn
+    self.reset()
+
+  def reset(self):
+    self.offset=0
+    self.mtime=None
+    self.ident=None
+    self.head=b''
+    self.mark=b''
+
+  def read(self,whole_lines=True):
+    ''' Read the new part of the file.
+    Args:
+      whole_lines (bool): stop at the last newline, leaving a partly written line for the next read.
+    Returns:
+      tuple: (text,restarted). restarted is True if the file changed under us; text then starts from the
+        beginning of the file and anything built from earlier reads should be dropped.
+    '''
+    # The file was rewritten if its identity changed, it shrank, or the bytes at its start or just before
+    # the offset aren't what we read before.
+    stat=os.stat(self.fn)
+    ident=(stat.st_dev,stat.st_ino)
+    with open(self.fn,'rb') as f:
+      head=f.read(self.headsize)
+      f.seek(self.offset-len(self.mark))
+      mark=f.read(len(self.mark))
+      restarted=self.ident is not None and \
+          (ident!=self.ident or stat.st_size<self.offset or head[:len(self.head)]!=self.head or mark!=self.mark)
+      if restarted:
+        self.reset()
+      f.seek(self.offset)
+      new=f.read()
+    end=new.rfind(b'\n')+1 if whole_lines else len(new)
+    self.offset+=end
+    self.mtime=stat.st_mtime
+    self.ident=ident
+    self.head=head[:min(self.offset,self.headsize)]
+    if end>0:
+      self.mark=new[max(0,end-self.headsize):end]
+    return new[:end].decode(errors='replace'),restarted
+
+####################################################
+class LogTail:
+  ''' Block records of a QWalk log, parsed incrementally.
+  Each update only parses complete records appended since the last one.
+
+  Args:
+    logfn (str): .log file.
+  Attributes:
+    blocks (list): blocks read so far, as from parse_blocks.
+    history (list): (time,number of blocks) at each update that found new blocks. The time is when the log
+      was last written, so it's the time QWalk wrote those blocks, however late they're read.
+  '''
+  def __init__(self,logfn):
+    self.logfn=logfn
+    self.tail=FileTail(logfn)
+    self.blocks=[]
+    self.buffer=''
+    self.history=[]
+
+  def update(self):
+    ''' Parse new records. Returns the list of all blocks.'''
+    text,restarted=self.tail.read(whole_lines=False)
+    if restarted:
+      self.blocks=[]
+      self.buffer=''
+      self.history=[]
+    self.buffer+=text
+    end=_complete_end(self.buffer)
+    new=parse_blocks(self.buffer[:end])
+    self.blocks+=new
+    self.buffer=self.buffer[end:]
+    if len(new)>0:
+      self.history.append((self.tail.mtime,len(self.blocks)))
+    return self.blocks
+
+  def seconds_per_block(self):
+    ''' Rate the run is writing blocks, from the log's modification times at the updates that found new blocks.
+    None until two updates have seen new blocks.'''
+    if len(self.history)<2:
+      return None
+    (start,nstart),(end,nend)=self.history[0],self.history[-1]
+    return (end-start)/(nend-nstart)
+
+  def read(self,label=None,warmup=0,reblock=1):
+    ''' Update and average the blocks. Arguments are the same as read_log.'''
+    blocks=self.update()
+    if len(blocks)==0:
+      return {}
+    if label is None:
+      label=blocks[-1]['label']
+    blocks=[b for b in blocks if b['label']==label]
+    return average_blocks(blocks,warmup,reblock)
+
+def _complete_end(text):
+  ''' Position just after the last closing brace of text that leaves no section open.'''
+  depth,end=0,0
+  for match in re.finditer('[{}]',text):
+    depth+=1 if match.group()=='{' else -1
+    if depth==0: end=match.end()
+  return end
+
+####################################################
+def read_log(logfn,label=None,warmup=0,reblock=1):
+  ''' Read and average a QWalk log without gosling.
+  Args:
+    logfn (str): .log file.
+    label (str): label of the run to average. Default is the label of the last block.
+    warmup (int or 'auto'): number of blocks to discard at the start.
+    reblock (int): number of consecutive blocks to combine before estimating the error.
+  Returns:
+    dict: same layout as gosling -json, or {} if there are no blocks.
+  '''
+  return LogTail(logfn).read(label,warmup,reblock)
+
+####################################################
+def gosling_json(logfn,gosling="gosling"):
+  ''' Run gosling on logfn and return its JSON output.'''
+  return json.loads(sub.check_output([gosling,"-json",logfn]).decode())
+
+####################################################
+def collect_log(logfn,gosling="gosling",native=True,tail=None,**kwargs):
+  ''' Read logfn natively, falling back to gosling if the native result isn't complete.
+  gosling is used if the log has no total energy, or if it has average generators (only gosling lays them out).
+  Args:
+    logfn (str): .log file.
+    gosling (str): gosling executable for the fallback. None disables the fallback. If there is no gosling,
+      average generators are only in 'average_generators', as raw averages.
+    native (bool): False goes straight to gosling.
+    tail (LogTail): state from earlier reads of logfn, so only new records are parsed.
+    kwargs: passed to read_log.
+  Returns:
+    dict: same layout as gosling -json, or {} if the log is missing or empty, or there's no total energy and no gosling.
+  '''
+  if not os.path.exists(logfn) or os.path.getsize(logfn)==0:
+    return {}
+  if native:
+    if tail is None:
+      tail=LogTail(logfn)
+    res={}
+    try:
+      res=tail.read(**kwargs)
+    except (OSError,ValueError,IndexError,KeyError) as err:
+      print("Couldn't read {} natively ({}).".format(logfn,err))
+    if 'total_energy' not in res.get('properties',{}):
+      return gosling_json(logfn,gosling) if gosling is not None else {}
+    if 'average_generators' not in res or gosling is None:
+      return res
+    try:
+      return gosling_json(logfn,gosling)
+    except (OSError,sub.CalledProcessError,ValueError) as err:
+      print("Couldn't run {} on {} ({}); average generators are raw averages.".format(gosling,logfn,err))
+      return res
+  return gosling_json(logfn,gosling)
+
+####################################################
+def read_logs(logfns,gosling="gosling",native=True,**kwargs):
+  ''' Collect many logs in one call (see collect_log).
+  Args:
+    logfns (list): .log files.
+  Returns:
+    list: result for each log, in order. Logs that can't be read at all give {}.
+  '''
+  results=[]
+  for logfn in logfns:
+    try:
+      results.append(collect_log(logfn,gosling,native,**kwargs))
+    except (IOError,OSError,ValueError,sub.CalledProcessError) as err:
+      print("Couldn't read {} ({}).".format(logfn,err))
+      results.append({})
+  return results
@@ -0,0 +1,161 @@
+'''
+Error analysis of a series of block averages (e.g. the total energy of each block in a QWalk log).
+- reblock: Flyvbjerg-Petersen reblocking, averaging neighboring blocks pairwise until the error stops growing.
+- autocorrelation_time: integrated autocorrelation time from the FFT autocorrelation function.
+- detect_warmup: number of blocks to discard as warmup (marginal standard error rule).
+- extra_blocks: blocks still needed to reach an error tolerance, using error ~ 1/sqrt(nblocks).
+analyze does all of these at once. Everything is O(n log n) or better in the number of blocks.
+'''
+
+from __future__ import division,print_function
+import numpy as np
+
+####################################################
+def reblock(vals,weights=None):
+  ''' Flyvbjerg-Petersen reblocking of a series of (weighted) block averages.
+  Args:
+    vals (array): average of each block.
+    weights (array): weight of each block. Default is equal weights.
+  Returns:
+    dict: arrays indexed by reblocking level: 'blocksize' (original blocks per reblocked block), 'nblocks',
+      'error' (standard error of the mean estimated at that level), and 'error_err' (uncertainty of that error).
+  '''
+  vals=np.asarray(vals,dtype=float)
+  weights=np.ones(vals.shape) if weights is None else np.asarray(weights,dtype=float)
+  stats={'blocksize':[],'nblocks':[],'error':[],'error_err':[]}
+  blocksize=1
+  while vals.size>=2:
+    nblock=vals.size
+    total=weights.sum()
+    mean=(weights*vals).sum()/total
+    error=((weights*(vals-mean)**2).sum()/total/(nblock-1))**0.5
+    stats['blocksize'].append(blocksize)
+    stats['nblocks'].append(nblock)
+    stats['error'].append(error)
+    stats['error_err'].append(error/(2*(nblock-1))**0.5)
+
+    # Merge neighboring pairs, dropping the last block if there's an odd number.
+    keep=nblock//2*2
+    pairw=weights[:keep].reshape(-1,2)
+    weights=pairw.sum(axis=1)
+    vals=(pairw*vals[:keep].reshape(-1,2)).sum(axis=1)/weights
+    blocksize*=2
+  return {key:np.array(val) for key,val in stats.items()}
+
+####################################################
+def optimal_level(stats):
+  ''' Choose the reblocking level using the criterion of Lee, Needs, and Towler (PRE 83, 066706):
+  the smallest blocksize B with B**3 > 2*n*(error_B/error_1)**4.
+  Args:
+    stats (dict): output of reblock.
+  Returns:
+    tuple: (level,converged). If no level satisfies the criterion, the last one is returned and converged is False.
+  '''
+  if len(stats['error'])==0:
+    return 0,False
+  if stats['error'][0]==0:
+    return 0,True
+  ratio=(stats['error']/stats['error'][0])**2
+  ok=np.nonzero(stats['blocksize']**3 > 2*stats['nblocks'][0]*ratio**2)[0]
+  if len(ok)==0:
+    return len(stats['error'])-1,False
+  return int(ok[0]),True
+
+####################################################
+def autocorrelation_time(vals,window=5.0):
+  ''' Integrated autocorrelation time, in blocks, using Sokal's automatic windowing.
+  Args:
+    vals (array): average of each block.
+    window (float): sum the autocorrelation function up to the first lag M with M >= window*tau(M).
+  Returns:
+    float: autocorrelation time (1 for uncorrelated blocks).
+  '''
+  vals=np.asarray(vals,dtype=float)
+  nblock=vals.size
+  if nblock<2:
+    return 1.0
+  dev=vals-vals.mean()
+  nfft=1<<int(2*nblock-1).bit_length()
+  spec=np.fft.rfft(dev,nfft)
+  acf=np.fft.irfft(spec*spec.conj(),nfft)[:nblock]
+  if acf[0]==0:
+    return 1.0
+  acf/=acf[0]
+  taus=2*np.cumsum(acf)-1
+  stop=np.nonzero(np.arange(nblock) >= window*taus)[0]
+  tau=taus[stop[0]] if len(stop)>0 else taus[-1]
+  return float(max(tau,1.0))
+
+####################################################
+def detect_warmup(vals,maxfrac=0.5):
+  ''' Number of blocks to discard as warmup, by the marginal standard error rule (MSER):
+  the warmup d minimizes var(vals[d:])/(n-d).
+  Args:
+    vals (array): average of each block.
+    maxfrac (float): never discard more than this fraction of the blocks.
+  Returns:
+    int: blocks to discard.
+  '''
+  vals=np.asarray(vals,dtype=float)
+  nblock=vals.size
+  if nblock<4:
+    return 0
+  # Sums of vals[d:] and vals[d:]**2 for every d.
+  tailsum=np.cumsum(vals[::-1])[::-1]
+  tailsq=np.cumsum(vals[::-1]**2)[::-1]
+  maxskip=int(maxfrac*nblock)
+  remain=nblock-np.arange(maxskip+1)
+  mean=tailsum[:maxskip+1]/remain
+  var=tailsq[:maxskip+1]/remain-mean**2
+  return int(np.argmin(var/remain))
+
+####################################################
+def extra_blocks(error,nblocks,errtol):
+  ''' Blocks needed beyond nblocks to bring error to errtol, assuming error ~ 1/sqrt(nblocks).'''
+  if error<=errtol:
+    return 0
+  return int(np.ceil(nblocks*(error/errtol)**2))-nblocks
+
+####################################################
+def analyze(vals,weights=None,warmup=0,errtol=None,min_blocks=8):
+  ''' Full error analysis of a series of block averages.
+  The error is the reblocked error at the level chosen by optimal_level, if the reblocking converged with at least
+  min_blocks reblocked blocks. Otherwise it is naive_error*sqrt(tau), with the autocorrelation time tau.
+  Args:
+    vals (array): average of each block.
+    weights (array): weight of each block.
+    warmup (int or 'auto'): blocks to discard; 'auto' uses detect_warmup.
+    errtol (float): target error, for predicting the blocks still needed.
+    min_blocks (int): fewest reblocked blocks to trust the reblocked error.
+  Returns:
+    dict: 'mean', 'error' (see above), 'naive_error' (assuming uncorrelated blocks), 'blocksize'
+      (chosen reblocking), 'converged' (whether the reblocking criterion was met), 'reblocked' (whether
+      'error' is the reblocked error), 'tau' (autocorrelation time in blocks), 'warmup',
+      'nblocks' (after warmup), and 'extra_blocks' if errtol is given.
+  '''
+  vals=np.asarray(vals,dtype=float)
+  weights=np.ones(vals.shape) if weights is None else np.asarray(weights,dtype=float)
+  if warmup=='auto':
+    warmup=detect_warmup(vals)
+  vals,weights=vals[warmup:],weights[warmup:]
+
+  res={'warmup':warmup,'nblocks':vals.size}
+  res['mean']=float((weights*vals).sum()/weights.sum()) if vals.size>0 else np.nan
+  stats=reblock(vals,weights)
+  level,res['converged']=optimal_level(stats)
+  if len(stats['error'])>0:
+    res['naive_error']=float(stats['error'][0])
+    res['reblocked']=bool(res['converged'] and stats['nblocks'][level]>=min_blocks)
+    res['blocksize']=int(stats['blocksize'][level])
+  else:
+    res['naive_error']=np.nan
+    res['reblocked']=False
+    res['blocksize']=1
+  res['tau']=autocorrelation_time(vals)
+  if res['reblocked']:
+    res['error']=float(stats['error'][level])
+  else:
+    res['error']=res['naive_error']*res['tau']**0.5
+  if errtol is not None:
+    res['extra_blocks']=extra_blocks(res['error'],res['nblocks'],errtol) if vals.size>1 else None
+  return res
@@ -1,4 +1,7 @@
+import copy
 import numpy as np
+from collections.abc import MutableMapping
+from qwalk_objects.pseudo_library import get_library
 periodic_table = ['H', 'He', 'Li', 'Be', 'B', 'C', 'N', 'O', 'F', 'Ne', 'Na',
     'Mg', 'Al', 'Si', 'P', 'S', 'Cl', 'Ar', 'K', 'Ca', 'Sc', 'Ti', 'V', 'Cr',
     'Mn', 'Fe', 'Co', 'Ni', 'Cu', 'Zn', 'Ga', 'Ge', 'As', 'Se', 'Br', 'Kr',
@@ -21,7 +24,9 @@ class System:
     - k-points (if any),
     - lattice vectors (if periodic).
 
-  Can also export to various file outputs.'''
+  Can also export to various file outputs.
+
+  positions is a Positions object; setting it to a list of dicts with 'species', 'abc', and 'xyz' converts it.'''
 
   # ----------------------------------------------------------------------------------------
   def __init__(self):
@@ -33,6 +38,15 @@ class System:
     self.nspin = (0,0)
     self.kpoint= (0.0,0.0,0.0)
 
+  # ----------------------------------------------------------------------------------------
+  @property
+  def positions(self):
+    return self._positions
+
+  @positions.setter
+  def positions(self,sites):
+    self._positions = Positions.from_sites(sites)
+
   # ----------------------------------------------------------------------------------------
   def import_xyz(self):
     ''' Generate a molecule's Structure from xyz file.'''
@@ -54,12 +68,11 @@ class System:
     for site in pydict['sites']:
       assert len(site['species'])==1,\
           'Multiple site not tested. Check this works ok and remove this assertion.'
-      element=site['species'][0]['element']
-      self.positions.append({
-            'species':element,
-            'abc':[float(c) for c in site['abc']], # TODO store only one.
-            'xyz':[float(c) for c in site['xyz']]
-          })
+    self.positions=Positions(
+        [site['species'][0]['element'] for site in pydict['sites']],
+        abc=[site['abc'] for site in pydict['sites']], # TODO store only one.
+        xyz=[site['xyz'] for site in pydict['sites']]
+      )
     for key in 'alpha','beta','gamma','a','b','c':
       self.latparm[key]=pydict['lattice'][key]
     self.latparm['latvecs']=np.array(pydict['lattice']['matrix'])*bohr
@@ -82,12 +95,11 @@ class System:
     assert len(struct)==1,\
         'Can only handle CIFs containing one structure for now.'
     struct=struct[struct.keys()[0]]
-    for label in struct['_atom_site_label']:
-      self.positions.append({
-        'species':''.join([c for c in label if c.isalpha()])
-        })
-    for idx,abc in enumerate(zip(struct['_atom_site_fract_x'],struct['_atom_site_fract_y'],struct['_atom_site_fract_z'])):
-      self.positions[idx]['abc']=[scrub_err(num) for num in abc]
+    self.positions=Positions(
+        [''.join([c for c in label if c.isalpha()]) for label in struct['_atom_site_label']],
+        abc=[[scrub_err(num) for num in abc]
+          for abc in zip(struct['_atom_site_fract_x'],struct['_atom_site_fract_y'],struct['_atom_site_fract_z'])]
+      )
 
     for key in 'alpha','beta','gamma':
       self.latparm[key]=scrub_err(struct['_cell_angle_%s'%key])
@@ -98,38 +110,30 @@ class System:
 
   # ----------------------------------------------------------------------------------------
   def lookup_pseudopotential(self,xml_name='BFD_Library.xml',species_list=None):
-    from xml.etree.ElementTree import ElementTree
     ''' Lookup pseudopotentials for the atoms in the structure. 
 
     Args:
       xml (str): path to xml for lookup.
       species (list): List of species to have pseudopotentials for. Default: all atoms currently in structure.
     '''
+    library=get_library(xml_name)
     if species_list is None:
-      species_list=set([s['species'] for s in self.positions])
+      species_list=self.positions.species_names
     for species in species_list:
+      element=library.pseudopotential(species)
       pseudo={}
-      tree = ElementTree()
-      tree.parse(xml_name)
-      element = tree.find('./Pseudopotential[@symbol="{}"]'.format(species))
-      eff_core_charge = element.find('./Effective_core_charge').text
-      pseudo['core_charge']=eff_core_charge
-      local_path = './Gaussian_expansion/Local_component'
-      non_local_path = './Gaussian_expansion/Non-local_component'
-      local_list = element.findall(local_path)
-      non_local_list = element.findall(non_local_path)
-      proj_list = element.findall('./Gaussian_expansion/Non-local_component/Proj')
+      pseudo['core_charge']=element['core_charge']
       pseudo['local']=[{
-        'exp':float(lc.find('./Exp').text),
-        'coef':float(lc.find('./Coeff').text),
-        'r_to_n':int(lc.find('./r_to_n').text)
-        } for lc in local_list]
+        'exp':float(exp),
+        'coef':float(coef),
+        'r_to_n':int(r_to_n)
+        } for exp,coef,r_to_n in element['local']]
       pseudo['nonlocal']=[{
-        'angular':int(pl.text),
-        'exp':float(nlc.find('./Exp').text),
-        'coef':float(nlc.find('./Coeff').text),
-        'r_to_n':int(nlc.find('./r_to_n').text)
-        } for pl,nlc in zip(proj_list,non_local_list)]
+        'angular':int(proj),
+        'exp':float(exp),
+        'coef':float(coef),
+        'r_to_n':int(r_to_n)
+        } for proj,(exp,coef,r_to_n) in zip(element['proj'],element['nonlocal'])]
       self.pseudo[species]=pseudo
 
   # ----------------------------------------------------------------------------------------
@@ -146,10 +150,9 @@ class System:
       ]
 
     geomlines+=["%i"%len(self.positions)]
-    for site in self.positions:
-      elemz=periodic_table.index(site['species'])+1
-      # TODO assumes psuedopotential.
-      geomlines+=[str(elemz+200)+" %g %g %g"%tuple(site['abc'])]
+    elemz=np.array([periodic_table.index(species)+1 for species in self.positions.species_names],dtype=int)
+    # TODO assumes psuedopotential.
+    geomlines+=format_rows("{} {:g} {:g} {:g}",[(elemz+200)[self.positions.species_index],self.positions.abc])
 
     if supercell is not None:
       geomlines+=["SUPERCELL"]
@@ -159,14 +162,31 @@ class System:
     return geomlines
 
   # ----------------------------------------------------------------------------------------
-  def export_qwalk_sys(self):
+  def export_qwalk_sys(self,kpoint=None):
     ''' Generate a system section for QWalk.
+    Args:
+      kpoint (tuple): k-point to use instead of self.kpoint.
     Returns: 
-      list: List of the lines (str) making up the qwalk system section.
+      str: the qwalk system section.
+    '''
+    if kpoint is None: kpoint=self.kpoint
+    return self.export_qwalk_sys_kpoints([kpoint])[0]
+
+  # ----------------------------------------------------------------------------------------
+  def export_qwalk_sys_kpoints(self,kpoints):
+    ''' System sections for each of kpoints (see export_qwalk_sys).
+    The atom and pseudopotential parts are formatted once, so each k-point only formats its kpoint line.
+    Returns:
+      list: system section (str) for each k-point.
     '''
     assert self.cutoff_divider is not None,"Must set cutoff_divider!"
     assert self.nspin != (0,0),"Must set nspin!"
+    atoms=[self.atom_section()] if len(self.positions)>0 else []
+    pseudos=[self.pseudo_section(species) for species in self.pseudo]
+    return [self._qwalk_sys(kpoint,atoms,pseudos) for kpoint in kpoints]
 
+  def _qwalk_sys(self,kpoint,atoms,pseudos):
+    ''' System section at kpoint, given the formatted atom and pseudo sections.'''
     outlines = []
 
     # Assumes 0-d or 3-d here.
@@ -182,70 +202,42 @@ class System:
           "  }",
           "  origin { 0 0 0 }",
           "  cutoff_divider {0}".format(self.cutoff_divider),
-          "  kpoint {{ {:4}   {:4}   {:4} }}".format(*self.kpoint)
+          "  kpoint {{ {:4}   {:4}   {:4} }}".format(*kpoint)
         ]
     else: # is molecule.
       outlines += [
           "system { molecule",
           "  nspin {{ {} {} }}".format(*self.nspin)
         ]
-    for position in self.positions:
-      if position['species'] in self.pseudo:
-        charge=self.pseudo[position['species']]['core_charge']
+    return '\n'.join(outlines+atoms+["}"]+pseudos)+'\n'
+
+  # ----------------------------------------------------------------------------------------
+  def atom_section(self):
+    ''' Atom lines of the QWalk system section, formatted all at once.
+    Returns:
+      str: atom lines.
+    '''
+    positions=self.positions
+    charges=[]
+    for species in positions.species_names:
+      if species in self.pseudo:
+        charges.append(self.pseudo[species]['core_charge'])
       else:
         assert 0, "Check part and delete this assertion!"
-        charge=periodic_table.find(position['species'])+1
-      outlines.append(
-        "  atom {{ {0} {1} coor {2} }}".format(
-          position['species'],
-          charge,
-          "{:< 15} {:< 15} {:< 15}".format(*[p for p in position['xyz']])
-        )
-      )
-    outlines.append("}")
-    done = []
-    for species in self.pseudo:
-      nonlocal_counts=[0,0,0,0,0,0] # Extra long to be safe.
-      for term in self.pseudo[species]['nonlocal']:
-        nonlocal_counts[term['angular']]+=1
-      for idx in range(len(nonlocal_counts)-1):
-        assert nonlocal_counts[idx]!=0 or nonlocal_counts[idx+1]==0,\
-          'Not sure if QWalk can handle a pseudopotential like this,'
-      nonlocal_counts=[c for c in nonlocal_counts if c>0]
-      num_types=1 + len(nonlocal_counts)
-
-      if num_types > 2: aip = 12
-      else:             aip =  6
+        charges.append(periodic_table.index(species)+1)
+    assert not np.isnan(positions.xyz).any(), "Need Cartesian (xyz) positions for QWalk."
+    names=np.array(positions.species_names,dtype=object)[positions.species_index]
+    atom_charges=np.array(charges,dtype=object)[positions.species_index]
+    lines=format_rows("  atom {{ {} {} coor {:< 15} {:< 15} {:< 15} }}",[names,atom_charges,positions.xyz])
+    return '\n'.join(lines)
 
-      outlines += [
-          "pseudo {",
-          "  {}".format(species),
-          "  aip {:d}".format(aip),
-          "  basis {{ {}".format(species),
-          "    rgaussian",
-          "    oldqmc {",
-          "      0.0 {:d}".format(num_types),
-          "      "+' '.join(["{}" for i in range(num_types)])\
-              .format(*(nonlocal_counts+[len(self.pseudo[species]['local'])]))
-        ]
-      last=-1
-      for gaussian in self.pseudo[species]['nonlocal']:
-        assert gaussian['angular']>last,\
-            "Wait, I thought the order is always ascending! Well this part needs some more code."
-        last=gaussian['angular']
-        outlines.append("      {:d}   {:<12} {:< 12}".format(
-          gaussian['r_to_n']+2,
-          gaussian['exp'],
-          gaussian['coef']
-        ))
-      for gaussian in self.pseudo[species]['local']:
-        outlines.append("      {:d}   {:<12} {:< 12}".format(
-          gaussian['r_to_n']+2,
-          gaussian['exp'],
-          gaussian['coef']
-        ))
-      outlines += ["    }","  }","}"]
-    return '\n'.join(outlines)+'\n'
+  # ----------------------------------------------------------------------------------------
+  def pseudo_section(self,species):
+    ''' QWalk pseudo section for species (see format_pseudo).
+    Returns:
+      str: pseudo section.
+    '''
+    return format_pseudo(species,self.pseudo[species])
 
   # ----------------------------------------------------------------------------------------
   def export_jastrow(self,threebody=False):
@@ -259,7 +251,7 @@ class System:
     if threebody: raise NotImplementedError("Should be simple to add three-body, but haven't bothered yet.")
       
     basis_cutoff = find_basis_cutoff(self.latparm['latvecs'])
-    atom_types = set([pos['species'] for pos in self.positions])
+    atom_types = self.positions.species_names
     outlines = [
         "jastrow2",
         "group {",
@@ -326,6 +318,258 @@ class System:
     self.cutoff_divider = find_cutoff_divider(self.latparm['latvecs'],min_exp)
     return self.cutoff_divider
 
+  # ----------------------------------------------------------------------------------------
+  def make_supercell(self,matrix,tol=1e-6):
+    ''' Build a supercell of this (periodic) system.
+    The supercell lattice vectors are matrix @ latvecs. The positions are tiled, and the k-point is folded
+    into the supercell (QWalk k-points are boundary phases exp(i pi k), so they transform like lattice vectors).
+    cutoff_divider is scaled so the basis cutoff length stays the same.
+
+    Args:
+      matrix (array): 3x3 integer matrix; row i gives supercell vector i in primitive lattice vectors.
+      tol (float): tolerance in fractional coordinates for deciding if an atom is inside the supercell.
+    Returns:
+      System: the supercell. This system is unchanged.
+    '''
+    assert self.latparm != {}, "Supercells need a periodic system."
+    matrix=np.array(matrix)
+    assert matrix.shape==(3,3) and (matrix==np.round(matrix)).all(), "Supercell matrix must be 3x3 integers."
+    matrix=np.round(matrix).astype(int)
+    ncell=int(round(abs(np.linalg.det(matrix))))
+    assert ncell>0, "Supercell matrix must not be singular."
+
+    latvecs=np.asarray(self.latparm['latvecs'],dtype=float)
+    superlatvecs=np.dot(matrix,latvecs)
+    positions=self.positions
+    abc=np.where(np.isnan(positions.abc),np.dot(positions.xyz,np.linalg.inv(latvecs)),positions.abc)
+    assert not np.isnan(abc).any(), "Need abc or xyz for every atom."
+
+    # Lattice translations that could land inside the supercell: the box around its corners.
+    corners=np.dot(np.array([[i,j,k] for i in (0,1) for j in (0,1) for k in (0,1)]),matrix)
+    ranges=[np.arange(lo,hi+1) for lo,hi in zip(corners.min(axis=0),corners.max(axis=0))]
+    shifts=np.stack(np.meshgrid(*ranges,indexing='ij'),axis=-1).reshape(-1,3)
+
+    # Fractional coordinates in the supercell of each atom shifted by each translation: [shift,atom,3].
+    frac=np.dot(abc[None,:,:]+shifts[:,None,:],np.linalg.inv(matrix))
+    inside=((frac>=-tol)&(frac<1-tol)).all(axis=2)
+    sidx,aidx=np.nonzero(inside)
+    assert sidx.size==ncell*len(positions),\
+        "Found %d atoms for a supercell of %d cells of %d atoms; try changing tol."%(sidx.size,ncell,len(positions))
+
+    supercell=copy.deepcopy(self)
+    supercell.positions=Positions(
+        positions.species[aidx],
+        abc=np.clip(frac[sidx,aidx],0.0,None),
+        xyz=positions.xyz[aidx]+np.dot(shifts[sidx],latvecs)
+      )
+    supercell.latparm['latvecs']=superlatvecs
+    if 'a' in self.latparm:
+      # Lengths in Angstroms, like import_cif.
+      lengths=np.linalg.norm(superlatvecs,axis=1)
+      for key,length in zip(('a','b','c'),lengths):
+        supercell.latparm[key]=length/bohr
+      for key,(i,j) in zip(('alpha','beta','gamma'),((1,2),(0,2),(0,1))):
+        supercell.latparm[key]=np.degrees(np.arccos(np.dot(superlatvecs[i],superlatvecs[j])/lengths[i]/lengths[j]))
+      supercell.group_number=1
+    supercell.nspin=tuple([n*ncell for n in self.nspin])
+    supercell.kpoint=tuple(np.mod(np.round(np.dot(matrix,self.kpoint),12),2.0).tolist())
+    if self.cutoff_divider is not None:
+      supercell.cutoff_divider=self.cutoff_divider*find_basis_cutoff(superlatvecs)/find_basis_cutoff(latvecs)
+    return supercell
+
+###########################################################################################
+class Positions:
+  ''' Atom positions stored as arrays: the species of each atom as an index into species_names,
+  and the coordinates as [natom,3] arrays.
+  Indexing and iterating give a Site for each atom, which acts like the dict {'species','abc','xyz'} that
+  System.positions used to hold, so older code still works; a slice gives a list of Sites.
+
+  Args:
+    species (list): species of each atom.
+    abc (array): fractional coordinates [natom,3]. Default is unknown.
+    xyz (array): Cartesian coordinates [natom,3]. Default is unknown.
+  Attributes:
+    species_names (list): distinct species, in order of appearance.
+    species_index (array): index into species_names for each atom.
+    abc (array): fractional coordinates [natom,3]; nan where unknown.
+    xyz (array): Cartesian coordinates [natom,3]; nan where unknown.
+  '''
+  def __init__(self,species=(),abc=None,xyz=None):
+    self._set_species(species)
+    self.abc=_coordinates(abc,len(self.species_index))
+    self.xyz=_coordinates(xyz,len(self.species_index))
+
+  @classmethod
+  def from_sites(cls,sites):
+    ''' Positions from a list of dicts with 'species' and (optionally) 'abc' and 'xyz'.'''
+    if isinstance(sites,Positions):
+      return sites
+    unknown=[np.nan]*3
+    return cls([site['species'] for site in sites],
+        abc=[site.get('abc',unknown) for site in sites],
+        xyz=[site.get('xyz',unknown) for site in sites])
+
+  def _set_species(self,species):
+    species=np.asarray(species,dtype=str)
+    names,first,inverse=np.unique(species,return_index=True,return_inverse=True)
+    order=np.argsort(first)
+    rank=np.empty(order.size,dtype=int)
+    rank[order]=np.arange(order.size)
+    self.species_names=names[order].tolist()
+    self.species_index=rank[inverse.ravel()]
+
+  @property
+  def species(self):
+    ''' Species of each atom (array of str).'''
+    return np.array(self.species_names,dtype=str)[self.species_index]
+
+  def __len__(self):
+    return len(self.species_index)
+
+  def __getitem__(self,idx):
+    if isinstance(idx,slice):
+      return [Site(self,i) for i in range(*idx.indices(len(self)))]
+    if idx<0: idx+=len(self)
+    if not 0<=idx<len(self):
+      raise IndexError("Atom %d out of range for %d atoms."%(idx,len(self)))
+    return Site(self,idx)
+
+  def __iter__(self):
+    for idx in range(len(self)):
+      yield Site(self,idx)
+
+  def append(self,site):
+    ''' Add an atom, from a dict like those of to_list.'''
+    self.extend(Positions.from_sites([site]))
+
+  def extend(self,other):
+    ''' Add the atoms of another Positions.'''
+    self._set_species(np.concatenate((self.species,other.species)))
+    self.abc=np.concatenate((self.abc,other.abc))
+    self.xyz=np.concatenate((self.xyz,other.xyz))
+
+  def set_species(self,idx,species):
+    ''' Change the species of atom idx.'''
+    allspecies=self.species.astype(object)
+    allspecies[idx]=species
+    self._set_species(allspecies)
+
+  def copy(self):
+    return Positions(self.species,abc=self.abc,xyz=self.xyz)
+
+  def to_list(self):
+    ''' Positions as a list of dicts with 'species', and 'abc' and 'xyz' (lists) if they're known.'''
+    sites=[{'species':species} for species in self.species.tolist()]
+    for key,coords in ('abc',self.abc),('xyz',self.xyz):
+      known=~np.isnan(coords).any(axis=1)
+      for site,coord,ok in zip(sites,coords.tolist(),known):
+        if ok: site[key]=coord
+    return sites
+
+###########################################################################################
+class Site(MutableMapping):
+  ''' One atom of a Positions, as a dict with 'species' and (if known) 'abc' and 'xyz'.
+  Coordinates are returned as lists, like the dicts used to hold; setting them changes the Positions.
+  '''
+  def __init__(self,positions,idx):
+    self.positions=positions
+    self.idx=idx
+
+  def _keys(self):
+    return ['species']+[key for key in ('abc','xyz') if not np.isnan(getattr(self.positions,key)[self.idx]).any()]
+
+  def __getitem__(self,key):
+    if key=='species':
+      return self.positions.species_names[self.positions.species_index[self.idx]]
+    if key not in self._keys():
+      raise KeyError(key)
+    return getattr(self.positions,key)[self.idx].tolist()
+
+  def __setitem__(self,key,value):
+    if key=='species':
+      self.positions.set_species(self.idx,value)
+    elif key in ('abc','xyz'):
+      getattr(self.positions,key)[self.idx]=value
+    else:
+      raise KeyError("Sites only have 'species', 'abc', and 'xyz'.")
+
+  def __delitem__(self,key):
+    if key not in ('abc','xyz'):
+      raise KeyError("Can only remove coordinates from a site.")
+    getattr(self.positions,key)[self.idx]=np.nan
+
+  def __iter__(self):
+    return iter(self._keys())
+
+  def __len__(self):
+    return len(self._keys())
+
+  def __repr__(self):
+    return repr(dict(self))
+
+def _coordinates(coords,natom):
+  if coords is None:
+    return np.full((natom,3),np.nan)
+  return np.array(coords,dtype=float).reshape(natom,3)
+
+###########################################################################################
+def format_rows(line,columns):
+  ''' Format line for every row of a table in one call.
+  Args:
+    line (str): str.format template for one row.
+    columns (list): arrays with an entry for each row; an [nrow,k] array fills k fields.
+  Returns:
+    list: formatted line (str) for each row.
+  '''
+  nrow=len(columns[0])
+  if nrow==0:
+    return []
+  table=np.column_stack([np.asarray(column).astype(object).reshape(nrow,-1) for column in columns])
+  return '\n'.join([line]*nrow).format(*table.ravel()).split('\n')
+
+###########################################################################################
+def format_pseudo(species,pseudo):
+  ''' QWalk pseudo section.
+  Args:
+    species (str): atom label.
+    pseudo (dict): pseudopotential, as from System.lookup_pseudopotential.
+  Returns:
+    str: pseudo section.
+  '''
+  nonlocal_counts=[0,0,0,0,0,0] # Extra long to be safe.
+  for term in pseudo['nonlocal']:
+    nonlocal_counts[term['angular']]+=1
+  for idx in range(len(nonlocal_counts)-1):
+    assert nonlocal_counts[idx]!=0 or nonlocal_counts[idx+1]==0,\
+      'Not sure if QWalk can handle a pseudopotential like this,'
+  nonlocal_counts=[c for c in nonlocal_counts if c>0]
+  num_types=1 + len(nonlocal_counts)
+
+  if num_types > 2: aip = 12
+  else:             aip =  6
+
+  outlines = [
+      "pseudo {",
+      "  {}".format(species),
+      "  aip {:d}".format(aip),
+      "  basis {{ {}".format(species),
+      "    rgaussian",
+      "    oldqmc {",
+      "      0.0 {:d}".format(num_types),
+      "      "+' '.join(["{}" for i in range(num_types)])\
+          .format(*(nonlocal_counts+[len(pseudo['local'])]))
+    ]
+  last=-1
+  for gaussian in pseudo['nonlocal']:
+    assert gaussian['angular']>last,\
+        "Wait, I thought the order is always ascending! Well this part needs some more code."
+    last=gaussian['angular']
+  args=[]
+  for gaussian in pseudo['nonlocal']+pseudo['local']:
+    args+=[gaussian['r_to_n']+2,gaussian['exp'],gaussian['coef']]
+  gaussians='\n'.join(["      {:d}   {:<12} {:< 12}"]*(len(args)//3)).format(*args)
+  return '\n'.join(outlines+([gaussians] if args else [])+["    }","  }","}"])
+
 ###########################################################################################
 def scrub_err(numstr):
   ''' Remove error bar notation.
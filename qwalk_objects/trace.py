@@ -0,0 +1,125 @@
+'''
+Read QWalk trace files (from save_trace in DMC and VMC) without loading them into memory.
+A trace is a sequence of binary records, one per walker, each with the electron positions and the walker weight
+as doubles. Every block of the run appends one record per walker, so a block is nconfig consecutive records.
+TraceReader memory maps the file and hands out blocks as NumPy views, so only the parts that are used are read.
+'''
+
+from __future__ import division,print_function
+import os
+import numpy as np
+
+####################################################
+class TraceReader:
+  ''' Memory-mapped QWalk trace file.
+
+  Args:
+    tracefn (str): trace file.
+    nelec (int): number of electrons, e.g. sum(system.nspin).
+    nconfig (int): walkers (records) per block, summed over processes. None treats the whole trace as one block.
+    ndim (int): dimensions of each electron position.
+    weight_first (bool): whether the weight comes before the positions in each record (QWalk writes it after).
+    dtype (str): type of the numbers in the file.
+  Attributes:
+    nrecords (int): complete records in the file. A partly written record at the end is ignored.
+    nblocks (int): complete blocks in the file.
+  '''
+  def __init__(self,tracefn,nelec,nconfig=None,ndim=3,weight_first=False,dtype='<f8'):
+    self.tracefn=tracefn
+    self.nelec=nelec
+    self.ndim=ndim
+    self.weight_first=weight_first
+    self.dtype=np.dtype(dtype)
+    self.recordsize=nelec*ndim+1
+
+    self.nrecords=os.path.getsize(tracefn)//(self.recordsize*self.dtype.itemsize)
+    self.nconfig=self.nrecords if nconfig is None else nconfig
+    self.nblocks=self.nrecords//self.nconfig if self.nconfig>0 else 0
+    if self.nrecords>0:
+      self._data=np.memmap(tracefn,dtype=self.dtype,mode='r',shape=(self.nrecords,self.recordsize))
+    else:
+      self._data=np.zeros((0,self.recordsize),dtype=self.dtype)
+
+  def __len__(self):
+    return self.nblocks
+
+  def __iter__(self):
+    return self.blocks()
+
+  def close(self):
+    ''' Release the memory map. Arrays from earlier blocks stay valid as long as they're referenced.'''
+    self._data=np.zeros((0,self.recordsize),dtype=self.dtype)
+    self.nrecords=self.nblocks=0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self,*args):
+    self.close()
+
+  #------------------------------------------------
+  def _split(self,records):
+    if self.weight_first:
+      weights,positions=records[:,0],records[:,1:]
+    else:
+      weights,positions=records[:,-1],records[:,:-1]
+    return positions.reshape(records.shape[0],self.nelec,self.ndim),weights
+
+  def block(self,bidx):
+    ''' Positions and weights of one block.
+    Args:
+      bidx (int): block index; negative counts from the end.
+    Returns:
+      tuple: (positions[nconfig,nelec,ndim], weights[nconfig]). These are read-only views into the file.
+    '''
+    if bidx<0: bidx+=self.nblocks
+    if not 0<=bidx<self.nblocks:
+      raise IndexError("Block %d out of range for trace with %d blocks."%(bidx,self.nblocks))
+    return self._split(self._data[bidx*self.nconfig:(bidx+1)*self.nconfig])
+
+  def blocks(self,start=0,stop=None,step=1):
+    ''' Generate (positions,weights) for each block in range(start,stop,step), as from block.'''
+    for bidx in range(*slice(start,stop,step).indices(self.nblocks)):
+      yield self.block(bidx)
+
+  def records(self,start=0,stop=None):
+    ''' Raw records of blocks start to stop, as a read-only view [walker,record].'''
+    start,stop,_=slice(start,stop).indices(self.nblocks)
+    return self._data[start*self.nconfig:stop*self.nconfig]
+
+  def weights(self,start=0,stop=None):
+    ''' Weights of blocks start to stop as an array [block,walker]. Only the weights are copied out of the file.'''
+    start,stop,_=slice(start,stop).indices(self.nblocks)
+    return np.array(self._split(self.records(start,stop))[1]).reshape(stop-start,self.nconfig)
+
+  def subsample(self,nsample,start=0,stop=None,seed=None):
+    ''' Draw walkers with probability proportional to their weight.
+    Args:
+      nsample (int): number of configurations to draw.
+      start, stop (int): range of blocks to draw from.
+      seed (int): seed for the random number generator.
+    Returns:
+      array: positions[nsample,nelec,ndim] of the drawn walkers.
+    '''
+    start,stop,_=slice(start,stop).indices(self.nblocks)
+    weights=self.weights(start,stop).ravel()
+    picks=np.sort(np.random.RandomState(seed).choice(weights.size,size=nsample,p=weights/weights.sum()))
+    positions,_=self._split(self.records(start,stop))
+    return np.array(positions[picks])
+
+####################################################
+def write_trace(tracefn,positions,weights,weight_first=False,append=False):
+  ''' Write walkers in the trace format, e.g. to make a subsampled or reweighted trace for postprocess.
+  Args:
+    tracefn (str): trace file.
+    positions (array): positions[nwalker,nelec,ndim].
+    weights (array): weights[nwalker].
+    weight_first (bool): see TraceReader.
+    append (bool): add to the end of an existing trace.
+  '''
+  positions=np.asarray(positions,dtype=float)
+  weights=np.asarray(weights,dtype=float).reshape(-1,1)
+  positions=positions.reshape(positions.shape[0],-1)
+  records=np.hstack((weights,positions) if weight_first else (positions,weights))
+  with open(tracefn,'ab' if append else 'wb') as f:
+    records.astype('<f8').tofile(f)
@@ -36,22 +36,27 @@ class Jastrow(TrialFunc):
 #################################################################################################
 class Slater(TrialFunc):
   ''' Class representing a slater determinant wave function. '''
-  def __init__(self,orbitals,orbfile,states,weights=(1.0,),shift_downorb=False):
+  def __init__(self,orbitals,orbfile,states,weights=(1.0,),shift_downorb=False,basisfile=None):
     '''
     Args: 
       weights (array-like): Weights of determinants for multideterminant expansion. 
       states (array-like): states[determinant][spin channel][orbital] select orbitals for determinants.
         Indicies should reference whats written in the orbfile.
       orbfile (str): where orbitals are stored on disk (see write_qwalk_orb).
-      orbitals (Orbitals): Something that can export_qwalk_orbitals(orbfile).
+      orbitals (Orbitals): Something that can export_qwalk_orbitals(orbfile), or export_qwalk_orbitals(orbfile,basisfile)
+        if basisfile is given. With shift_downorb, it also needs nmos() or eigvecs for the number of up orbitals.
       shift_downorb (bool): Shift states[1] by number of up orbitals. 
         Useful for unrestricted calculations.
+      basisfile (str): file with the basis section to include, instead of writing the basis into the orbitals.
     '''
     self.weights=weights
     self.states=states
     self.orbfn=orbfile
     self.orbitals=orbitals
-    self.shift_downorb=shift_downorb*(orbitals.eigvecs[0].shape[0])
+    self.basisfile=basisfile
+    self.shift_downorb=0
+    if shift_downorb:
+      self.shift_downorb=orbitals.nmos()[0] if hasattr(orbitals,'nmos') else orbitals.eigvecs[0].shape[0]
 
   def export_qwalk_wf(self,optimize_det=False,rotate_orbs=None):
     ''' Write out a qwalk wave function section .
@@ -99,7 +104,8 @@ class Slater(TrialFunc):
 
     outlines = [
         "slater",
-        self.orbitals.export_qwalk_orbitals(self.orbfn),
+        self.orbitals.export_qwalk_orbitals(self.orbfn) if self.basisfile is None else
+          self.orbitals.export_qwalk_orbitals(self.orbfn,self.basisfile),
         "detwt {{ {} }}".format(' '.join(weights.astype(str))),
         "states {"
       ]
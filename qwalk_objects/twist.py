@@ -0,0 +1,225 @@
+'''
+Inputs for twist-averaged QMC: one run for each k-point (twist) of a System.
+write_twists takes the System and the list of Orbitals from pack_objects, and writes for each twist an orb file,
+a system file at that twist, and a QWalk input from a VMCWriter or DMCWriter. All twists include one basis file.
+A manifest ([base].twists) lists the files and k-point weights of the twists, for averaging the results.
+
+The twists are written in parallel. Orb files, the expensive part, are skipped when they're newer than the files
+the orbitals come from (sources), and the other files are only rewritten when their contents change, so rerunning
+write_twists with sources is cheap. With LazyOrbitals, only the orb files that are written read the coefficients.
+
+After the runs, collect_twists reads every twist with a VMC, DMC, or postprocess reader and average_twists
+combines the results with the k-point weights.
+'''
+
+from __future__ import division,print_function
+import os
+import copy
+import json
+import numpy as np
+from qwalk_objects.trialfunc import Slater,SlaterJastrow
+from qwalk_objects.collect import collect_runs
+from qwalk_objects.parallel import worker,map_with_context
+
+####################################################
+def write_twists(system,orbitals,writer,base='qwalk',jastrow=None,states=None,nproc=1,sources=(),force=False):
+  ''' Write the inputs of a twist-averaged run.
+  Args:
+    system (System): system; its k-point is replaced by each twist's.
+    orbitals (list): Orbitals (or LazyOrbitals) for each twist, e.g. from pack_objects.
+    writer (object): writer with sys, trialfunc, and qwalk_input(infile), e.g. DMCWriter(None,None).
+      Each twist uses a copy with sys and trialfunc filled in.
+    base (str): twist i is written to [base]_[i].in, .sys, and .orb; the basis to [base].basis.
+    jastrow (Jastrow): Jastrow factor for a Slater-Jastrow trial function. Default is a Slater determinant only.
+    states (list): states for Slater (1-based), the same for every twist. Default is the lowest orbitals
+      of each spin channel, filled according to system.nspin.
+    nproc (int): number of processes writing twists in parallel.
+    sources (list): files the orbitals come from (e.g. KRED.DAT). An orb file is up to date if it exists and
+      is newer than all of these. Without sources, every orb file is rewritten.
+    force (bool): rewrite every file.
+  Returns:
+    dict: the manifest, also written to [base].twists: 'basis' (file), 'total kweight', and 'twists',
+      a dict for each twist with 'twist', 'kpoint', 'kweight', 'infile', 'sysfile', 'orbfile',
+      and 'written' (files that were changed by this call).
+  '''
+  assert len(orbitals)>0, "Need orbitals for at least one twist."
+  if states is None:
+    states=[[np.arange(1,system.nspin[0]+1),np.arange(1,system.nspin[1]+1)]]
+  newest=max([os.stat(fn).st_mtime_ns for fn in sources]) if len(sources)>0 else None
+  force_orb=force or len(sources)==0
+
+  basisfn=base+'.basis'
+  written=_write_text(basisfn,orbitals[0].export_qwalk_basis(),force)
+
+  # The atoms and pseudopotentials are formatted once for all twists.
+  systexts=system.export_qwalk_sys_kpoints([[float(k) for k in orbs.kpoint] for orbs in orbitals])
+  tasks=[]
+  for i,(orbs,systext) in enumerate(zip(orbitals,systexts)):
+    files={key:'%s_%d.%s'%(base,i,key) for key in ('in','sys','orb')}
+    tasks.append((i,orbs,files,systext))
+  context={'system':system,'writer':writer,'jastrow':jastrow,'states':states,
+      'basisfn':basisfn,'newest':newest,'force':force,'force_orb':force_orb}
+  if nproc>1:
+    twists=map_with_context(_write_twist,tasks,context,nproc)
+  else:
+    twists=[write_twist(*task,**context) for task in tasks]
+
+  if written:
+    twists[0]['written'].insert(0,basisfn)
+  manifest={'basis':basisfn,'total kweight':sum([twist['kweight'] for twist in twists]),'twists':twists}
+  with open(base+'.twists','w') as f:
+    json.dump(manifest,f,indent=1)
+  return manifest
+
+####################################################
+def write_twist(twist,orbs,files,systext,system,writer,jastrow,states,basisfn,newest=None,force=False,force_orb=None):
+  ''' Write the orb, system, and input files for one twist (see write_twists).
+  Args:
+    twist (int): index of the twist.
+    orbs (Orbitals): orbitals at this twist.
+    files (dict): file names for 'in', 'sys', and 'orb'.
+    systext (str): system section at this twist, or None to export it from system.
+    newest (int): modification time (ns) of the newest source of the orbitals, or None.
+    force_orb (bool): rewrite the orb file even if it's newer than newest. Default is force.
+    Other arguments are from write_twists.
+  Returns:
+    dict: manifest entry of the twist.
+  '''
+  kpoint=[float(k) for k in orbs.kpoint]
+  entry={'twist':twist,'kpoint':kpoint,'kweight':float(orbs.kweight),
+      'infile':files['in'],'sysfile':files['sys'],'orbfile':files['orb'],'written':[]}
+
+  if force_orb is None:
+    force_orb=force
+  orbfn=files['orb']
+  if force_orb or not os.path.exists(orbfn) or (newest is not None and os.stat(orbfn).st_mtime_ns<newest):
+    tmpfn='%s.%d.tmp'%(orbfn,os.getpid())
+    orbs.write_qwalk_orb(tmpfn)
+    os.replace(tmpfn,orbfn)
+    entry['written'].append(orbfn)
+
+  if systext is None:
+    systext=system.export_qwalk_sys(kpoint)
+  if _write_text(files['sys'],systext,force):
+    entry['written'].append(files['sys'])
+
+  slater=Slater(orbs,orbfn,states,shift_downorb=len(orbs.nmos())>1,basisfile=basisfn)
+  writer=copy.copy(writer)
+  writer.sys="include {0}".format(files['sys'])
+  writer.trialfunc=slater if jastrow is None else SlaterJastrow(slater,jastrow)
+  if _write_input(writer,files['in'],force):
+    entry['written'].append(files['in'])
+  return entry
+
+####################################################
+def _write_text(fn,text,force=False):
+  ''' Write text to fn unless fn already has it. Returns whether fn was written.'''
+  if not force and os.path.exists(fn):
+    with open(fn,'r') as f:
+      if f.read()==text:
+        return False
+  with open(fn,'w') as f:
+    f.write(text)
+  return True
+
+def _write_input(writer,infile,force=False):
+  ''' writer.qwalk_input(infile), keeping the old modification time if the input didn't change.
+  Returns whether the contents changed.'''
+  if force or not os.path.exists(infile):
+    writer.qwalk_input(infile)
+    return True
+  stat=os.stat(infile)
+  with open(infile,'r') as f:
+    old=f.read()
+  writer.qwalk_input(infile)
+  with open(infile,'r') as f:
+    if f.read()!=old:
+      return True
+  os.utime(infile,ns=(stat.st_atime_ns,stat.st_mtime_ns))
+  return False
+
+####################################################
+def average_twists(outputs,kweights,labels=None,partial=False):
+  ''' Twist average of reader outputs, weighted by the k-point weights.
+  Each property is averaged as sum(w*value)/sum(w), with error sqrt(sum((w*error)**2))/sum(w).
+  For the total energy of the first wave function, the reblocked error is used when the output has one
+  (see DMCReader.energy_error).
+
+  Args:
+    outputs (list): output (gosling layout, with 'properties') of each twist; None or {} if a twist has no results.
+    kweights (list): k-point weight of each twist.
+    labels (list): name of each twist to report, e.g. its output file. Default is the index.
+    partial (bool): average the twists that have results even if others don't, with their weights renormalized.
+  Returns:
+    dict: 'properties' (averaged 'value' and 'error' of the properties all used twists have), 'kweight'
+      (total weight averaged), 'twists' (number of twists with results), and 'missing' (labels of twists without results).
+      If twists are missing and partial is False, there are no properties.
+  '''
+  if labels is None:
+    labels=list(range(len(outputs)))
+  assert len(outputs)==len(kweights)==len(labels), "Need a k-point weight and label for each output."
+  have=[output is not None and 'properties' in output for output in outputs]
+  res={'missing':[label for label,ok in zip(labels,have) if not ok],'twists':sum(have),'kweight':0.0,'properties':{}}
+  if sum(have)==0 or (len(res['missing'])>0 and not partial):
+    return res
+
+  outputs=[output for output,ok in zip(outputs,have) if ok]
+  weights=np.array([weight for weight,ok in zip(kweights,have) if ok],dtype=float)
+  wtot=weights.sum()
+  res['kweight']=float(wtot)
+  names=[name for name in outputs[0]['properties'] if all([name in output['properties'] for output in outputs])]
+  for name in names:
+    # [twist,component] arrays.
+    vals=np.array([output['properties'][name]['value'] for output in outputs],dtype=float)
+    errs=np.array([output['properties'][name]['error'] for output in outputs],dtype=float)
+    if name=='total_energy':
+      # The reblocked error is for the first wave function only.
+      for output,err in zip(outputs,errs):
+        if 'reblock' in output:
+          err[0]=output['reblock']['error']
+    shape=(-1,)+(1,)*(vals.ndim-1)
+    res['properties'][name]={
+        'value':((weights.reshape(shape)*vals).sum(axis=0)/wtot).tolist(),
+        'error':(((weights.reshape(shape)*errs)**2).sum(axis=0)**0.5/wtot).tolist()
+      }
+  return res
+
+####################################################
+def collect_twists(manifest,reader,nproc=1,partial=False,outfiles=None):
+  ''' Collect and twist average the runs of a write_twists manifest.
+  Args:
+    manifest (str or dict): [base].twists file, or the manifest returned by write_twists.
+    reader (object): reader for the runs, e.g. DMCReader(errtol=0.001); each twist is collected by a copy.
+    nproc (int): number of processes reading twists in parallel.
+    partial (bool): average the finished twists (status 'ok') even if others aren't (see average_twists).
+      Twists that need to be restarted aren't averaged.
+    outfiles (list): output file of each twist. Default is the input file with .o.
+  Returns:
+    dict: from average_twists, plus 'complete' (whether every twist finished), 'blocking' (output files of
+      twists that failed to read or need to be restarted, with their status), and 'rows' (from collect_runs).
+      'incomplete' has the output files of twists with results that need to be restarted, and 'missing'
+      the rest of the twists that weren't averaged.
+  '''
+  if not isinstance(manifest,dict):
+    with open(manifest,'r') as f:
+      manifest=json.load(f)
+  twists=manifest['twists']
+  if outfiles is None:
+    outfiles=[twist['infile']+'.o' for twist in twists]
+  rows=collect_runs(outfiles,reader,nproc=nproc,keep_output=True)
+
+  blocking={row['file']:row['status'] if row['status']!='error' else row['message']
+      for row in rows if row['status']!='ok'}
+  outputs=[row['output'] if row['status']=='ok' else None for row in rows]
+  res=average_twists(outputs,[twist['kweight'] for twist in twists],outfiles,partial)
+  res['incomplete']=[row['file'] for row in rows if row['status']=='restart' and 'properties' in row['output']]
+  res['missing']=[fn for fn in res['missing'] if fn not in res['incomplete']]
+  res['complete']=len(blocking)==0
+  res['blocking']=blocking
+  res['rows']=rows
+  return res
+
+####################################################
+# Task of the pool of write_twists.
+def _write_twist(task):
+  return write_twist(*task,**worker)
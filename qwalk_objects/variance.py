@@ -1,5 +1,6 @@
 from __future__ import print_function
 import os
+from qwalk_objects.qwalk_log import FileTail
 ####################################################
 class VarianceWriter:
   def __init__(self,sys,trialfunc,iterations=10,macro_iterations=3):
@@ -59,16 +60,23 @@ class VarianceReader:
     self.vartol=vartol
     self.vardifftol=vardifftol
     self.minsteps=minsteps
+    self._tail=None
+    self._trace=[]
 
   #------------------------------------------------
   def read_outputfile(self,outfile):
-    ''' Read output file into dict.'''
+    ''' Read output file into dict. Only the part of outfile added since the last read is parsed.'''
+    if self._tail is None or self._tail.fn!=outfile:
+      self._tail=FileTail(outfile)
+      self._trace=[]
+    text,restarted=self._tail.read()
+    if restarted:
+      self._trace=[]
+    for line in text.splitlines():
+      if 'dispersion' in line:
+        self._trace.append(float(line.split()[4]))
     ret={}
-    ret['sigma_trace']=[]
-    with open(outfile,'r') as f:
-      for line in f:
-        if 'dispersion' in line:
-          ret['sigma_trace'].append(float(line.split()[4]))
+    ret['sigma_trace']=list(self._trace)
     if len(ret['sigma_trace'])>0:
       ret['sigma']=ret['sigma_trace'][-1]
     else:
@@ -1,8 +1,6 @@
 from __future__ import print_function
 import os
 import qwalk_objects as obj
-import subprocess as sub
-import json
 
 ####################################################
 class VMCWriter:
@@ -54,7 +52,7 @@ class VMCWriter:
 
 ####################################################
 class VMCReader:
-  def __init__(self,errtol=0.01,minblocks=15,gosling="gosling"):
+  def __init__(self,errtol=0.01,minblocks=15,gosling="gosling",native=False,warmup='auto'):
     ''' Object for reading and storing variance optimizer results.
     Args are only important for collect and check_complete.
 
@@ -62,6 +60,9 @@ class VMCReader:
       vartol (float): Tolerance on the variance for collec.
       vardifftol (float): Tolerance of the change between the first and last variance.
       minsteps (int): minimun number of steps to attempt >= 2.
+      gosling (str): gosling executable, used if the log can't be read natively.
+      native (bool): Read the log in Python instead of calling gosling (see qwalk_log).
+      warmup (int): Number of blocks to discard when reading the log natively, or 'auto' to detect it.
     Attributes:
       output (dict): Results for energy, error, and other information.
       completed (bool): Whether no more runs are needed.
@@ -72,14 +73,44 @@ class VMCReader:
     self.errtol=errtol
     self.minblocks=minblocks
     self.gosling=gosling
+    self.native=native
+    self.warmup=warmup
+    self._tails={}
 
   def read_outputfile(self,outfile):
     ''' Read output file results.
+    Blocks read by earlier calls are remembered, so only new blocks of the log are parsed.
 
     Args:
       outfile (str): output to read.
     '''
-    return json.loads(sub.check_output([self.gosling,"-json",outfile.replace('.o','.log')]).decode())
+    logfn=outfile.replace('.o','.log')
+    if logfn not in self._tails:
+      self._tails[logfn]=obj.qwalk_log.LogTail(logfn)
+    return obj.qwalk_log.collect_log(logfn,self.gosling,self.native,self._tails[logfn],warmup=self.warmup)
+
+  def read_outputfiles(self,outfiles):
+    ''' Read results of many output files in one call.
+
+    Args:
+      outfiles (list): outputs to read.
+    Returns:
+      list: results for each output; {} for outputs that couldn't be read.
+    '''
+    return obj.qwalk_log.read_logs([outfile.replace('.o','.log') for outfile in outfiles],
+        self.gosling,self.native,warmup=self.warmup)
+
+  def seconds_per_block(self):
+    ''' Measured time per block of the collected run, from when its blocks were written to the log. None if unknown.'''
+    if 'file' not in self.output: return None
+    tail=self._tails.get(self.output['file'].replace('.o','.log'))
+    return tail.seconds_per_block() if tail is not None else None
+
+  def energy_error(self):
+    ''' Error of the total energy, from reblocking if the log was read natively (more reliable with correlated blocks).'''
+    if 'reblock' in self.output:
+      return self.output['reblock']['error']
+    return self.output['properties']['total_energy']['error'][0]
 
   def check_complete(self):
     ''' Check if a VMC run is complete.
@@ -89,9 +120,9 @@ class VMCReader:
     completed=True
     if len(self.output)==0:
       return False # No results yet.
-    if self.output['properties']['total_energy']['error'][0] > self.errtol:
+    if self.energy_error() > self.errtol:
       print("VMC incomplete: (%f) does not meet tolerance (%f)"%\
-          (self.output['properties']['total_energy']['error'][0],self.errtol))
+          (self.energy_error(),self.errtol))
       completed=False
     if self.output['total blocks']-self.output['warmup blocks'] < self.minblocks:
       print("VMC incomplete: Run completed %d blocks, but requires %d."%\
@@ -0,0 +1,336 @@
+''' Timings of the performance-sensitive parts of the library.
+Run from this directory: python benchmark.py [GRED.DAT KRED.DAT]
+'''
+import sys
+import time
+import numpy as np
+sys.path.insert(0,'..')
+import qwalk_objects as obj
+
+GRED = 'mno/ref/crystal/GRED.DAT'
+KRED = 'mno/ref/crystal/KRED.DAT'
+
+def timeit(func,repeat=5):
+  ''' Best wall time of func() over repeat calls. '''
+  best = np.inf
+  for i in range(repeat):
+    start = time.perf_counter()
+    func()
+    best = min(best,time.perf_counter()-start)
+  return best
+
+def report(name,reftime,newtime):
+  print("{:<30} reference {:10.4f} s  new {:10.4f} s  speedup {:6.2f}".format(name,reftime,newtime,reftime/newtime))
+
+def text_eigvec_lookup(kpt,eigsys,spin=0):
+  ''' Line-by-line reader that eigvec_lookup used before KredReader. '''
+  nband = eigsys['nbands']
+  ncpnts = int(nband*eigsys['nao'])
+  if eigsys['ikpt_iscmpx'][kpt]:
+    ncpnts *= 2
+  linesperkpt = ncpnts//4 + int(ncpnts%4>0)
+
+  kredf = open(eigsys['kred'],'r')
+  kredf.seek(eigsys['kpt_file_start'][kpt][spin])
+  eigvec = []
+  for li,line in enumerate(kredf):
+    if li==linesperkpt: break
+    eigvec += line.split()
+  eigvec = np.array(eigvec[:ncpnts],dtype=float)
+  if eigsys['ikpt_iscmpx'][kpt]:
+    eigvec = eigvec.reshape(ncpnts//2,2)
+    eigvec = eigvec[:,0] + eigvec[:,1]*1j
+  return eigvec.reshape(nband,eigsys['nao'])
+
+def text_read_gred(gred="GRED.DAT"):
+  ''' Whole-file reader that read_gred used before GredTokens. '''
+  lat_parm = {}
+  ions = {}
+  basis = {}
+  pseudo = {}
+
+  gred = open(gred,'r').read()
+
+  # Fix numbers with no space between them.
+  gred = gred.replace("-"," -")
+  gred = gred.replace("E -","E-") 
+
+  gred_words = gred.split()
+  nparms = [int(w) for w in gred_words[1:4]]
+  cursor = 4
+
+  # These follow naming of cryapi_inp (but "inf" -> "info").
+  info = [int(w) for w in gred_words[cursor          :cursor+nparms[0]]]
+  itol = [int(w) for w in gred_words[cursor+nparms[0]:cursor+nparms[1]]]
+  par  = [int(w) for w in gred_words[cursor+nparms[1]:cursor+nparms[2]]]
+  cursor += sum(nparms)
+
+  lat_parm['struct_dim'] = int(info[9])
+
+  # Lattice parameters.
+  lat_parm['latvecs'] = \
+      np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3).T.round(15)
+  if (lat_parm['latvecs'] > 100).any():
+    print("Lattice parameter larger than 100 A! Reducing to 100.")
+    print("If this is a dimension < 3 system, there is no cause for alarm.")
+    print("Otherwise if this is a problem for you, please generalize crystal2qmc.")
+    lat_parm['latvecs'][lat_parm['latvecs']>100] = 100.
+  cursor += 9
+  prim_trans= np.array(gred_words[cursor:cursor+9],dtype=float).reshape(3,3)
+  cursor += 9
+  lat_parm['conv_cell'] = prim_trans.dot(lat_parm['latvecs'])
+  cursor += info[1] + 48*48 + 9*info[1] + 3*info[1] # Skip symmetry part.
+
+  # Lattice "stars" (?) skipped.
+  cursor += info[4]+1 + info[78]*3 + info[4]+1 + info[4]+1 + info[78] + info[78]*3
+
+  # Some of ion information.
+  natoms = info[23]
+  ions['charges'] = np.array(gred_words[cursor:cursor+natoms],dtype=float)
+  cursor += natoms
+  # Atom positions.
+  atom_poss = np.array(gred_words[cursor:cursor+3*natoms],dtype=float)
+  ions['positions'] = atom_poss.reshape(natoms,3)
+  cursor += 3*natoms
+
+  # Basis information (some ion information mixed in).
+  nshells = info[19]
+  nprim   = info[74]
+  # Formal charge of shell.
+  basis['charges'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  cursor += nshells
+  # "Adjoined gaussian" of shells.
+  basis['adj_gaus'] = np.array(gred_words[cursor:cursor+nshells],dtype=float)
+  cursor += nshells
+  # Position of shell.
+  shell_poss = np.array(gred_words[cursor:cursor+3*nshells],dtype=float)
+  basis['positions'] = shell_poss.reshape(nshells,3)
+  cursor += 3*nshells
+  # Primitive gaussian exponents.
+  basis['prim_gaus'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  # Coefficients of s, p, d, and (?).
+  basis['coef_s'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  basis['coef_p'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  basis['coef_dfg'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  basis['coef_max'] = np.array(gred_words[cursor:cursor+nprim],dtype=float)
+  cursor += nprim
+  # Skip "old normalization"
+  cursor += 2*nprim
+  # Atomic numbers.
+  ions['atom_nums'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms
+  # First shell of each atom (skip extra number after).
+  basis['first_shell'] = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms + 1
+  # First primitive of each shell (skips an extra number after).
+  basis['first_prim'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells + 1
+  # Number of prims per shell.
+  basis['prim_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  # Type of shell: 0=s,1=sp,2=p,3=d,4=f.
+  basis['shell_type'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  # Number of atomic orbtials per shell.
+  basis['nao_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+  # First atomic orbtial per shell (skip extra number after).
+  basis['first_ao'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells + 1
+  # Atom to which each shell belongs.
+  basis['atom_shell'] = np.array(gred_words[cursor:cursor+nshells],dtype=int)
+  cursor += nshells
+
+  # Pseudopotential information.
+  # Pseudopotential for each element.
+  pseudo_atom = np.array(gred_words[cursor:cursor+natoms],dtype=int)
+  cursor += natoms
+  cursor += 1 # skip INFPOT
+  ngauss = int(gred_words[cursor])
+  cursor += 1
+  headlen = int(gred_words[cursor])
+  cursor += 1
+  # Number of pseudopotentials.
+  numpseudo = int(gred_words[cursor])
+  cursor += 1
+  # Exponents of r^l prefactor.
+  r_exps = -1*np.array(gred_words[cursor:cursor+ngauss],dtype=int)
+  cursor += ngauss
+  # Number of Gaussians for angular momenutum j
+  n_per_j = np.array(gred_words[cursor:cursor+headlen],dtype=int)
+  cursor += headlen
+  # index of first n_per_j for each pseudo.
+  pseudo_start = np.array(gred_words[cursor:cursor+numpseudo],dtype=int)
+  cursor += numpseudo + 1
+  # Actual floats of pseudopotential.
+  exponents = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  cursor += ngauss
+  prefactors = np.array(gred_words[cursor:cursor+ngauss],dtype=float)
+  cursor += ngauss
+  # Store information nicely.
+  npjlen = int(headlen / len(pseudo_start))
+  for aidx,atom in enumerate(ions['atom_nums']):
+    psidx = pseudo_atom[aidx]-1
+    start = pseudo_start[psidx]
+    if psidx+1 >= len(pseudo_start): end = ngauss
+    else                           : end = pseudo_start[psidx+1]
+    if atom not in pseudo.keys():
+      pseudo[atom] = {}
+      pseudo[atom]['prefactors'] = prefactors[start:end]
+      pseudo[atom]['r_exps'] = r_exps[start:end]
+      pseudo[atom]['n_per_j'] = n_per_j[npjlen*psidx:npjlen*(psidx+1)]
+      pseudo[atom]['exponents'] = exponents[start:end]
+
+  ## Density matrix information.
+  # This is impossible to figure out.  See `cryapi_inp.f`.
+  #atomic_charges = np.array(gred_words[cursor:cursor+natoms],dtype=float)
+  #cursor += natoms
+  #mvlaf = info[55] #???
+  ## Skip symmetry information.
+  #cursor += mvlaf*4 + info[19]*info[1] + 
+  #print("atomic_charges",atomic_charges)
+
+  return info, lat_parm, ions, basis, pseudo
+
+def text_write_orbfile(outf,naos,eigvecs,iscomplex):
+  ''' One-number-at-a-time writer that Orbitals.write_qwalk_orb used before write_orbfile. '''
+  coef_cnt = 0
+  for moidx in range(sum([e.shape[0] for e in eigvecs])):
+    for atidx,nao in enumerate(naos):
+      for aoidx in range(nao):
+        outf.write(" {:5d} {:5d} {:5d} {:5d}\n"\
+            .format(moidx+1,aoidx+1,atidx+1,coef_cnt+1))
+        coef_cnt += 1
+  eigvec_flat = [e.ravel() for e in eigvecs]
+  print_cnt = 0
+  outf.write("COEFFICIENTS\n")
+  if iscomplex:
+    for eigv in eigvec_flat:
+      for r,i in zip(eigv.real,eigv.imag):
+        outf.write("({:<.12e},{:<.12e}) "\
+            .format(r,i))
+        print_cnt+=1
+        if print_cnt%5==0: outf.write("\n")
+  else:
+    for eigr in eigvec_flat:
+      for r in eigr:
+        outf.write("{:< 15.12e} ".format(r))
+        print_cnt+=1
+        if print_cnt%5==0: outf.write("\n")
+
+def bench_kred_reader(gred,kred):
+  info, lat_parm, ions, basis, pseudo = obj.crystal2qmc.read_gred(gred)
+  eigsys = obj.crystal2qmc.read_kred(info,basis,kred)
+  blocks = [(kpt,spin) for kpt in eigsys['kpt_coords'] for spin in range(eigsys['nspin'])]
+
+  def text():
+    for kpt,spin in blocks: text_eigvec_lookup(kpt,eigsys,spin)
+  def mapped():
+    with obj.crystal2qmc.KredReader(eigsys) as reader:
+      for kpt,spin in blocks: reader.lookup(kpt,spin)
+  report("KRED.DAT eigenvectors",timeit(text),timeit(mapped))
+
+def bench_kred_grid(kgrid=4,nbands=100,nao=150,nspin=2):
+  ''' KredReader on a synthetic KRED.DAT with a kgrid**3 k-point grid, half of the k-points complex. '''
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    eigsys = {'kred':tmpdir+'/KRED.DAT','nbands':nbands,'nao':nao,'nspin':nspin,
+              'kpt_coords':[],'ikpt_iscmpx':{},'kpt_file_start':{}}
+    pos = 0
+    with open(eigsys['kred'],'w') as f:
+      for kidx in range(kgrid**3):
+        kpt = (kidx//kgrid**2,(kidx//kgrid)%kgrid,kidx%kgrid)
+        eigsys['kpt_coords'].append(kpt)
+        eigsys['ikpt_iscmpx'][kpt] = kidx%2==1
+        eigsys['kpt_file_start'][kpt] = []
+        ncpnts = nbands*nao*(2 if kidx%2==1 else 1)
+        for spin in range(nspin):
+          vals = np.random.randn(ncpnts)
+          text = ''.join([''.join(['%21.13E'%x for x in vals[i:i+4]])+'\n' for i in range(0,ncpnts,4)])
+          eigsys['kpt_file_start'][kpt].append(pos)
+          f.write(text)
+          pos += len(text)
+    blocks = [(kpt,spin) for kpt in eigsys['kpt_coords'] for spin in range(nspin)]
+    def text():
+      for kpt,spin in blocks: text_eigvec_lookup(kpt,eigsys,spin)
+    def mapped():
+      with obj.crystal2qmc.KredReader(eigsys) as reader:
+        for kpt,spin in blocks: reader.lookup(kpt,spin)
+    report("KRED.DAT %d^3 k-points (%.0f MB)"%(kgrid,pos/1e6),timeit(text,repeat=2),timeit(mapped,repeat=2))
+
+def bench_crystal_cache(gred,kred):
+  import tempfile
+  with tempfile.TemporaryDirectory() as cache_dir:
+    obj.crystal_cache.load_crystal(gred,kred,use_cache=True,cache_dir=cache_dir)
+    def text():
+      obj.crystal_cache.load_crystal(gred,kred,use_cache=False)
+    def cached():
+      obj.crystal_cache.load_crystal(gred,kred,use_cache=True,cache_dir=cache_dir)
+    report("GRED.DAT and KRED.DAT",timeit(text),timeit(cached))
+    obj.crystal_cache.clear_cache(cache_dir)
+
+def bench_read_gred(gred):
+  report("GRED.DAT",timeit(lambda: text_read_gred(gred)),timeit(lambda: obj.crystal2qmc.read_gred(gred)))
+
+def bench_orb_writer(nmo=200,naos=(40,)*50):
+  import io
+  eigvecs = [np.random.randn(nmo,sum(naos)) for spin in range(2)]
+  ceigvecs = [e + 1j*np.random.randn(*e.shape) for e in eigvecs]
+  for name,vecs,iscomplex in ("real",eigvecs,False),("complex",ceigvecs,True):
+    ref,new = io.StringIO(),io.StringIO()
+    reftime = timeit(lambda: text_write_orbfile(ref,naos,vecs,iscomplex),repeat=1)
+    newtime = timeit(lambda: obj.orbitals.write_orbfile(new,naos,vecs,iscomplex),repeat=1)
+    assert ref.getvalue() == new.getvalue(), "Orb writers differ."
+    nbytes = len(new.getvalue())
+    report("%s orb file (%.0f MB)"%(name,nbytes/1e6),reftime,newtime)
+
+def quad_fit_exp(basis,expnew):
+  ''' fit_exp as it was before the vectorized fitting: numerical derivatives and adaptive quad for the error. '''
+  import warnings
+  from scipy.integrate import quad
+  from scipy.optimize import curve_fit
+  from qwalk_objects.basis_refit import generate_norm, n_map
+  def evaluate(exp,coeff,el,x):
+    f = 0.0*x
+    for e,c in zip(exp,coeff):
+      f += generate_norm(e,n_map[el])*c*np.exp(-e*x**2)
+    return f
+  xdata = np.logspace(-5,1,1000)
+  ydata = evaluate(basis['exp'],basis['coeff'],basis['el'],xdata)
+  pf,pcov = curve_fit(lambda x,*p: evaluate(expnew,p,basis['el'],x),xdata,ydata,[1.]*len(expnew))
+  with warnings.catch_warnings():
+    warnings.simplefilter('ignore')
+    err = quad(lambda x: np.abs(evaluate(expnew,pf,basis['el'],x)-evaluate(basis['exp'],basis['coeff'],basis['el'],x)),0,10.0)
+  return expnew,pf,err[0]
+
+def bench_basis_refit(xml='../qwalk_objects/BFD_Library.xml',ncontraction=20):
+  from qwalk_objects import basis_refit
+  library = obj.pseudo_library.PseudoLibrary(xml)
+  bases = []
+  for symbol in library.elements:
+    for contraction in library.basis(symbol,'vtz'):
+      basis = {'el':contraction['angular'].upper(),
+               'exp':[float(e) for e,c in contraction['terms']],'coeff':[float(c) for e,c in contraction['terms']]}
+      if len(basis['exp']) > 1 and min(basis['exp']) < 0.2 and basis['el'] in basis_refit.n_map:
+        bases.append(basis)
+  bases = bases[:ncontraction]
+  exps = [0.2*2**i for i in range(10)]
+  reftime = timeit(lambda: [quad_fit_exp(basis,exps) for basis in bases],repeat=1)
+  newtime = timeit(lambda: [basis_refit.fit_exp(basis,exps) for basis in bases],repeat=1)
+  worst = max([abs(quad_fit_exp(b,exps)[2]-basis_refit.fit_exp(b,exps)[2])/quad_fit_exp(b,exps)[2] for b in bases])
+  report("fit per contraction (%d)"%len(bases),reftime/len(bases),newtime/len(bases))
+  print("  largest relative difference of fit error: %.2g"%worst)
+
+if __name__=='__main__':
+  if len(sys.argv) > 2:
+    GRED, KRED = sys.argv[1:3]
+  bench_read_gred(GRED)
+  bench_kred_reader(GRED,KRED)
+  bench_kred_grid()
+  bench_crystal_cache(GRED,KRED)
+  bench_orb_writer()
+  bench_basis_refit()
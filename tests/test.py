@@ -10,6 +10,29 @@ def run_test():
   creader = test_crystal_reader()
   orbitals,system = convert_crystal()
   var = test_variance_writer()
+  test_read_gred()
+  test_kred_reader()
+  test_crystal_cache()
+  test_write_orbfile()
+  test_lazy_orbitals()
+  test_kaverage()
+  test_qwalk_log()
+  test_qwalk_log_layout()
+  test_log_tail()
+  test_collect_runs()
+  test_trace_reader()
+  test_postprocess_shards()
+  test_reblock()
+  test_plan_restart()
+  test_pseudo_library()
+  test_compiled_library()
+  test_refit_library()
+  test_gaussian_fit()
+  test_qwalk_sys()
+  test_positions()
+  test_make_supercell()
+  test_write_twists()
+  test_average_twists()
 
 def test_crystal_writer():
   cwriter = obj.crystal.CrystalWriter(xml_name='../BFD_Library.xml',total_spin=5)
@@ -27,6 +50,520 @@ def convert_crystal():
   orbitals[0].write_qwalk_orb('mno/test/'+CRYORB)
   return orbitals,system
 
+def test_read_gred():
+  from benchmark import text_read_gred
+  gred = 'mno/ref/crystal/GRED.DAT'
+  ref = text_read_gred(gred)
+  new = obj.crystal2qmc.read_gred(gred)
+  assert new[0] == ref[0]
+  for refsec,sec in zip(ref[1:],new[1:]):
+    assert refsec.keys() == sec.keys()
+    for key in refsec:
+      refvals = refsec[key] if type(refsec[key]) is dict else {None:refsec[key]}
+      vals = sec[key] if type(sec[key]) is dict else {None:sec[key]}
+      for subkey in refvals:
+        assert np.array_equal(refvals[subkey],vals[subkey]) and np.asarray(refvals[subkey]).dtype == np.asarray(vals[subkey]).dtype
+
+  # Small chunks so words are split between chunks.
+  words = open(gred).read().replace("-"," -").replace("E -","E-").split()
+  with obj.crystal2qmc.GredTokens(gred,chunksize=1001) as tokens:
+    tokens.skip(5000)
+    assert (tokens.take(100000,str) == np.array(words[5000:105000])).all()
+
+def test_kred_reader():
+  info, lat_parm, ions, basis, pseudo = obj.crystal2qmc.read_gred('mno/ref/crystal/GRED.DAT')
+  eigsys = obj.crystal2qmc.read_kred(info,basis,'mno/ref/crystal/KRED.DAT')
+  with obj.crystal2qmc.KredReader(eigsys) as reader:
+    for spin in range(eigsys['nspin']):
+      start = eigsys['kpt_file_start'][(0,0,0)][spin]
+      ref = np.array(open(eigsys['kred']).read()[start:].split()[:eigsys['nbands']*eigsys['nao']],dtype=float)
+      assert (reader.lookup((0,0,0),spin) == ref.reshape(eigsys['nbands'],eigsys['nao'])).all()
+      assert (reader.lookup((0,0,0),spin,maxbands=3) == ref.reshape(eigsys['nbands'],eigsys['nao'])[:3]).all()
+
+  # Blocks whose first line isn't full, and blocks that aren't in 4E21.13, are still read right.
+  import tempfile
+  vals = np.random.randn(11)
+  lines = lambda v,fmt: ''.join([''.join([fmt%x for x in v[i:i+4]])+'\n' for i in range(0,len(v),4)])
+  blocks = [lines(vals[:3],'%21.13E'),lines(vals[3:],'%21.13E'),lines(vals,'%15.7E')]
+  with tempfile.TemporaryDirectory() as tmpdir:
+    open(tmpdir+'/KRED.DAT','w').write(''.join(blocks))
+    with obj.crystal2qmc.KredReader({'kred':tmpdir+'/KRED.DAT'}) as reader:
+      starts = np.cumsum([0]+[len(block) for block in blocks])
+      assert (reader._parse(starts[0],np.empty(3)) == [float('%21.13E'%x) for x in vals[:3]]).all()
+      assert (reader._parse(starts[1],np.empty(8)) == [float('%21.13E'%x) for x in vals[3:]]).all()
+      assert (reader._parse(starts[2],np.empty(11)) == [float('%15.7E'%x) for x in vals]).all()
+
+def test_crystal_cache():
+  import tempfile
+  with tempfile.TemporaryDirectory() as cache_dir:
+    gred, kred = 'mno/ref/crystal/GRED.DAT', 'mno/ref/crystal/KRED.DAT'
+    ref = obj.crystal_cache.load_crystal(gred,kred)
+    first = obj.crystal_cache.load_crystal(gred,kred,use_cache=True,cache_dir=cache_dir)
+    second = obj.crystal_cache.load_crystal(gred,kred,use_cache=True,cache_dir=cache_dir)
+    assert 'cache' not in ref[-1] and first[-1]['cache'] == second[-1]['cache']
+    assert (second[3]['prim_gaus'] == ref[3]['prim_gaus']).all()
+    assert (second[-1]['eigvals'] == ref[-1]['eigvals']).all()
+    for spin in range(ref[-1]['nspin']):
+      assert (obj.crystal2qmc.eigvec_lookup((0,0,0),second[-1],spin) == obj.crystal2qmc.eigvec_lookup((0,0,0),ref[-1],spin)).all()
+      assert (obj.crystal2qmc.eigvec_lookup((0,0,0),second[-1],spin,maxbands=5) == obj.crystal2qmc.eigvec_lookup((0,0,0),ref[-1],spin)[:5]).all()
+    assert obj.crystal_cache.evict(cache_dir,max_bytes=0) == [second[-1]['cache']]
+
+def test_write_orbfile():
+  import io
+  from benchmark import text_write_orbfile
+  naos = [7,3,12]
+  eigvecs = [np.random.randn(9,sum(naos)),np.random.randn(4,sum(naos))]
+  for vecs,iscomplex in (eigvecs,False),([e*np.exp(1j*e) for e in eigvecs],True):
+    ref,new = io.StringIO(),io.StringIO()
+    text_write_orbfile(ref,naos,vecs,iscomplex)
+    obj.orbitals.write_orbfile(new,naos,vecs,iscomplex,chunksize=64)
+    assert ref.getvalue() == new.getvalue()
+
+def test_lazy_orbitals():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    args = ('mno/ref/crystal/GRED.DAT','mno/ref/crystal/KRED.DAT')
+    system, orbitals = obj.crystal2qmc.pack_objects(*args,spin=5,use_cache=False)
+    system, lazy = obj.crystal2qmc.pack_objects(*args,spin=5,use_cache=False,lazy=True)
+    assert not lazy[0].loaded()
+    orbitals[0].write_qwalk_orb(tmpdir+'/ref.orb')
+    lazy[0].write_qwalk_orb(tmpdir+'/lazy.orb')
+    assert not lazy[0].loaded()
+    assert open(tmpdir+'/ref.orb').read() == open(tmpdir+'/lazy.orb').read()
+    assert (lazy[0].eigvecs[0] == orbitals[0].eigvecs[0]).all() and lazy[0].loaded()
+
+def test_kaverage():
+  nstates, nkpt = 3, 4
+  def tbdm():
+    dm = {'states':list(range(nstates)),'obdm':{},'tbdm':{}}
+    for key in 'up','down':
+      dm['obdm'][key] = np.random.randn(nstates,nstates).tolist()
+      dm['obdm'][key+'_err'] = np.random.rand(nstates,nstates).tolist()
+    for key in 'upup','updown','downup','downdown':
+      dm['tbdm'][key] = np.random.randn(*(nstates,)*4).tolist()
+    return dm
+  data = [{'dpenergy':{'vals':[1.,2.],'err':[.1,.2]},'dpwf':{'vals':[3.,4.],'err':[.3,.4]},
+           'tbdm':tbdm(),'dprdm':[{'tbdm':tbdm()},{'tbdm':tbdm()}]} for k in range(nkpt)]
+  res = obj.average_tools.kaverage('average_derivative_dm',data)
+  assert res['dpenergy'] == [1.,2.]
+  assert np.allclose(res['dprdm'][1]['tbdm']['updown'],np.mean([d['dprdm'][1]['tbdm']['tbdm']['updown'] for d in data],axis=0))
+  assert np.allclose(res['tbdm']['obdm']['up_err'],np.sum([np.array(d['tbdm']['obdm']['up_err'])**2 for d in data],axis=0)**0.5/nkpt)
+  assert 'upup_err' not in res['tbdm']['tbdm']
+
+def test_qwalk_log():
+  import tempfile
+  energies, weights = [-1.0,-1.2,-1.1,-0.9], [10,20,10,20]
+  lines = ['block { ','  label vmc','  totweight 5','  total_energy -5.0 0.1','}']
+  for e,w in zip(energies,weights):
+    lines += ['block { ','  label dmc','  totweight %d'%w,'  total_energy %g 0.01'%e,
+              '  kinetic 1.0 0.01','  average_generator { obdm vals 1 2 3 } ','}']
+  with tempfile.TemporaryDirectory() as tmpdir:
+    logfn = tmpdir+'/qw.log'
+    open(logfn,'w').write('\n'.join(lines))
+    res = obj.qwalk_log.read_log(logfn)
+    mean = np.average(energies,weights=weights)
+    err = (np.average((np.array(energies)-mean)**2,weights=weights)/3)**0.5
+    assert res['total blocks'] == 4 and res['warmup blocks'] == 0 and res['label'] == 'dmc'
+    assert np.allclose(res['properties']['total_energy']['value'],[mean])
+    assert np.allclose(res['properties']['total_energy']['error'],[err])
+    assert obj.qwalk_log.read_log(logfn,label='vmc')['properties']['total_energy']['value'] == [-5.0]
+    assert obj.qwalk_log.read_log(logfn,warmup=2)['properties']['total_energy']['value'][0] == np.average(energies[2:],weights=weights[2:])
+    reader = obj.dmc.DMCReader(native=True,warmup=0)
+    assert reader.read_outputfiles([logfn.replace('.log','.o')]) == [res]
+
+def test_qwalk_log_layout():
+  import json, tempfile
+  # Blocks in the layout QWalk writes (total_energy0, ...), and the gosling -json layout, both written by hand:
+  # this checks the parser follows the format, not that it agrees with gosling on real runs.
+  ref = json.load(open('qwalk/dmc.log.json'))
+  res = obj.qwalk_log.read_log('qwalk/dmc.log',warmup=0)
+  assert {key:res[key] for key in ref if key!='properties'} == {key:ref[key] for key in ref if key!='properties'}
+  assert sorted(res['properties']) == sorted(ref['properties'])
+  for name in ref['properties']:
+    for key in 'value','error':
+      assert np.allclose(res['properties'][name][key],ref['properties'][name][key])
+  assert obj.dmc.DMCReader(native=True,warmup=0).read_outputfiles(['qwalk/dmc.o'])[0]['properties']['total_energy'] == res['properties']['total_energy']
+
+  block = 'block {\n label dmc\n totweight 1\n total_energy0 %g 0.01\n total_energy1 %g 0.01\n'
+  block += ' average_generator {\n type tbdm_basis\n vals %g 2 3\n }\n}\n'
+  with tempfile.TemporaryDirectory() as tmpdir:
+    logfn = tmpdir+'/qw.log'
+    open(logfn,'w').write(''.join([block%(-1-i,-2-i,i) for i in range(4)]))
+    res = obj.qwalk_log.collect_log(logfn,gosling=None)
+    assert np.allclose(res['properties']['total_energy']['value'],[-2.5,-3.5])
+    assert res['average_generators'][0]['type'] == 'tbdm_basis'
+    assert np.allclose(res['average_generators'][0]['vals'],[1.5,2,3])
+    open(logfn,'w').write(block.replace('total_energy','kinetic')%(-1,-2,0))
+    assert obj.qwalk_log.collect_log(logfn,gosling=None) == {}
+    open(logfn,'w').write('')
+    assert obj.qwalk_log.collect_log(logfn) == {}
+    assert obj.vmc.VMCReader(native=True).read_outputfile(logfn.replace('qw.log','missing.o')) == {}
+
+def test_log_tail():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    def block(e):
+      return 'block { \n label dmc\n totweight 1\n total_energy %g 0.01\n}\n'%e
+    logfn = tmpdir+'/qw.log'
+    open(logfn,'w').write(block(-1.0)+block(-2.0)[:30])
+    tail = obj.qwalk_log.LogTail(logfn)
+    assert len(tail.update()) == 1
+    open(logfn,'a').write(block(-2.0)[30:]+block(-3.0))
+    assert [b['properties']['total_energy'][0,0] for b in tail.update()] == [-1.0,-2.0,-3.0]
+    open(logfn,'w').write(block(-4.0))
+    assert [b['properties']['total_energy'][0,0] for b in tail.update()] == [-4.0]
+
+    outfn = tmpdir+'/qw.o'
+    line = 'step 1 current energy -%g +/- 0.01\n'
+    var = obj.linear.LinearReader()
+    open(outfn,'w').write(line%1+line%2)
+    assert var.read_outputfile(outfn)['energy_trace'] == [-1.,-2.]
+    open(outfn,'a').write(line%3)
+    assert var.read_outputfile(outfn)['energy_trace'] == [-1.,-2.,-3.]
+    open(outfn,'w').write(line%4)
+    assert var.read_outputfile(outfn)['energy_trace'] == [-4.]
+    open(outfn,'w').write(line%4+line%5+line%6)
+    assert var.read_outputfile(outfn)['energy_trace'] == [-4.,-5.,-6.]
+
+def test_collect_runs():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    outfiles = []
+    for run in range(4):
+      lines = []
+      for e in np.linspace(-1,-1.01,20):
+        lines += ['block { ','  label vmc','  totweight 1','  total_energy %g 0.01'%(e-run),'}']
+      open(tmpdir+'/run%d.log'%run,'w').write('\n'.join(lines)+'\n')
+      open(tmpdir+'/run%d.o'%run,'w').write('')
+      outfiles.append(tmpdir+'/run%d.o'%run)
+    outfiles.append(tmpdir+'/missing.o')
+    rows = obj.collect.collect_runs(outfiles,obj.vmc.VMCReader(gosling=None,native=True,warmup=0),nproc=2)
+    assert [row['status'] for row in rows] == ['ok']*4+['restart']
+    assert np.allclose([row['energy'] for row in rows[:4]],[-1.005-run for run in range(4)])
+    assert [row['blocks'] for row in rows] == [20]*4+[None]
+    assert obj.collect.timing_summary(rows)['total'] >= 0
+    threaded = obj.collect.collect_runs(outfiles,obj.vmc.VMCReader(gosling=None,native=True,warmup=0),nproc=2,threads=True)
+    assert [row['energy'] for row in threaded] == [row['energy'] for row in rows]
+
+    # Readers kept between calls only parse new blocks, and time them.
+    readers = {}
+    reader = obj.vmc.VMCReader(gosling=None,native=True,warmup=0)
+    rows = obj.collect.collect_runs(outfiles[:2],reader,nproc=2,readers=readers)
+    assert sorted(readers) == outfiles[:2] and 'reader' not in rows[0]
+    open(tmpdir+'/run0.log','a').write('block {\n label vmc\n totweight 1\n total_energy -1.02 0.01\n}\n')
+    rows = obj.collect.collect_runs(outfiles[:2],reader,nproc=2,readers=readers)
+    assert [row['blocks'] for row in rows] == [21,20]
+    assert len(readers[outfiles[0]]._tails[tmpdir+'/run0.log'].history) == 2
+    assert readers[outfiles[0]].seconds_per_block() is not None
+    assert [row['error'] for row in rows] == [readers[fn].energy_error() for fn in outfiles[:2]]
+
+def test_trace_reader():
+  import tempfile
+  nblock, nconfig, nelec = 5, 7, 4
+  positions = np.random.randn(nblock*nconfig,nelec,3)
+  weights = np.random.rand(nblock*nconfig)
+  with tempfile.TemporaryDirectory() as tmpdir:
+    tracefn = tmpdir+'/dmc.trace'
+    obj.trace.write_trace(tracefn,positions,weights)
+    open(tracefn,'ab').write(b'partial')
+    with obj.trace.TraceReader(tracefn,nelec,nconfig) as trace:
+      assert len(trace) == nblock
+      pos, wt = trace.block(-1)
+      assert (pos == positions[-nconfig:]).all() and (wt == weights[-nconfig:]).all()
+      assert np.allclose([w.sum() for p,w in trace.blocks(1,step=2)],weights.reshape(nblock,nconfig)[1::2].sum(axis=1))
+      assert (trace.weights() == weights.reshape(nblock,nconfig)).all()
+      assert trace.subsample(10,seed=0).shape == (10,nelec,3)
+
+def test_postprocess_shards():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    nblock, nconfig, nelec, nskip = 10, 3, 2, 2
+    weights = np.random.rand(nblock*nconfig)
+    obj.trace.write_trace(tmpdir+'/dmc.trace',np.random.randn(nblock*nconfig,nelec,3),weights)
+    writer = obj.postprocess.PostprocessWriter('sys','trialfunc',tmpdir+'/dmc.trace',nskip=nskip)
+    infiles = writer.qwalk_input_shards(tmpdir+'/post',3,nconfig,nelec)
+    assert len(infiles) == 3 and 'nskip 0' in open(infiles[0]).read()
+    shards = obj.postprocess.json.load(open(tmpdir+'/post.shards'))
+    assert [s['blocks'] for s in shards] == [[2,5],[5,7],[7,10]]
+    # Only the blocks of each shard are copied; the last shard reads the original trace.
+    assert shards[2]['tracefn'] == tmpdir+'/dmc.trace' and 'nskip 7' in open(infiles[2]).read()
+    for s in shards[:2]:
+      trace = obj.trace.TraceReader(s['tracefn'],nelec,nconfig)
+      assert trace.nblocks == s['blocks'][1]-s['blocks'][0]
+      trace.close()
+    assert np.isclose(sum([s['weight'] for s in shards]),weights[nskip*nconfig:].sum())
+    for i,infile in enumerate(infiles):
+      out = {'properties':{'total_energy':{'value':[float(i)],'error':[0.1]}},'states':[1,2],'file':infile,
+             'dprdm':[{'value':[float(i)],'label':'shard%d'%i}]}
+      obj.postprocess.json.dump(out,open(infile+'.json','w'))
+    merged = obj.postprocess.merge_postprocess(tmpdir+'/post.shards')
+    w = np.array([s['weight'] for s in shards])/sum([s['weight'] for s in shards])
+    assert np.allclose(merged['properties']['total_energy']['value'],[(w*np.arange(3)).sum()])
+    assert np.allclose(merged['properties']['total_energy']['error'],[0.1*(w**2).sum()**0.5])
+    assert merged['states'] == [1,2] and merged['file'] == infiles[0]
+    assert np.allclose(merged['dprdm'][0]['value'],[(w*np.arange(3)).sum()]) and merged['dprdm'][0]['label'] == 'shard0'
+
+def test_reblock():
+  # AR(1) series: autocorrelation time (1+phi)/(1-phi) = 9.
+  phi, nblock = 0.8, 2**14
+  rand = np.random.RandomState(1)
+  vals = np.zeros(nblock)
+  for i in range(1,nblock):
+    vals[i] = phi*vals[i-1] + rand.randn()
+  res = obj.reblock.analyze(vals,errtol=0.01)
+  assert res['converged'] and 7 < res['tau'] < 11
+  assert 2.5 < res['error']/res['naive_error'] < 3.5
+  assert res['extra_blocks'] == obj.reblock.extra_blocks(res['error'],nblock,0.01) > 0
+  assert obj.reblock.extra_blocks(0.005,100,0.01) == 0
+  stats = obj.reblock.reblock(np.arange(8.))
+  assert list(stats['blocksize']) == [1,2,4] and np.isclose(stats['error'][0],np.std(np.arange(8.),ddof=1)/8**0.5)
+  assert 40 <= obj.reblock.detect_warmup(np.concatenate([np.linspace(10,0,50),rand.randn(500)*0.1])) <= 60
+
+  # Short uncorrelated runs: the error is unbiased, so runs whose true error is errtol are done about half the time,
+  # and runs whose true error is 1.5*errtol rarely are.
+  errtol, nblock, ntrial = 0.01, 20, 2000
+  runs = rand.randn(ntrial,nblock)*errtol*nblock**0.5
+  results = [obj.reblock.analyze(run) for run in runs]
+  assert 0.9 < np.mean([res['error'] for res in results])/errtol < 1.1
+  assert 0.4 < np.mean([res['error'] <= errtol for res in results]) < 0.7
+  assert np.mean([obj.reblock.analyze(1.5*run)['error'] <= errtol for run in runs]) < 0.1
+
+def test_plan_restart():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    rand = np.random.RandomState(2)
+    def blocks(n):
+      return ''.join(['block {\n label dmc\n totweight 1\n total_energy %.8f 0.01\n}\n'%(-1+0.04*rand.randn()) for i in range(n)])
+    import os
+    open(tmpdir+'/dmc.log','w').write(blocks(20))
+    os.utime(tmpdir+'/dmc.log',(1000.,1000.))
+    open(tmpdir+'/dmc.o','w').write('')
+    reader = obj.dmc.DMCReader(errtol=0.004,native=True,warmup=0)
+    assert reader.collect(tmpdir+'/dmc.o') == 'restart'
+    assert reader.seconds_per_block() is None
+    try:
+      obj.planner.plan_restart(reader)
+      assert False, "Planned a wall time without a time per block."
+    except ValueError:
+      pass
+    open(tmpdir+'/dmc.log','a').write(blocks(10))
+    os.utime(tmpdir+'/dmc.log',(1050.,1050.))
+    reader.collect(tmpdir+'/dmc.o')
+    plan = obj.planner.plan_restart(reader,safety=1.0)
+    error = reader.output['reblock']['error']
+    assert plan['blocks'] == 30 and plan['nblock'] == int(np.ceil(30*(error/0.004)**2))-30
+    assert plan['seconds_per_block'] == 5.0 and plan['walltime'] == plan['nblock']*5.0
+    assert obj.planner.plan_restart(reader,seconds_per_block=2.0,max_nblock=5)['walltime'] == 10.0
+    writer = obj.planner.apply_plan(obj.dmc.DMCWriter('sys','wf'),plan)
+    assert writer.nblock == plan['nblock']
+
+def test_pseudo_library():
+  import tempfile, os
+  xml = '../qwalk_objects/BFD_Library.xml'
+  library = obj.pseudo_library.get_library(xml)
+  assert obj.pseudo_library.get_library(xml) is library
+  assert library.pseudopotential('O')['core_charge'] == '6'
+  assert library.basis('Mn','vtz')[0]['angular'] == 's'
+  library.basis('Mn','vtz')[0]['terms'].append(('1.0','1.0'))
+  library.pseudopotential('O')['local'].clear()
+  assert library.basis('Mn','vtz') == obj.pseudo_library.PseudoLibrary(xml).basis('Mn','vtz')
+  assert len(library.pseudopotential('O')['local']) > 0
+  with tempfile.TemporaryDirectory() as cache_dir:
+    obj.pseudo_library._libraries.clear()
+    persisted = obj.pseudo_library.get_library(xml,persist=True,cache_dir=cache_dir)
+    obj.pseudo_library._libraries.clear()
+    assert [fn.endswith('.json') for fn in os.listdir(cache_dir)] == [True]
+    assert obj.pseudo_library.get_library(xml,persist=True,cache_dir=cache_dir).elements == persisted.elements
+    system = obj.system.System()
+    system.positions = [{'species':'O','abc':[0,0,0],'xyz':[0,0,0]}]
+    system.lookup_pseudopotential(xml)
+    assert system.pseudo['O']['local'][0]['r_to_n'] == int(library.pseudopotential('O')['local'][0][2])
+
+def test_compiled_library():
+  import tempfile, shutil, os
+  with tempfile.TemporaryDirectory() as tmpdir:
+    xml = tmpdir+'/BFD_Library.xml'
+    shutil.copy('../qwalk_objects/BFD_Library.xml',xml)
+    parsed = obj.pseudo_library.PseudoLibrary(xml)
+    compiled = obj.pseudo_library.CompiledLibrary(obj.pseudo_library.compile_library(xml))
+    for symbol in parsed.elements:
+      assert parsed.pseudopotential(symbol) == compiled.pseudopotential(symbol)
+      assert parsed.basis(symbol,'vtz') == compiled.basis(symbol,'vtz')
+    angular, exps, coefs = compiled.basis_arrays('O','vdz')[0]
+    assert angular == 's' and np.allclose(exps,[float(e) for e,c in parsed.basis('O','vdz')[0]['terms']])
+    assert isinstance(obj.pseudo_library.get_library(xml),obj.pseudo_library.CompiledLibrary)
+    # A store older than an edit to the XML (e.g. after a checkout that touched it) is recompiled, not used.
+    store = obj.pseudo_library.compiled_name(xml)
+    open(xml,'a').write('\n')
+    mtime = os.stat(xml).st_mtime
+    os.utime(store,(mtime+10,mtime+10))
+    library = obj.pseudo_library.get_library(xml)
+    with np.load(store) as npz:
+      assert npz['source_size'] == os.stat(xml).st_size
+    assert isinstance(library,obj.pseudo_library.CompiledLibrary) and library.pseudopotential('O') == parsed.pseudopotential('O')
+
+def test_refit_library():
+  import tempfile, warnings
+  from xml.etree.ElementTree import ElementTree
+  from qwalk_objects import basis_refit
+  with tempfile.TemporaryDirectory() as tmpdir:
+    tree = ElementTree()
+    tree.parse('../qwalk_objects/BFD_Library.xml')
+    for element in list(tree.getroot())[1:]:
+      tree.getroot().remove(element)
+    tree.write(tmpdir+'/H.xml')
+    with warnings.catch_warnings():
+      warnings.simplefilter('ignore')
+      table = basis_refit.refit_library(tmpdir+'/H.xml',tmpdir+'/H1.xml',tmpdir+'/H1.csv',ebases=(0.2,0.3))
+      basis_refit.refit_library(tmpdir+'/H.xml',tmpdir+'/H2.xml',tmpdir+'/H2.csv',ebases=(0.2,0.3),nproc=2)
+    assert open(tmpdir+'/H1.xml').read() == open(tmpdir+'/H2.xml').read()
+    assert open(tmpdir+'/H1.csv').read() == open(tmpdir+'/H2.csv').read()
+    assert [row['ebase'] for row in table[:2]] == [0.2,0.3] and all([row['symbol'] == 'H' for row in table])
+
+def test_gaussian_fit():
+  from scipy.integrate import quad
+  from qwalk_objects import basis_refit
+  basis = {'el':'P','exp':[0.06,0.15,0.4,1.1,3.0,8.0],'coeff':[0.1,0.3,0.4,0.2,0.05,0.01]}
+  for nexp in 4,7,12:
+    exps, coeffs, err = basis_refit.fit_exp(basis,[0.1*2**i for i in range(nexp)])
+    assert len(coeffs) == nexp
+    ref = quad(lambda x: abs(basis_refit.evaluate(exps,coeffs,'P',x)-basis_refit.evaluate(basis['exp'],basis['coeff'],'P',x)),0,10,limit=200)[0]
+    assert abs(err-ref) < 1e-4*ref
+  exps, coeffs, errall = basis_refit.fit_exp_all(basis,[0.1*2**i for i in range(4)])
+  assert errall < basis_refit.fit_exp(basis,[0.1*2**i for i in range(4)])[2] and (exps > 0).all()
+
+def test_qwalk_sys():
+  system, orbitals = obj.crystal2qmc.pack_objects('mno/ref/crystal/GRED.DAT','mno/ref/crystal/KRED.DAT',spin=5)
+  sections = system.export_qwalk_sys_kpoints([(0.0,0.0,0.0),(1.0,0.0,0.0)])
+  assert sections[0] == system.export_qwalk_sys()
+  assert sections[1] == sections[0].replace("kpoint {  0.0    0.0    0.0 }","kpoint {  1.0    0.0    0.0 }")
+  assert sections[0].count("  atom { ") == len(system.positions)
+  species = system.positions[0]['species']
+  system.pseudo[species]['local'][0]['coef'] = 12.5
+  system.positions[0]['xyz'] = [0.5,0.5,0.5]
+  changed = system.export_qwalk_sys()
+  assert "12.5" in changed and "  atom {{ {} {} coor  0.5 ".format(species,system.pseudo[species]['core_charge']) in changed
+
+def test_positions():
+  system = obj.system.System()
+  system.positions = [{'species':'Mn','abc':[0,0,0]},{'species':'O','abc':[0.5,0.5,0.5]},{'species':'Mn','abc':[0.25,0.5,0.0]}]
+  assert isinstance(system.positions,obj.system.Positions)
+  assert system.positions.species_names == ['Mn','O'] and list(system.positions.species_index) == [0,1,0]
+  assert system.positions[1]['species'] == 'O' and 'xyz' not in system.positions[1]
+  assert [site['species'] for site in system.positions[1:]] == ['O','Mn'] and system.positions[::-1][0]['abc'] == [0.25,0.5,0.0]
+  abc = system.positions[1]['abc']
+  abc[0] = 9.0
+  assert system.positions.abc[1,0] == 0.5
+  system.positions[2]['abc'] = [0.25,0.25,0.25]
+  system.positions.append({'species':'Ni','abc':[0.1,0.2,0.3]})
+  assert system.positions.abc.shape == (4,3) and system.positions.to_list()[2]['abc'] == [0.25,0.25,0.25]
+  system.latparm = {'a':4.4}
+  system.group_number = 225
+  assert system.export_crystal_geom()[4:] == ['4','225 0 0 0','208 0.5 0.5 0.5','225 0.25 0.25 0.25','228 0.1 0.2 0.3']
+
+def test_make_supercell():
+  system, orbitals = obj.crystal2qmc.pack_objects('mno/ref/crystal/GRED.DAT','mno/ref/crystal/KRED.DAT',spin=5)
+  system.kpoint = (1.0,0.0,1.0)
+  matrix = [[2,1,0],[0,1,0],[0,0,3]]
+  supercell = system.make_supercell(matrix)
+  assert len(supercell.positions) == 6*len(system.positions)
+  assert supercell.nspin == (6*system.nspin[0],6*system.nspin[1])
+  assert np.allclose(supercell.latparm['latvecs'],np.dot(matrix,system.latparm['latvecs']))
+  assert supercell.kpoint == (0.0,0.0,1.0)
+  frac = np.dot(supercell.positions.xyz,np.linalg.inv(supercell.latparm['latvecs']))
+  assert np.allclose(frac,supercell.positions.abc)
+  assert len(np.unique(np.round(frac,6),axis=0)) == len(supercell.positions)
+  assert supercell.export_qwalk_sys().count("  atom { ") == len(supercell.positions)
+
+def test_write_twists():
+  import tempfile, copy
+  args = ('mno/ref/crystal/GRED.DAT','mno/ref/crystal/KRED.DAT')
+  system, orbitals = obj.crystal2qmc.pack_objects(*args,spin=5,lazy=True)
+  twists = []
+  for kpoint in (0.,0.,0.),(1.,0.,0.),(1.,1.,0.):
+    orbs = copy.deepcopy(orbitals[0])
+    orbs.kpoint = kpoint
+    orbs.kweight = 0.5 if kpoint == (1.,0.,0.) else 0.25
+    twists.append(orbs)
+  with tempfile.TemporaryDirectory() as tmpdir:
+    base = tmpdir+'/mno'
+    writer = obj.dmc.DMCWriter(None,None)
+    manifest = obj.twist.write_twists(system,twists,writer,base=base,nproc=2,sources=args)
+    assert manifest['total kweight'] == 1.0 and len(manifest['twists']) == 3
+    twist = manifest['twists'][1]
+    assert twist['kweight'] == 0.5 and len(twist['written']) == 3
+    assert "kpoint {  1.0    0.0    0.0 }" in open(twist['sysfile']).read()
+    assert "include %s.basis"%base in open(twist['infile']).read()
+    assert all([twist['written'] == [] for twist in obj.twist.write_twists(system,twists,writer,base=base,sources=args)['twists']])
+    writer.nblock = 10
+    rerun = obj.twist.write_twists(system,twists,writer,base=base,sources=args)
+    assert [twist['written'] for twist in rerun['twists']] == [[twist['infile']] for twist in rerun['twists']]
+
+    # Coefficients are only read to write orb files, and released after; without sources, orb files are rewritten.
+    lookups = []
+    lookup = obj.crystal2qmc.KredReader.lookup
+    def counted(self,*largs,**kwargs):
+      lookups.append(largs)
+      return lookup(self,*largs,**kwargs)
+    obj.crystal2qmc.KredReader.lookup = counted
+    try:
+      obj.twist.write_twists(system,twists,writer,base=base,sources=args)
+      assert lookups == [] and not any([orbs.loaded() for orbs in twists])
+      manifest = obj.twist.write_twists(system,twists,writer,base=base)
+      assert len(lookups) == 3*len(twists[0].nmos())
+      assert all([twist['written'] == [twist['orbfile']] for twist in manifest['twists']])
+      assert not any([orbs.loaded() for orbs in twists])
+    finally:
+      obj.crystal2qmc.KredReader.lookup = lookup
+
+    # Slater still takes any orbitals with export_qwalk_orbitals(orbfile) and eigvecs.
+    class PlainOrbitals:
+      eigvecs = [np.zeros((3,2))]*2
+      def export_qwalk_orbitals(self,orbfn):
+        return 'orbitals { orbfile %s }'%orbfn
+    slater = obj.trialfunc.Slater(PlainOrbitals(),'plain.orb',[[[1],[1]]],shift_downorb=True)
+    assert slater.shift_downorb == 3 and 'orbfile plain.orb' in slater.export_qwalk_wf()
+
+def test_average_twists():
+  import tempfile
+  with tempfile.TemporaryDirectory() as tmpdir:
+    energies, kweights = [-1.0,-2.0,-4.0], [0.25,0.5,0.25]
+    twists = []
+    for i,energy in enumerate(energies):
+      twists.append({'twist':i,'infile':tmpdir+'/mno_%d.in'%i,'kweight':kweights[i]})
+      if i == 2: continue
+      lines = []
+      for block in range(20):
+        lines += ['block { ','  label dmc','  totweight 1','  total_energy %g 0.01'%(energy+0.001*(-1)**block),'}']
+      open(twists[-1]['infile']+'.log','w').write('\n'.join(lines)+'\n')
+      open(twists[-1]['infile']+'.o','w').write('')
+    manifest = {'twists':twists}
+    reader = obj.dmc.DMCReader(errtol=0.1,native=True,minblocks=10,warmup=0)
+    res = obj.twist.collect_twists(manifest,reader)
+    assert not res['complete'] and list(res['blocking']) == [tmpdir+'/mno_2.in.o'] and res['missing'] == [tmpdir+'/mno_2.in.o']
+    assert res['properties'] == {}
+    res = obj.twist.collect_twists(manifest,reader,partial=True)
+    assert np.allclose(res['properties']['total_energy']['value'],[(0.25*-1.0+0.5*-2.0)/0.75]) and res['kweight'] == 0.75
+    assert res['incomplete'] == []
+    unfinished = obj.twist.collect_twists(manifest,obj.dmc.DMCReader(errtol=0.1,native=True,minblocks=30,warmup=0),partial=True)
+    assert unfinished['properties'] == {} and unfinished['twists'] == 0
+    assert unfinished['incomplete'] == [tmpdir+'/mno_0.in.o',tmpdir+'/mno_1.in.o'] and unfinished['missing'] == [tmpdir+'/mno_2.in.o']
+    outputs = [row['output'] for row in res['rows'][:2]]*2
+    full = obj.twist.average_twists(outputs,[1.0,1.0,2.0,2.0])
+    errs = [output['reblock']['error'] for output in outputs]
+    assert np.allclose(full['properties']['total_energy']['error'],[(errs[0]**2+errs[1]**2+4*errs[0]**2+4*errs[1]**2)**0.5/6])
+    assert full['missing'] == [] and full['twists'] == 4
+    twowf = [{'properties':{'total_energy':{'value':[-1.,-2.],'error':[.1,.2]}}} for i in range(2)]
+    twowf[0]['reblock'] = {'error':.3}
+    mixed = obj.twist.average_twists(twowf,[1.,1.])
+    assert np.allclose(mixed['properties']['total_energy']['error'],[(.3**2+.1**2)**0.5/2,(.2**2+.2**2)**0.5/2])
+    def tbdm(k):
+      return {'states':[0],'obdm':{'up':[[k]],'down':[[k]]},'tbdm':{key:[[[[k]]]] for key in ('upup','updown','downup','downdown')}}
+    data = [{'dpenergy':{'vals':[1.,2.],'err':[.1,.2]},'dpwf':{'vals':[3.,4.],'err':[.3,.4]},
+             'tbdm':tbdm(k),'dprdm':[{'tbdm':tbdm(k)}]} for k in (1.0,4.0)]
+    weighted = obj.average_tools.kaverage('average_derivative_dm',data,weights=[3.,1.])
+    assert weighted['tbdm']['obdm']['up'] == [[1.75]] and np.allclose(weighted['dpenergy_err'],np.array([.1,.2])*10**0.5/4)
+
 # NEXT STEP: write the tests for qwalk parts.
 def test_variance_writer():
   system, orbitals = obj.crystal2qmc.pack_objects('mno/ref/crystal/GRED.DAT','mno/ref/crystal/KRED.DAT',spin=5) 